@@ -1,339 +1,677 @@
 import os
+import time
 import logging
+import threading
 from datetime import datetime, timedelta # <--- Added timedelta
-from flask import Flask, request
-from twilio.twiml.messaging_response import MessagingResponse
-from twilio.rest import Client # <--- Added Client
+from flask import Flask, request, Response, send_file
 
 # Local imports
+import callbacks
 import database
+import dispatch
+import idempotency
+import metrics
+import migrations
 import mpesa
+import outbox
+import payouts
+import profiling
+import ratelimit
+import reconcile
+from router import CommandRouter, prerender
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
-database.init_db()
+
+# --- STARTUP ---
+# Kept short because workers are started on demand. Schema changes run once
+# per deploy (migrations.py); here we only check the version. Heavy modules
+# used by few requests (twilio.rest, Crypto) are imported on first use.
+# `python startup_report.py` breaks the cold start down.
+# STARTUP_WARM_UP: 'background' (default) pre-encrypts the B2C credential
+# off the startup path, 'sync' before serving, 'off' on the first WITHDRAW.
+STARTUP_WARM_UP = os.environ.get("STARTUP_WARM_UP", "background")
+STARTUP_TIMINGS = {} # step -> milliseconds
+
+def _startup_step(name, fn):
+    started = time.perf_counter()
+    fn()
+    STARTUP_TIMINGS[name] = round((time.perf_counter() - started) * 1000, 2)
+
+_startup_step('schema_check', migrations.ensure_current)
+if STARTUP_WARM_UP == 'sync':
+    _startup_step('warm_up', mpesa.warm_up)
+elif STARTUP_WARM_UP == 'background':
+    _startup_step('warm_up', threading.Thread(target=mpesa.warm_up, name="warm-up", daemon=True).start)
+app.logger.info(f"Startup steps (ms): {STARTUP_TIMINGS}")
 
 # CONFIGURATION
-MIN_WITHDRAWAL = 50 
+MIN_WITHDRAWAL = payouts.MIN_WITHDRAWAL
 
 # TWILIO CREDENTIALS (REQUIRED FOR REMINDERS)
 # Get these from your Twilio Console Dashboard
 TW_SID = os.environ.get("TWILIO_SID", "YOUR_TWILIO_ACCOUNT_SID")
 TW_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN", "YOUR_TWILIO_AUTH_TOKEN")
 TW_NUMBER = "whatsapp:+14155238886" # Your Twilio Sandbox Number
+# Seconds a Twilio API call may take; must stay well under outbox.OUTBOX_LEASE_SECONDS
+TWILIO_TIMEOUT = float(os.environ.get("TWILIO_TIMEOUT", "15"))
+
+# STK PUSH DISPATCH
+# 'sync': BUY/PAY wait for Daraja before replying (default)
+# 'async': reply at once, push runs on a background pool, result sent via Twilio
+STK_DISPATCH_MODE = os.environ.get("STK_DISPATCH_MODE", "sync")
+stk_pool = dispatch.WorkerPool("stk",
+                               workers=int(os.environ.get("STK_WORKERS", "4")),
+                               max_queue=int(os.environ.get("STK_QUEUE_SIZE", "100")))
 
-def is_expired(expiry_date_str):
-    if not expiry_date_str: return False
+_twilio_client = None
+
+def get_twilio_client():
+    """Returns a shared Twilio REST client (created on first use)."""
+    global _twilio_client
+    if _twilio_client is None:
+        from twilio.rest import Client # Slow to import; most workers never send
+        from twilio.http.http_client import TwilioHttpClient
+        _twilio_client = Client(TW_SID, TW_TOKEN, http_client=TwilioHttpClient(timeout=TWILIO_TIMEOUT))
+    return _twilio_client
+
+def send_whatsapp(to, body):
+    """Sends a WhatsApp message outside of a webhook reply. Returns the message SID."""
+    status = 'error'
     try:
-        expiry = datetime.strptime(expiry_date_str, '%Y-%m-%d')
-        return datetime.now() > expiry
-    except ValueError:
-        return False
+        with metrics.timer('twilio_request_seconds', operation='messages.create'):
+            message = get_twilio_client().messages.create(body=body, from_=TW_NUMBER, to=to)
+        status = 'sent'
+        return message.sid
+    finally:
+        metrics.inc('twilio_messages_total', {'status': status})
+
+# Messages we start are queued and delivered in the background (see outbox.py)
+outbox.workers.start(send_whatsapp)
+
+def is_expired(expires_at):
+    """expires_at: epoch seconds (shop[6]), or None for no expiry."""
+    return expires_at is not None and time.time() > expires_at
 
 # --- NEW: AUTOMATIC REMINDER ENDPOINT ---
 # Set up a Cron Job to hit this URL (e.g., https://your-app.com/cron/send_reminders) daily
+# Reminders are only queued in the outbox, a page at a time; progress is saved
+# with each page, so a crashed or missed run picks up where it stopped (up to
+# REMINDER_CATCHUP_DAYS back) without double-sending.
+REMINDER_JOB = "expiry_reminders"
+REMINDER_CATCHUP_DAYS = int(os.environ.get("REMINDER_CATCHUP_DAYS", "7"))
+
+def reminder_message(name, expiry_date, tomorrow):
+    if expiry_date == tomorrow:
+        when = f"expires tomorrow ({tomorrow})!"
+    elif expiry_date > tomorrow:
+        when = f"expires on {expiry_date}."
+    else:
+        when = f"expired on {expiry_date}."
+    return (f"⚠️ *Urgent Reminder*\n\n"
+            f"Hello {name}, your shop subscription {when}\n"
+            f"To keep your shop online, please text *PAY* to renew now.")
+
 @app.route('/cron/send_reminders', methods=['GET'])
 def send_reminders():
     try:
-        # 1. Calculate "Tomorrow's Date"
-        tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        # 1. Calculate the window: "Tomorrow's Date", plus any days a missed run skipped
+        today = datetime.now()
+        tomorrow = (today + timedelta(days=1)).strftime('%Y-%m-%d')
+        earliest = (today + timedelta(days=1 - REMINDER_CATCHUP_DAYS)).strftime('%Y-%m-%d')
         
-        # 2. Get shops expiring tomorrow
-        expiring_shops = database.get_shops_expiring_on(tomorrow)
-        
-        if not expiring_shops:
-            return f"No shops expiring on {tomorrow}."
-
-        # 3. Initialize Twilio Client
-        client = Client(TW_SID, TW_TOKEN)
+        watermark = database.get_watermark(REMINDER_JOB)
+        if watermark and watermark[0] >= earliest:
+            start, after = watermark[0], watermark
+        else:
+            start, after = (tomorrow if not watermark else earliest), None
         
+        # 2. Stream shops expiring in the window, one page at a time
         count = 0
-        for phone, name in expiring_shops:
-            try:
-                # 4. Send the Active Message
-                msg_body = (f"⚠️ *Urgent Reminder*\n\n"
-                            f"Hello {name}, your shop subscription expires tomorrow ({tomorrow})!\n"
-                            f"To keep your shop online, please text *PAY* to renew now.")
-                
-                # Phone comes from DB as 'whatsapp:+254...', which is what Twilio needs
-                message = client.messages.create(
-                    body=msg_body,
-                    from_=TW_NUMBER,
-                    to=phone 
-                )
-                app.logger.info(f"Reminder sent to {name}: {message.sid}")
-                count += 1
-            except Exception as e:
-                app.logger.error(f"Failed to msg {name}: {e}")
-
-        return f"✅ Cron Job Complete. Sent {count} reminders for {tomorrow}."
+        page = []
+        def queue_page():
+            # 3. Queue the page and move the watermark past it in one commit
+            # Phone comes from DB as 'whatsapp:+254...', which is what Twilio needs
+            with database.transaction():
+                added = outbox.enqueue_many([(phone, reminder_message(name, expiry_date, tomorrow),
+                                              f"reminder:{phone}:{expiry_date}")
+                                             for phone, name, expiry_date in page])
+                # 4. Never revisit these shops for these expiry dates
+                database.set_watermark(REMINDER_JOB, page[-1][2], page[-1][0])
+            page.clear()
+            return added
+
+        for row in database.iter_shops_expiring_between(start, tomorrow, after):
+            page.append(row)
+            if len(page) >= database.EXPIRY_PAGE_SIZE:
+                count += queue_page()
+        if page:
+            count += queue_page()
+
+        if not count:
+            return f"No shops expiring on {tomorrow}."
+        return f"✅ Cron Job Complete. Queued {count} reminders for {start} to {tomorrow}."
         
     except Exception as e:
         app.logger.error(f"Cron Error: {e}")
         return f"❌ Error: {e}"
 
 
-@app.route('/bot', methods=['POST'])
-def bot():
-    # --- 1. DUAL INPUT HANDLING ---
-    # raw_msg: Preserves case (e.g., "Mama's Cafe", "http://mylink.com")
-    # command_msg: Uppercase for logic checks (e.g., "REGISTER", "HELP")
-    raw_msg = request.values.get('Body', '').strip()
-    command_msg = raw_msg.upper()
-    sender_number = request.values.get('From', '') 
-    
-    resp = MessagingResponse()
-    msg = resp.message()
-
-    # --- 2. INTELLIGENT HELP SYSTEM ---
-    if command_msg == 'HELP':
-        shop = database.get_shop(sender_number)
-        if shop:
-            msg.body(f"👋 *Hello {shop[1]} Owner!*\n\n"
-                     "Here is your menu:\n"
-                     "--------------------------------\n"
-                     "📊 *STATUS* - View Wallet & Expiry\n"
-                     "💸 *WITHDRAW* - Cash out to M-Pesa\n"
-                     "💰 *PAY* - Renew Subscription\n"
-                     "📝 *UPDATE* - Edit Details\n"
-                     "   Format: UPDATE | FIELD | VALUE\n"
-                     "   (e.g., UPDATE | HOURS | 8am-8pm)\n"
-                     "--------------------------------\n"
-                     "Need support? Contact Admin at https://dms-23bq.vercel.app/ OR +254703903056")
-        else:
-            msg.body("🤖 *Welcome to Dtekk ShopBot Help*\n\n"
-                     "🛍️ *Customers:*\n"
-                     "• To Buy: *BUY | Shop Name | Amount*\n"
-                     "• To View: *VIEW [Shop Name]*\n\n"
-                     "💼 *Shop Owners:*\n"
-                     "• To Join: *REGISTER | Name | Link | Map | Pay Info | Hours*")
-        return str(resp)
-    
-     # --- 2. WELCOME HANDLER (Hi, Hello, Start) ---
-    GREETINGS = ['HI', 'HELLO', 'START', 'JAMBO', 'HEY']
-    if command_msg in GREETINGS:
-        msg.body("👋 *Welcome to ShopBot!*\n\n"
-                 "Are you a Customer or a Shop Owner?\n\n"
-                 "👉 Text *HELP* to see what I can do.")
-        return str(resp)
-
-    # --- 3. REGISTRATION (ROBUST) ---
-    if command_msg.startswith('REGISTER'):
-        try:
-            # FIX: Limit split to 5. This handles if user puts '|' inside the hours/desc
-            parts = raw_msg.split('|', 5)
-            
-            if len(parts) < 6:
-                msg.body("⚠️ *Format Error!* Use:\n"
-                         "REGISTER | Name | Link | Map | Pay Info | Hours")
-                return str(resp)
-
-            # We slice [1:] effectively because the first part is the command 'REGISTER'
-            # But safer to unpack manually:
-            _, shop_name, catalog, location, payment, hours = [p.strip() for p in parts]
-            
-            success, result = database.add_shop(sender_number, shop_name, catalog, location, payment, hours)
-            
-            if success:
-                msg.body(f"✅ *{shop_name}* is LIVE!\nTrial until: {result}\nText *STATUS* to see dashboard.")
-            else:
-                msg.body(f"❌ Error: {result}")
-        except Exception as e:
-            msg.body("System Error. Ensure you used the '|' separator.")
-        return str(resp)
+# --- PENDING TRANSACTION RECONCILIATION ---
+# Hit every few minutes: settles STK pushes whose callback was lost and
+# clears pending rows that will never complete (see reconcile.py)
+@app.route('/cron/reconcile', methods=['GET'])
+def run_reconciliation():
+    try:
+        report = reconcile.run()
+        return f"✅ Reconciliation Complete. {report}"
+    except Exception as e:
+        app.logger.error(f"Reconcile Error: {e}")
+        return f"❌ Error: {e}"
+
+
+# --- BATCHED PAYOUTS ---
+# With WITHDRAW_MODE=batched, hit this on a schedule (e.g. hourly): it pays
+# every wallet whose owner sent WITHDRAW, or resumes an unfinished run (see payouts.py)
+@app.route('/cron/run_payouts', methods=['GET'])
+def run_payouts():
+    try:
+        report = payouts.run()
+        return f"✅ Payout Run Complete. {report}"
+    except Exception as e:
+        app.logger.error(f"Payout Run Error: {e}")
+        return f"❌ Error: {e}"
 
-    # --- 4. CUSTOMER BUY (Money IN) ---
-    elif command_msg.startswith('BUY'):
+
+# --- PAYMENT FLOWS ---
+# BUY, PAY and WITHDRAW are written once, as generators shared by the
+# handlers here and the async ones in async_app.py. A flow does the checks
+# and database work, yields each Daraja call as (name, *args), gets the
+# response sent back (or the exception thrown in) and returns the reply.
+# run_payment() makes the calls with DARAJA_CALLS; async_app awaits its own.
+DARAJA_CALLS = {'stk_push': mpesa.trigger_stk_push, 'b2c': mpesa.pay_shop_owner}
+
+def resume_payment(flow, response=None, error=None):
+    """Runs a flow up to its next Daraja call. Returns (call, None), or (None, reply) once it is done."""
+    try:
+        call = flow.throw(error) if error is not None else flow.send(response)
+    except StopIteration as done:
+        return None, done.value
+    return call, None
+
+def run_payment(flow, calls=DARAJA_CALLS):
+    """Runs a payment flow to its reply, making its Daraja calls with calls[name]."""
+    call, reply = resume_payment(flow)
+    while call:
+        name, *args = call
         try:
-            # Use raw_msg so specific casing in shop names might be respected (depending on DB search)
-            parts = raw_msg.split('|')
-            if len(parts) < 3:
-                msg.body("⚠️ Format: *BUY | Shop Name | Amount*")
-                return str(resp)
-
-            _, shop_query, amount_str = [p.strip() for p in parts]
-            shop = database.search_shop_by_name(shop_query)
-            
-            if not shop:
-                msg.body(f"❌ Shop '{shop_query}' not found.")
-                return str(resp)
-            
-            amount = float(amount_str)
-            customer_phone = sender_number.replace('whatsapp:', '').replace('+', '')
-            
-            # 1. Trigger STK Push
-            res = mpesa.trigger_stk_push(customer_phone, int(amount))
-            
-            if res.get('ResponseCode') == '0':
-                # 2. LOG PENDING TRANSACTION
-                checkout_id = res.get('CheckoutRequestID')
-                target_shop_phone = shop[0] 
-                
-                database.log_pending_transaction(checkout_id, sender_number, 'PURCHASE', target_shop_phone, amount)
-                
-                msg.body(f"📲 *Payment Initiated*\n"
-                         f"Paying KES {amount} to {shop[1]}.\n"
-                         f"Enter PIN to complete.")
-            else:
-                msg.body("❌ Payment Failed. Try again.")
-                
-        except ValueError:
-            msg.body("❌ Amount must be a number.")
+            response, error = calls[name](*args), None
         except Exception as e:
-            app.logger.error(f"Buy Error: {e}")
-            msg.body("System Error.")
-        return str(resp)
+            response, error = None, e
+        call, reply = resume_payment(flow, response, error)
+    return reply
 
-    # --- 5. SECURE WITHDRAWAL (Money OUT) ---
-    elif command_msg == 'WITHDRAW':
-        shop = database.get_shop(sender_number)
-        if not shop:
-            msg.body("❌ Not registered.")
-            return str(resp)
-            
-        current_balance = shop[7]
-        
-        if current_balance < MIN_WITHDRAWAL:
-            msg.body(f"❌ Balance too low (KES {current_balance}).\nMinimum withdrawal is KES {MIN_WITHDRAWAL}.")
-            return str(resp)
+def stk_push_flow(sender_number, tx_type, amount, target_shop=None):
+    """
+    Prompts the sender for their M-Pesa PIN and logs the pending transaction.
+    Returns True if Daraja accepted the request.
+    """
+    mpesa_phone = sender_number.replace('whatsapp:', '').replace('+', '')
+    res = yield ('stk_push', mpesa_phone, int(amount))
+    
+    if res.get('ResponseCode') == '0':
+        checkout_id = res.get('CheckoutRequestID')
+        database.log_pending_transaction(checkout_id, sender_number, tx_type, target_shop, amount)
+        return True
+    return False
+
+def start_stk_push(sender_number, tx_type, amount, target_shop=None):
+    """stk_push_flow() with the blocking client."""
+    return run_payment(stk_push_flow(sender_number, tx_type, amount, target_shop))
+
+def _stk_push_job(sender_number, tx_type, amount, target_shop, success_body, failure_body):
+    """Background version of start_stk_push: reports the outcome over WhatsApp (via the outbox)."""
+    try:
+        ok = start_stk_push(sender_number, tx_type, amount, target_shop)
+    except mpesa.MpesaError as e:
+        if getattr(e, 'sent', False):
+            # The PIN prompt may still arrive: don't tell them it failed
+            app.logger.error(f"STK Dispatch: unconfirmed {tx_type} for {sender_number}: {e}")
+            outbox.enqueue(sender_number, MPESA_UNCONFIRMED_REPLY)
+            return
+        app.logger.error(f"STK Dispatch Error: {e}")
+        ok = False
+    except Exception as e:
+        app.logger.error(f"STK Dispatch Error: {e}")
+        ok = False
+    outbox.enqueue(sender_number, success_body if ok else failure_body)
+
+def queue_stk_push(sender_number, tx_type, amount, target_shop, success_body, failure_body):
+    """Hands the STK push to the background pool. Returns False if it is full."""
+    return stk_pool.submit(_stk_push_job, sender_number, tx_type, amount, target_shop,
+                           success_body, failure_body)
+
+BUSY_REPLY = "⚠️ We're handling a lot of payments right now. Please try again in a minute."
+# While Daraja is failing (mpesa circuit open) payments are refused at once
+MPESA_DOWN_REPLY = prerender("⚠️ M-Pesa is not responding right now, so no payment was started.\n"
+                             "Please try again in a few minutes.")
+# The request may have reached Daraja, but we never heard back
+MPESA_UNCONFIRMED_REPLY = ("⚠️ M-Pesa didn't answer in time.\n"
+                           "If a PIN prompt still arrives, please ignore it and try again later.")
+
+WITHDRAW_UNCONFIRMED_REPLY = ("⚠️ M-Pesa didn't confirm your withdrawal in time.\n"
+                              "Your wallet is locked while we check. Contact support if the money doesn't arrive.")
+
+# --- COMMAND ROUTER ---
+# One handler per command; fixed replies are pre-rendered TwiML bytes.
+# Extra commands can be added as plugins: BOT_PLUGINS=module_a,module_b
+# (each module defines register(router)).
+router = CommandRouter(fallback="👋 Welcome! Text *HELP* to see menu.")
+
+# --- 1. INTELLIGENT HELP SYSTEM ---
+CUSTOMER_HELP = prerender("🤖 *Welcome to Dtekk ShopBot Help*\n\n"
+                          "🛍️ *Customers:*\n"
+                          "• To Buy: *BUY | Shop Name | Amount*\n"
+                          "• To View: *VIEW [Shop Name]*\n\n"
+                          "💼 *Shop Owners:*\n"
+                          "• To Join: *REGISTER | Name | Link | Map | Pay Info | Hours*")
+
+@router.command('HELP')
+def help_command(req):
+    shop = database.get_shop(req.sender)
+    if not shop:
+        return CUSTOMER_HELP
+    return (f"👋 *Hello {shop[1]} Owner!*\n\n"
+            "Here is your menu:\n"
+            "--------------------------------\n"
+            "📊 *STATUS* - View Wallet & Expiry\n"
+            "💸 *WITHDRAW* - Cash out to M-Pesa\n"
+            "💰 *PAY* - Renew Subscription\n"
+            "📝 *UPDATE* - Edit Details\n"
+            "   Format: UPDATE | FIELD | VALUE\n"
+            "   (e.g., UPDATE | HOURS | 8am-8pm)\n"
+            "--------------------------------\n"
+            "Need support? Contact Admin at https://dms-23bq.vercel.app/ OR +254703903056")
+
+# --- 2. WELCOME HANDLER (Hi, Hello, Start) ---
+router.static(['HI', 'HELLO', 'START', 'JAMBO', 'HEY'],
+              "👋 *Welcome to ShopBot!*\n\n"
+              "Are you a Customer or a Shop Owner?\n\n"
+              "👉 Text *HELP* to see what I can do.")
+
+# --- 3. REGISTRATION (ROBUST) ---
+# args=6: the last part keeps any '|' the user puts inside the hours/desc
+@router.command('REGISTER', prefix=True, args=6,
+                usage="⚠️ *Format Error!* Use:\nREGISTER | Name | Link | Map | Pay Info | Hours")
+def register_command(req):
+    try:
+        _, shop_name, catalog, location, payment, hours = req.args
         
-        # INTEGRITY CHECK: Prevent double-withdrawals
-        if database.check_pending_withdrawal(sender_number):
-            msg.body("⚠️ Withdrawal already in progress. Please wait.")
-            return str(resp)
-            
-        clean_phone = sender_number.replace('whatsapp:', '').replace('+', '')
+        success, result = database.add_shop(req.sender, shop_name, catalog, location, payment, hours)
         
-        # 1. Trigger B2C (Do NOT debit yet)
-        b2c_res = mpesa.pay_shop_owner(clean_phone, current_balance)
+        if success:
+            return f"✅ *{shop_name}* is LIVE!\nTrial until: {result}\nText *STATUS* to see dashboard."
+        return f"❌ Error: {result}"
+    except Exception as e:
+        return "System Error. Ensure you used the '|' separator."
+
+# --- 4. CUSTOMER BUY (Money IN) ---
+def buy_flow(req, background=False):
+    """background: queue the push on stk_pool and reply at once (STK_DISPATCH_MODE=async)."""
+    if not mpesa.is_available():
+        return MPESA_DOWN_REPLY
+    try:
+        _, shop_query, amount_str = req.args
+        shop = database.search_shop_by_name(shop_query)
         
-        # 2. Log Pending
-        # B2C returns ConversationID or OriginatorConversationID
-        req_id = b2c_res.get('ConversationID', f"W_{datetime.now().timestamp()}")
+        if not shop:
+            return f"❌ Shop '{shop_query}' not found."
         
-        database.log_pending_transaction(req_id, sender_number, 'WITHDRAWAL', amount=current_balance)
+        amount = float(amount_str)
+        target_shop_phone = shop[0] 
+        success_body = (f"📲 *Payment Initiated*\n"
+                        f"Paying KES {amount} to {shop[1]}.\n"
+                        f"Enter PIN to complete.")
         
-        msg.body(f"⏳ *Processing Withdrawal...*\n"
-                 f"Requesting KES {current_balance}.\n"
-                 f"You will receive an M-Pesa SMS shortly.")
-        return str(resp)
-
-    # --- 6. SUBSCRIPTION PAYMENT ---
-    elif command_msg == 'PAY':
-        shop = database.get_shop(sender_number)
-        if not shop:
-            msg.body("❌ Not registered.")
-            return str(resp)
+        if background:
+            # Reply now; the push + pending log happen off the request path
+            if queue_stk_push(req.sender, 'PURCHASE', amount, target_shop_phone,
+                              success_body, "❌ Payment Failed. Try again."):
+                return (f"⏳ Payment being initiated...\n"
+                        f"Paying KES {amount} to {shop[1]}. Watch for the M-Pesa PIN prompt.")
+            return BUSY_REPLY
+        # Trigger STK Push + LOG PENDING TRANSACTION
+        if (yield from stk_push_flow(req.sender, 'PURCHASE', amount, target_shop_phone)):
+            return success_body
+        return "❌ Payment Failed. Try again."
+            
+    except mpesa.MpesaBusy:
+        return BUSY_REPLY
+    except mpesa.MpesaUnavailable as e:
+        app.logger.warning(f"Buy: Daraja unavailable: {e}")
+        return MPESA_UNCONFIRMED_REPLY if e.sent else MPESA_DOWN_REPLY
+    except ValueError:
+        return "❌ Amount must be a number."
+    except Exception as e:
+        app.logger.error(f"Buy Error: {e}")
+        return "System Error."
+
+@router.command('BUY', prefix=True, args=3, usage="⚠️ Format: *BUY | Shop Name | Amount*")
+def buy_command(req):
+    return run_payment(buy_flow(req, background=STK_DISPATCH_MODE == 'async'))
 
-        mpesa_phone = sender_number.replace('whatsapp:', '').replace('+', '')
-        res = mpesa.trigger_stk_push(mpesa_phone, amount=1)
+# --- 5. SECURE WITHDRAWAL (Money OUT) ---
+def withdraw_flow(req):
+    sender_number = req.sender
+    # Never act on a cached balance
+    shop = database.get_shop(sender_number, fresh=True)
+    if not shop:
+        return "❌ Not registered."
         
-        if res.get('ResponseCode') == '0':
-            checkout_id = res.get('CheckoutRequestID')
-            database.log_pending_transaction(checkout_id, sender_number, 'SUBSCRIPTION')
-            msg.body("📲 Enter M-Pesa PIN to renew.")
-        else:
-            msg.body("❌ Payment Failed.")
-        return str(resp)
-
-    # --- 7. UPDATE DETAILS (Uses raw_msg) ---
-    elif command_msg.startswith('UPDATE'):
-        # raw_msg split preserves "8am-5pm" instead of "8AM-5PM"
-        parts = raw_msg.split('|')
-        if len(parts) < 3:
-            msg.body("⚠️ Use: UPDATE | FIELD | VALUE")
-            return str(resp)
-        _, field, val = [p.strip() for p in parts]
+    current_balance = shop[7]
+    
+    if current_balance < MIN_WITHDRAWAL:
+        return f"❌ Balance too low (KES {current_balance}).\nMinimum withdrawal is KES {MIN_WITHDRAWAL}."
+    
+    # INTEGRITY CHECK: Prevent double-withdrawals
+    if database.check_pending_withdrawal(sender_number):
+        return "⚠️ Withdrawal already in progress. Please wait."
+
+    if payouts.WITHDRAW_MODE == 'batched':
+        # Paid by the next payout run instead of a B2C call from here
+        if not payouts.request_payout(sender_number):
+            return "⏳ Your payout is already queued for the next payout run."
+        return (f"✅ *Payout Requested*\n"
+                f"Your balance (KES {int(current_balance)}) will be sent in the next payout run.\n"
+                f"You will receive an M-Pesa SMS then.")
         
-        # database.py handles the field name capitalization (field.upper()),
-        # so passing raw 'field' is safe. 'val' is passed raw to preserve case.
-        success, res = database.update_shop_field(sender_number, field.upper(), val)
-        msg.body(f"✅ {res}" if success else f"❌ {res}")
-        return str(resp)
-
-    # --- 8. STATUS ---
-    elif command_msg == 'STATUS':
-        existing_shop = database.get_shop(sender_number)
-        if existing_shop:
-            msg.body(f"🏢 *{existing_shop[1]} Dashboard*\n"
-                     f"💰 *Wallet: KES {existing_shop[7]}*\n" 
-                     f"📅 Expiry: {existing_shop[6]}\n"
-                     f"----------------\n"
-                     f"To cash out, text *WITHDRAW*")
-        else:
-            msg.body("❌ Not registered.")
-        return str(resp)
-
-    # --- 9. VIEW & FALLBACK ---
-    elif command_msg.startswith('VIEW'):
-        # Slice the raw message to keep the search query casing clean
-        # e.g. "VIEW Mama Mboga" -> query = "Mama Mboga"
-        query = raw_msg[5:].strip()
-        shop = database.search_shop_by_name(query)
-        if shop:
-            if is_expired(shop[6]):
-                msg.body(f"⚠️ {shop[1]} is currently unavailable.")
-            else:
-                msg.body(f"🏪 *{shop[1]}*\n📍 {shop[3]}\n🕒 {shop[5]}\n"
-                         f"📋 Catalog: {shop[2]}\n"
-                         f"💳 Pay: {shop[4]}\n\n"
-                         f"👉 To buy, text: *BUY | {shop[1]} | Amount*")
-        else:
-            msg.body("❌ Shop not found.")
-        return str(resp)
+    if not mpesa.is_available():
+        return MPESA_DOWN_REPLY
+
+    clean_phone = sender_number.replace('whatsapp:', '').replace('+', '')
+    # B2C pays whole shillings; the cents stay in the wallet
+    payout = int(current_balance)
+    # Sent with the request, so its result can be matched even if the answer is lost
+    originator_id = mpesa.new_originator_id()
     
-    else:
-        msg.body("👋 Welcome! Text *HELP* to see menu.")
+    # 1. Trigger B2C (Do NOT debit yet)
+    try:
+        b2c_res = yield ('b2c', clean_phone, payout, originator_id)
+    except mpesa.MpesaBusy:
+        return BUSY_REPLY
+    except mpesa.MpesaError as e:
+        if not getattr(e, 'sent', False):
+            app.logger.warning(f"Withdraw: Daraja unavailable: {e}")
+            return MPESA_DOWN_REPLY
+        # The payout may still happen: keep the withdrawal lock (never swept)
+        # until its B2C result or an admin settles it
+        app.logger.error(f"Withdraw: unconfirmed B2C {originator_id} of KES {payout} for {sender_number}: {e}")
+        database.log_pending_transaction(originator_id, sender_number, 'WITHDRAWAL_UNCONFIRMED', amount=payout)
+        return WITHDRAW_UNCONFIRMED_REPLY
+    
+    # 2. Log Pending
+    # The B2C result carries the ConversationID (and our OriginatorConversationID)
+    req_id = b2c_res.get('ConversationID') or originator_id
+    
+    database.log_pending_transaction(req_id, sender_number, 'WITHDRAWAL', amount=payout)
+    
+    return (f"⏳ *Processing Withdrawal...*\n"
+            f"Requesting KES {payout}.\n"
+            f"You will receive an M-Pesa SMS shortly.")
+
+@router.command('WITHDRAW')
+def withdraw_command(req):
+    return run_payment(withdraw_flow(req))
+
+# --- 6. SUBSCRIPTION PAYMENT ---
+def pay_flow(req, background=False):
+    shop = database.get_shop(req.sender)
+    if not shop:
+        return "❌ Not registered."
+    if not mpesa.is_available():
+        return MPESA_DOWN_REPLY
+
+    if background:
+        if queue_stk_push(req.sender, 'SUBSCRIPTION', 1, None,
+                          "📲 Enter M-Pesa PIN to renew.", "❌ Payment Failed."):
+            return "⏳ Payment being initiated... Watch for the M-Pesa PIN prompt."
+        return BUSY_REPLY
+    try:
+        if (yield from stk_push_flow(req.sender, 'SUBSCRIPTION', amount=1)):
+            return "📲 Enter M-Pesa PIN to renew."
+    except mpesa.MpesaBusy:
+        return BUSY_REPLY
+    except mpesa.MpesaUnavailable as e:
+        app.logger.warning(f"Pay: Daraja unavailable: {e}")
+        return MPESA_UNCONFIRMED_REPLY if e.sent else MPESA_DOWN_REPLY
+    return "❌ Payment Failed."
+
+@router.command('PAY')
+def pay_command(req):
+    return run_payment(pay_flow(req, background=STK_DISPATCH_MODE == 'async'))
+
+# --- 7. UPDATE DETAILS (Uses raw_msg) ---
+# The raw split preserves "8am-5pm" instead of "8AM-5PM"
+@router.command('UPDATE', prefix=True, args=3, usage="⚠️ Use: UPDATE | FIELD | VALUE")
+def update_command(req):
+    _, field, val = req.args
     
-    return str(resp)
+    # database.py handles the field name capitalization (field.upper()),
+    # so passing raw 'field' is safe. 'val' is passed raw to preserve case.
+    success, res = database.update_shop_field(req.sender, field.upper(), val)
+    return f"✅ {res}" if success else f"❌ {res}"
+
+# --- 8. STATUS ---
+@router.command('STATUS')
+def status_command(req):
+    existing_shop = database.get_shop(req.sender)
+    if not existing_shop:
+        return "❌ Not registered."
+    return (f"🏢 *{existing_shop[1]} Dashboard*\n"
+            f"💰 *Wallet: KES {existing_shop[7]}*\n" 
+            f"📅 Expiry: {database.format_day(existing_shop[6])}\n"
+            f"----------------\n"
+            f"To cash out, text *WITHDRAW*")
+
+# --- 9. VIEW ---
+@router.command('VIEW', prefix=True)
+def view_command(req):
+    # Slice the raw message to keep the search query casing clean
+    # e.g. "VIEW Mama Mboga" -> query = "Mama Mboga"
+    query = req.raw[5:].strip()
+    shop = database.search_shop_by_name(query)
+    if not shop:
+        return "❌ Shop not found."
+    if is_expired(shop[6]):
+        return f"⚠️ {shop[1]} is currently unavailable."
+    return (f"🏪 *{shop[1]}*\n📍 {shop[3]}\n🕒 {shop[5]}\n"
+            f"📋 Catalog: {shop[2]}\n"
+            f"💳 Pay: {shop[4]}\n\n"
+            f"👉 To buy, text: *BUY | {shop[1]} | Amount*")
+
+router.load_plugins(os.environ.get("BOT_PLUGINS", "").split(','))
+
+# --- RATE LIMITS ---
+# Each sender gets a token bucket per command class (see ratelimit.py);
+# commands not listed here (and unknown messages) count as 'read'.
+COMMAND_LIMITS = {'BUY': 'payment', 'PAY': 'payment', 'WITHDRAW': 'payment',
+                  'REGISTER': 'write', 'UPDATE': 'write'}
+RATE_LIMITED_REPLY = prerender("⏳ You're sending messages too fast. Please wait a minute and try again.")
+
+def handle_message(raw_msg, sender_number):
+    """Rate-limits the sender, then runs the command."""
+    command = router.resolve(raw_msg.upper())
+    limit = COMMAND_LIMITS.get(command.name, 'read') if command else 'read'
+    if not ratelimit.allow(limit, sender_number):
+        return RATE_LIMITED_REPLY
+    return router.dispatch(raw_msg, sender_number)
+
+def _bot_command_name():
+    command = router.resolve(request.values.get('Body', '').strip().upper())
+    return command.name if command else 'FALLBACK'
+
+@app.route('/bot', methods=['POST'])
+@profiling.profiled(_bot_command_name)
+def bot():
+    # --- DUAL INPUT HANDLING ---
+    # raw_msg: Preserves case (e.g., "Mama's Cafe", "http://mylink.com")
+    # The router upper-cases a copy for matching (e.g., "REGISTER", "HELP")
+    raw_msg = request.values.get('Body', '').strip()
+    sender_number = request.values.get('From', '') 
+    # A Twilio retry of the same message gets the first reply (see idempotency.py)
+    return idempotency.run_once(request.values.get('MessageSid'),
+                                lambda: handle_message(raw_msg, sender_number))
+
+# --- METRICS ---
+# Prometheus scrape target. Set METRICS_DIR so every gunicorn worker's
+# numbers are included, and METRICS_TOKEN to require a bearer token.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+metrics.describe('twilio_request_seconds', 'histogram', 'Latency of outbound Twilio API calls.')
+metrics.describe('twilio_messages_total', 'counter', 'Outbound WhatsApp messages by result.')
+metrics.describe('pending_transactions', 'gauge', 'Rows in pending_transactions per transaction type.')
+
+@metrics.register_gauge
+def pending_gauge():
+    return [('pending_transactions', {'type': tx_type}, count)
+            for tx_type, count in database.count_pending_by_type().items()]
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return "Unauthorized", 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# --- ADMIN REPORT ---
+# Sales, commission, withdrawals and renewals per day, read from the daily
+# rollups (one row per day, however many payments it had).
+#   GET /admin/report?from=YYYY-MM-DD&to=YYYY-MM-DD[&shop=whatsapp:+254...]
+# Disabled unless ADMIN_TOKEN is set; send it as a bearer token.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+REPORT_DEFAULT_DAYS = 30
+REPORT_MAX_DAYS = 366
+
+def is_admin():
+    return bool(ADMIN_TOKEN) and request.headers.get('Authorization') == f"Bearer {ADMIN_TOKEN}"
+
+@app.route('/admin/report', methods=['GET'])
+def admin_report():
+    if not is_admin():
+        return "Unauthorized", 401
+    try:
+        end = datetime.strptime(request.args.get('to') or datetime.now().strftime('%Y-%m-%d'), '%Y-%m-%d')
+        start = (datetime.strptime(request.args['from'], '%Y-%m-%d') if request.args.get('from')
+                 else end - timedelta(days=REPORT_DEFAULT_DAYS - 1))
+    except ValueError:
+        return "Dates must be YYYY-MM-DD", 400
+    if not 0 <= (end - start).days < REPORT_MAX_DAYS:
+        return f"'from' must be on or before 'to', at most {REPORT_MAX_DAYS} days apart", 400
+
+    start_day, end_day = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+    shop = request.args.get('shop')
+    days = database.get_daily_rollups(start_day, end_day, shop)
+    totals = dict.fromkeys(database.ROLLUP_COLUMNS, 0)
+    for _, values in days:
+        for name, value in values.items():
+            totals[name] += value
+    return {'from': start_day, 'to': end_day, 'shop': shop or 'platform',
+            'totals': totals, 'days': [dict(values, day=day) for day, values in days]}
+
+# --- UNCONFIRMED WITHDRAWALS ---
+# B2C sends we never got an answer for keep the wallet locked until their
+# result arrives. Check the B2C statement, then settle them here:
+#   GET  /admin/withdrawals                    unconfirmed sends, oldest first
+#   POST /admin/withdrawals/<id>  outcome=paid|failed
+# 'paid' debits the wallet as the B2C result would; both release the lock.
+# Bearer ADMIN_TOKEN, as for /admin/report.
+ADMIN_WITHDRAWALS_LIMIT = 500
+
+@app.route('/admin/withdrawals', methods=['GET'])
+def admin_withdrawals():
+    if not is_admin():
+        return "Unauthorized", 401
+    rows = database.get_stale_pending(datetime.now(), ('WITHDRAWAL_UNCONFIRMED',), ADMIN_WITHDRAWALS_LIMIT)
+    return {'withdrawals': [{'id': row[0], 'shop': row[1], 'amount': row[4], 'created_at': row[5]}
+                            for row in rows]}
+
+@app.route('/admin/withdrawals/<originator_id>', methods=['POST'])
+def admin_settle_withdrawal(originator_id):
+    if not is_admin():
+        return "Unauthorized", 401
+    values = request.get_json(silent=True) or request.values
+    outcome = values.get('outcome')
+    if outcome not in ('paid', 'failed'):
+        return "outcome must be 'paid' or 'failed'", 400
+    tx = database.get_pending_transaction(originator_id)
+    if not tx or tx[2] != 'WITHDRAWAL_UNCONFIRMED':
+        return "No such unconfirmed withdrawal", 404
+    # Through the callback path, so a B2C result arriving later is ignored
+    status = callbacks.apply_callback('ADMIN', originator_id, 0 if outcome == 'paid' else 1)
+    app.logger.warning(f"Admin settled withdrawal {originator_id} for {tx[1]} as {outcome}: {status}")
+    return {'id': originator_id, 'outcome': outcome, 'status': status}
+
+# --- PROFILING ---
+# Sampled cProfile profiles of /bot and /mpesa_callback (see profiling.py).
+#   GET  /admin/profiling                     settings in effect
+#   POST /admin/profiling  every=N [slow_ms=X] [minutes=60]   (every=0 turns it off)
+#   GET  /admin/profiles[?command=BUY]        recent profiles, newest first
+#   GET  /admin/profiles/<name>[?format=text] the .prof file, or its top functions as text
+# Bearer ADMIN_TOKEN, as for /admin/report.
+PROFILE_SORTS = ('cumulative', 'tottime', 'calls')
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
+    if not is_admin():
+        return "Unauthorized", 401
+    if request.method == 'POST':
+        values = request.get_json(silent=True) or request.values
+        try:
+            every = int(values.get('every', 0))
+            slow_ms = float(values.get('slow_ms', 0))
+            minutes = float(values.get('minutes', 60))
+        except (TypeError, ValueError):
+            return "every, slow_ms and minutes must be numbers", 400
+        if every < 0 or slow_ms < 0 or not 0 < minutes <= 24 * 60:
+            return "every and slow_ms can't be negative; minutes must be over 0 and at most 1440", 400
+        app.logger.info(f"Profiling set to 1 in {every} requests over {slow_ms}ms for {minutes} minutes")
+        return profiling.set_settings(every, slow_ms, minutes)
+    return profiling.get_settings()
+
+@app.route('/admin/profiles', methods=['GET'])
+def admin_profiles():
+    if not is_admin():
+        return "Unauthorized", 401
+    return {'profiles': profiling.list_profiles(request.args.get('command'))}
+
+@app.route('/admin/profiles/<name>', methods=['GET'])
+def admin_profile(name):
+    if not is_admin():
+        return "Unauthorized", 401
+    path = profiling.profile_path(name)
+    if not path:
+        return "No such profile", 404
+    if request.args.get('format') == 'text':
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in PROFILE_SORTS:
+            return f"sort must be one of {', '.join(PROFILE_SORTS)}", 400
+        return Response(profiling.summary(path, sort), mimetype='text/plain')
+    return send_file(os.path.abspath(path), mimetype='application/octet-stream',
+                     as_attachment=True, download_name=name)
 
 # --- CALLBACK LISTENER (The Ledger) ---
+def _callback_name():
+    event = callbacks.parse_callback(request.get_json(silent=True))
+    return f"CALLBACK_{event[0]}" if event else 'CALLBACK'
+
 @app.route('/mpesa_callback', methods=['POST'])
+@profiling.profiled(_callback_name)
 def mpesa_callback():
     data = request.json
     try:
-        # 1. HANDLE STK PUSH (Customer Buy / Sub Pay)
-        if 'stkCallback' in data.get('Body', {}):
-            stk = data['Body']['stkCallback']
-            if stk.get('ResultCode') == 0:
-                checkout_id = stk.get('CheckoutRequestID')
-                tx = database.get_pending_transaction(checkout_id)
-                
-                if tx:
-                    tx_type = tx[2]
-                    
-                    if tx_type == 'SUBSCRIPTION':
-                        database.renew_subscription(tx[1]) 
-                        app.logger.info(f"✅ Renewed Subscription for {tx[1]}")
-                        
-                    elif tx_type == 'PURCHASE':
-                        target_shop = tx[3]
-                        amount = tx[4]
-                        database.credit_wallet(target_shop, amount)
-                        app.logger.info(f"✅ Credited {amount} to Shop {target_shop}")
-                else:
-                    app.logger.warning(f"⚠️ Transaction {checkout_id} not found in pending list.")
-
-        # 2. HANDLE B2C (Owner Withdrawal)
-        # B2C results often come in a 'Result' object
-        elif 'Result' in data:
-            result = data['Result']
-            conv_id = result.get('ConversationID')
-            
-            # Find the transaction using ConversationID
-            tx = database.get_pending_transaction(conv_id)
-            
-            if tx and result.get('ResultCode') == 0:
-                # SUCCESS: NOW we debit the wallet
-                shop_phone = tx[1]
-                database.debit_wallet_all(shop_phone)
-                database.clear_pending_withdrawal(shop_phone)
-                app.logger.info(f"✅ Withdrawal Confirmed for {shop_phone}")
-                
-            elif tx:
-                # FAILURE: Just release lock
-                database.clear_pending_withdrawal(tx[1])
-                app.logger.info(f"❌ Withdrawal Failed for {tx[1]}")
+        # Each callback is applied once, in one transaction (see callbacks.py)
+        status = callbacks.process_callback(data)
+        if status:
+            app.logger.info(f"Callback processed: {status}")
 
     except Exception as e:
         app.logger.error(f"Callback Error: {e}")
@@ -0,0 +1,153 @@
+import os
+import asyncio
+import logging
+
+from aiohttp import web
+
+import callbacks
+import database
+import idempotency
+import metrics
+import mpesa
+import outbox
+import ratelimit
+
+# This process delivers the outbox with async tasks (see _start), so the
+# Flask app must not start its delivery threads when imported below
+outbox.workers.workers = 0
+import app # Router, replies and cron jobs are shared with the Flask app
+
+logger = logging.getLogger(__name__)
+
+# --- ASYNCIO SERVICE ---
+# An alternative entry point to `gunicorn app:app` serving /bot,
+# /mpesa_callback and /cron/send_reminders on one event loop. A BUY waiting on
+# Daraja holds a coroutine and a pooled connection instead of a worker
+# thread, so one process can have thousands of payments in flight.
+#   python async_app.py                                      (listens on PORT)
+#   gunicorn async_app:create_app -k aiohttp.GunicornWebWorker
+# BUY, PAY and WITHDRAW run app.py's payment flows with the async Daraja
+# client (run_payment below); every other command (only SQLite work) and all
+# database calls run on database.run_async's pool.
+# Payments always wait for Daraja before replying: that holds no thread
+# here, so STK_DISPATCH_MODE doesn't apply.
+PORT = int(os.environ.get("PORT", "8080"))
+TWILIO_POOL_SIZE = int(os.environ.get("TWILIO_POOL_SIZE", "100")) # Open connections to Twilio
+
+# --- TWILIO ---
+_twilio_client = None
+
+def get_twilio_client():
+    """Returns a Twilio client sending through one pooled aiohttp session (call from the event loop)."""
+    global _twilio_client
+    if _twilio_client is None:
+        import aiohttp
+        from twilio.rest import Client
+        from twilio.http.async_http_client import AsyncTwilioHttpClient
+        http_client = AsyncTwilioHttpClient(pool_connections=False, timeout=app.TWILIO_TIMEOUT)
+        http_client.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=TWILIO_POOL_SIZE))
+        _twilio_client = Client(app.TW_SID, app.TW_TOKEN, http_client=http_client)
+    return _twilio_client
+
+async def send_whatsapp(to, body):
+    """Async app.send_whatsapp(). Returns the message SID."""
+    status = 'error'
+    try:
+        with metrics.timer('twilio_request_seconds', operation='messages.create'):
+            message = await asyncio.wait_for(
+                get_twilio_client().messages.create_async(body=body, from_=app.TW_NUMBER, to=to),
+                app.TWILIO_TIMEOUT)
+        status = 'sent'
+        return message.sid
+    finally:
+        metrics.inc('twilio_messages_total', {'status': status})
+
+# --- PAYMENT COMMANDS ---
+# The flows are app.py's (see app.resume_payment); only the Daraja calls differ
+DARAJA_CALLS = {'stk_push': mpesa.trigger_stk_push_async, 'b2c': mpesa.pay_shop_owner_async}
+
+async def run_payment(flow, calls=DARAJA_CALLS):
+    """Async app.run_payment(): the flow's database work runs on database.run_async's pool."""
+    call, reply = await database.run_async(app.resume_payment, flow)
+    while call:
+        name, *args = call
+        try:
+            response, error = await calls[name](*args), None
+        except Exception as e:
+            response, error = None, e
+        call, reply = await database.run_async(app.resume_payment, flow, response, error)
+    return reply
+
+async def buy_command(req):
+    return await run_payment(app.buy_flow(req))
+
+async def pay_command(req):
+    return await run_payment(app.pay_flow(req))
+
+async def withdraw_command(req):
+    return await run_payment(app.withdraw_flow(req))
+
+ASYNC_COMMANDS = {'BUY': buy_command, 'PAY': pay_command, 'WITHDRAW': withdraw_command}
+
+async def handle_message(raw_msg, sender_number):
+    """Async app.handle_message()."""
+    command = app.router.resolve(raw_msg.upper())
+    limit = app.COMMAND_LIMITS.get(command.name, 'read') if command else 'read'
+    if not await database.run_async(ratelimit.allow, limit, sender_number):
+        return app.RATE_LIMITED_REPLY
+    return await app.router.dispatch_async(raw_msg, sender_number, ASYNC_COMMANDS, database.run_async)
+
+# --- ROUTES ---
+routes = web.RouteTableDef()
+
+@routes.post('/bot')
+async def bot(request):
+    # Query string first, like Flask's request.values
+    values = {**await request.post(), **request.query}
+    raw_msg = values.get('Body', '').strip()
+    sender_number = values.get('From', '')
+    reply = await idempotency.run_once_async(values.get('MessageSid'),
+                                             lambda: handle_message(raw_msg, sender_number))
+    return web.Response(body=reply if isinstance(reply, bytes) else reply.encode('utf-8'),
+                        content_type='text/xml', charset='utf-8')
+
+@routes.post('/mpesa_callback')
+async def mpesa_callback(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    try:
+        status = await database.run_async(callbacks.process_callback, data)
+        if status:
+            logger.info(f"Callback processed: {status}")
+    except Exception as e:
+        logger.error(f"Callback Error: {e}")
+    return web.Response(text="OK")
+
+@routes.get('/cron/send_reminders')
+async def send_reminders(request):
+    # Only queues the reminders; the outbox tasks send them
+    return web.Response(text=await database.run_async(app.send_reminders))
+
+# --- LIFECYCLE ---
+async def _start(web_app):
+    get_twilio_client()
+    outbox.async_workers.start(send_whatsapp)
+
+async def _stop(web_app):
+    await outbox.async_workers.stop()
+    await mpesa.close_async_session()
+    if _twilio_client is not None:
+        await _twilio_client.http_client.close()
+
+async def create_app():
+    """Builds the aiohttp application (also the gunicorn entry point)."""
+    web_app = web.Application()
+    web_app.add_routes(routes)
+    web_app.on_startup.append(_start)
+    web_app.on_cleanup.append(_stop)
+    return web_app
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=PORT)
@@ -0,0 +1,350 @@
+"""
+Offline load test for /bot and /mpesa_callback.
+
+Seeds a throwaway database, starts a stub Daraja server and the Flask app on
+localhost, then replays a mix of Twilio webhooks (plus the matching STK/B2C
+callbacks) at a target rate. Prints per-command throughput and p50/p95/p99
+latency, and writes the same report as JSON for diffing between versions.
+
+    python benchmark.py --shops 5000 --rate 50 --duration 30 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import re
+import queue
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+DEFAULT_MIX = "BUY=35,VIEW=30,STATUS=15,REGISTER=5,WITHDRAW=5,HELP=10"
+# mpesa_callbacks_total{kind="B2C",result_code="0",status="APPLIED"} 12
+CALLBACK_METRIC = re.compile(r'^mpesa_callbacks_total\{(.*)\} (\S+)$')
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+WORDS = ["Mama", "Mboga", "Duka", "Kiosk", "Salon", "Hardware", "Fresh", "Juice", "Chips", "Books"]
+
+# --- STUB DARAJA ---
+class StubDaraja(BaseHTTPRequestHandler):
+    """Answers OAuth, STK push, STK query and B2C like the sandbox, with injected latency/failures."""
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    failure_rate = 0.0
+    callback_delay = 0.0
+    issued = None # queue.Queue of (due, 'STK'|'B2C', id) to send callbacks for
+    counter = 0
+    lock = threading.Lock()
+    stats = {'requests': 0, 'failures': 0}
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _issue(self, kind, callback_id):
+        # Called once the answer is written: the app logs its pending row after
+        # reading it, so the callback comes a little later, as Daraja's does
+        self.issued.put((time.monotonic() + self.callback_delay, kind, callback_id))
+
+    def _next_id(self, prefix):
+        with StubDaraja.lock:
+            StubDaraja.counter += 1
+            StubDaraja.stats['requests'] += 1
+            return f"{prefix}_{StubDaraja.counter}"
+
+    def _fail(self):
+        if random.random() < self.failure_rate:
+            with StubDaraja.lock:
+                StubDaraja.stats['failures'] += 1
+            return True
+        return False
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self._reply(200, {'access_token': 'bench-token', 'expires_in': '3599'})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        if self.path.startswith('/mpesa/stkpush/'):
+            checkout_id = self._next_id("ws_CO")
+            if self._fail():
+                return self._reply(500, {'errorCode': '500.001.1001', 'errorMessage': 'Stub failure'})
+            self._reply(200, {'ResponseCode': '0', 'CheckoutRequestID': checkout_id,
+                              'MerchantRequestID': checkout_id})
+            return self._issue('STK', checkout_id)
+        if self.path.startswith('/mpesa/b2c/'):
+            conv_id = self._next_id("AG")
+            if self._fail():
+                return self._reply(500, {'errorCode': '500.002.1001', 'errorMessage': 'Stub failure'})
+            self._reply(200, {'ResponseCode': '0', 'ConversationID': conv_id})
+            return self._issue('B2C', conv_id)
+        if self.path.startswith('/mpesa/stkpushquery/'):
+            return self._reply(200, {'ResponseCode': '0', 'ResultCode': '0'})
+        self._reply(404, {})
+
+def start_stub(latency_ms, failure_rate, callback_delay_ms=0):
+    StubDaraja.latency = latency_ms / 1000
+    StubDaraja.failure_rate = failure_rate
+    StubDaraja.callback_delay = callback_delay_ms / 1000
+    StubDaraja.issued = queue.Queue()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubDaraja)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# --- DATABASE SEEDING ---
+def seed(database, count, rng):
+    """Bulk-inserts count shops. Returns their (phone, name) pairs."""
+    shops = []
+    rows = []
+    for i in range(count):
+        phone = f"whatsapp:+2547{i:08d}"
+        name = f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}"
+        expiry = database.day_start(time.strftime('%Y-%m-%d',
+                                                  time.localtime(time.time() + rng.randint(-5, 60) * 86400)))
+        shops.append((phone, name))
+        rows.append((phone, name, "https://example.com/catalog", "https://maps.example.com",
+                     "Till 123456", "8am-6pm", expiry, rng.randint(0, 500000)))
+    by_shard = {}
+    for row in rows:
+        by_shard.setdefault(database.shard_for(row[0]), []).append(row)
+    for db_name, shard_rows in by_shard.items():
+        with database.transaction(db_name) as c:
+            c.executemany("""INSERT OR REPLACE INTO shops (phone_number, shop_name, catalog_link, location_map,
+                                                          payment_info, operating_hours, expires_at, wallet_cents)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", shard_rows)
+    return shops
+
+# --- LOAD GENERATION ---
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix[name.strip().upper()] = float(weight)
+    return mix
+
+def make_message(command, shops, rng, serial):
+    """Returns (From, Body) for one simulated WhatsApp message."""
+    customer = f"whatsapp:+2541{rng.randint(0, 99999999):08d}"
+    phone, name = rng.choice(shops)
+    if command == 'BUY':
+        return customer, f"BUY | {name} | {rng.randint(10, 2000)}"
+    if command == 'VIEW':
+        return customer, f"VIEW {name if rng.random() < 0.7 else name.split()[0]}"
+    if command == 'REGISTER':
+        return f"whatsapp:+2549{serial:08d}", (f"REGISTER | Bench Shop {serial} | https://x.co | map | "
+                                               f"Till {serial} | 9am-5pm")
+    if command == 'HELP':
+        return (phone if rng.random() < 0.5 else customer), "HELP"
+    return phone, command # STATUS, WITHDRAW, PAY
+
+def callback_outcomes(metrics):
+    """{kind: {status: count}} from mpesa_callbacks_total (UNKNOWN: no pending row yet)."""
+    outcomes = {}
+    for line in metrics.render().splitlines():
+        match = CALLBACK_METRIC.match(line)
+        if match:
+            labels = dict(LABEL.findall(match.group(1)))
+            by_status = outcomes.setdefault(labels['kind'], {})
+            by_status[labels['status']] = by_status.get(labels['status'], 0) + int(float(match.group(2)))
+    return outcomes
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed):
+        commands = {}
+        for name, values in sorted(self.samples.items()):
+            values = sorted(values)
+            commands[name] = {
+                'count': len(values),
+                'errors': self.errors.get(name, 0),
+                'throughput_rps': round(len(values) / elapsed, 2),
+                'mean_ms': round(sum(values) / len(values) * 1000, 2),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p95_ms': round(percentile(values, 95) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+                'max_ms': round(values[-1] * 1000, 2),
+            }
+        total = sum(c['count'] for c in commands.values())
+        return {'elapsed_seconds': round(elapsed, 2), 'total_requests': total,
+                'throughput_rps': round(total / elapsed, 2) if elapsed else 0.0, 'commands': commands}
+
+def run(args):
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    db_dir = tempfile.mkdtemp(prefix="ssup_bench_")
+    db_path = args.db or os.path.join(db_dir, "saas_bot.db")
+
+    stub = start_stub(args.daraja_latency_ms, args.daraja_failure_rate, args.callback_delay_ms)
+    os.environ["MPESA_BASE_URL"] = f"http://127.0.0.1:{stub.server_port}"
+    os.environ.setdefault("STK_DISPATCH_MODE", "sync")
+    # Measure our own latency, not the global Daraja cap (set it to test shedding)
+    os.environ.setdefault("MPESA_CALLS_PER_SECOND", "100000")
+    if args.shards:
+        os.environ["DB_SHARDS"] = str(args.shards)
+    # Count this run's callbacks only, not other processes' snapshots
+    os.environ["METRICS_DIR"] = ""
+
+    # The app reads its DB path and Daraja URL at import time
+    import database
+    database.DB_NAME = db_path
+    import mpesa
+    mpesa.MPESA_BASE_URL = os.environ["MPESA_BASE_URL"]
+    import app as bot_app
+    import metrics
+    for logger_name in ("", "werkzeug", "app", "callbacks"):
+        logging.getLogger(logger_name).setLevel(logging.WARNING)
+
+    started = time.perf_counter()
+    shops = seed(database, args.shops, rng)
+    print(f"Seeded {len(shops)} shops in {time.perf_counter() - started:.2f}s ({db_path})", file=sys.stderr)
+
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, bot_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    recorder = Recorder()
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+
+    def send(name, path, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            ok = session.post(base + path, timeout=30, **kwargs).status_code == 200
+        except requests.RequestException:
+            ok = False
+        recorder.add(name, time.perf_counter() - t0, ok)
+
+    def send_callback(kind, callback_id):
+        code = 0 if rng.random() >= args.callback_failure_rate else 1032
+        if kind == 'STK':
+            body = {'Body': {'stkCallback': {'CheckoutRequestID': callback_id, 'ResultCode': code}}}
+        else:
+            body = {'Result': {'ConversationID': callback_id, 'ResultCode': code}}
+        send(f"CALLBACK_{kind}", '/mpesa_callback', json=body)
+
+    held = deque() # (due, kind, id) not due yet, in issue order
+
+    def drain_callbacks(pool):
+        """Delivers the due callbacks for payments Daraja accepted so far."""
+        while True:
+            try:
+                held.append(StubDaraja.issued.get_nowait())
+            except queue.Empty:
+                break
+        now = time.monotonic()
+        while held and held[0][0] <= now:
+            _, kind, callback_id = held.popleft()
+            pool.submit(send_callback, kind, callback_id)
+
+    interval = 1.0 / args.rate
+    deadline = time.perf_counter() + args.duration
+    next_at = time.perf_counter()
+    serial = 0
+    in_flight = set() # /bot requests not answered yet
+    print(f"Replaying {args.rate}/s for {args.duration}s against {base}", file=sys.stderr)
+    load_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        while next_at < deadline:
+            # Open loop: keep the schedule even if responses are slow
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            serial += 1
+            command = rng.choices(names, weights)[0]
+            sender, body = make_message(command, shops, rng, serial)
+            in_flight.add(pool.submit(send, command, '/bot', data={'From': sender, 'Body': body,
+                                                                  'MessageSid': f"SMbench{serial}"}))
+            in_flight = {f for f in in_flight if not f.done()}
+            drain_callbacks(pool)
+            next_at += interval
+        # Payments accepted near the end still get their callback
+        wait(in_flight)
+        drain_callbacks(pool)
+        while held:
+            time.sleep(max(0.0, held[0][0] - time.monotonic()))
+            drain_callbacks(pool)
+    elapsed = time.perf_counter() - load_started
+
+    server.shutdown()
+    stub.shutdown()
+    report = recorder.report(elapsed)
+    report['config'] = {k: v for k, v in vars(args).items()}
+    report['daraja_stub'] = dict(StubDaraja.stats)
+    report['callbacks'] = callback_outcomes(metrics)
+    return report
+
+def print_table(report):
+    print(f"{'command':<14}{'count':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}",
+          file=sys.stderr)
+    for name, c in report['commands'].items():
+        print(f"{name:<14}{c['count']:>8}{c['errors']:>6}{c['throughput_rps']:>9}"
+              f"{c['p50_ms']:>9}{c['p95_ms']:>9}{c['p99_ms']:>9}{c['max_ms']:>9}", file=sys.stderr)
+    print(f"total {report['total_requests']} requests, {report['throughput_rps']} req/s "
+          f"(latency in ms)", file=sys.stderr)
+    for kind, by_status in sorted(report['callbacks'].items()):
+        print(f"{kind} callbacks: {by_status}", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shops", type=int, default=1000, help="shops to seed")
+    parser.add_argument("--rate", type=float, default=20, help="webhooks per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=32, help="max in-flight requests")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="command weights, e.g. BUY=50,VIEW=50")
+    parser.add_argument("--daraja-latency-ms", type=float, default=150)
+    parser.add_argument("--daraja-failure-rate", type=float, default=0.02)
+    parser.add_argument("--callback-failure-rate", type=float, default=0.1,
+                        help="share of callbacks reporting a cancelled/failed payment")
+    parser.add_argument("--callback-delay-ms", type=float, default=50,
+                        help="delay between Daraja's answer and its callback")
+    parser.add_argument("--db", help="database file (default: a new temp file)")
+    parser.add_argument("--shards", type=int, help="DB_SHARDS to run with (default: environment)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print_table(report)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
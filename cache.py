@@ -0,0 +1,65 @@
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    A small thread-safe LRU cache whose entries also expire after ttl seconds.
+    Loads that raced with an invalidation are not stored, so a reader can't
+    put back a value that was read just before a write committed.
+    cache_none=False: a loader returning None isn't stored (e.g. a lookup
+    miss, which a write elsewhere may turn into a hit at any moment).
+    """
+
+    def __init__(self, max_size=1024, ttl=30.0, cache_none=True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_none = cache_none
+        self._data = OrderedDict() # key -> (expires_at, value), oldest first
+        self._lock = threading.Lock()
+        self._epoch = 0 # Bumped by every invalidation
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get_or_load(self, key, loader):
+        """Returns the cached value for key, calling loader() on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._data.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[1]
+                del self._data[key]
+                self.stats['expirations'] += 1
+            self.stats['misses'] += 1
+            epoch = self._epoch
+
+        value = loader()
+
+        with self._lock:
+            if epoch == self._epoch and (value is not None or self.cache_none):
+                self._data[key] = (now + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+                    self.stats['evictions'] += 1
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._epoch += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    def get_stats(self):
+        """Counters plus current size and hit rate."""
+        with self._lock:
+            stats = dict(self.stats, size=len(self._data))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,198 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+import database
+import metrics
+import payouts
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('mpesa_callbacks_total', 'counter', 'Daraja callbacks by kind, result code and outcome.')
+
+# --- GROUP COMMIT ---
+# Off by default: each callback commits on its own. When enabled, one thread
+# applies up to CALLBACK_BATCH_MAX callbacks (arriving within
+# CALLBACK_BATCH_WAIT_MS) in a single transaction, i.e. one commit per batch.
+CALLBACK_GROUP_COMMIT = os.environ.get("CALLBACK_GROUP_COMMIT", "0") == "1"
+CALLBACK_BATCH_MAX = int(os.environ.get("CALLBACK_BATCH_MAX", "50"))
+CALLBACK_BATCH_WAIT_MS = int(os.environ.get("CALLBACK_BATCH_WAIT_MS", "5"))
+CALLBACK_WAIT_TIMEOUT = 10 # Seconds a request waits for its batch to commit
+
+def parse_callback(data):
+    """
+    Normalizes a Daraja callback body.
+    Returns (kind, callback_id, result_code, originator_id) or None if it
+    isn't one we handle. originator_id is the B2C OriginatorConversationID.
+    """
+    data = data or {}
+    # 1. STK PUSH (Customer Buy / Sub Pay)
+    if 'stkCallback' in data.get('Body', {}):
+        stk = data['Body']['stkCallback']
+        return 'STK', stk.get('CheckoutRequestID'), int(stk.get('ResultCode', -1)), None
+    # 2. B2C (Owner Withdrawal) - results come in a 'Result' object
+    if 'Result' in data:
+        result = data['Result']
+        return ('B2C', result.get('ConversationID'), int(result.get('ResultCode', -1)),
+                result.get('OriginatorConversationID'))
+    return None
+
+def _pending_id(callback_id, originator_id):
+    """
+    The pending row a callback settles: its own id, or the OriginatorConversationID
+    for a B2C whose answer never reached us (logged as WITHDRAWAL_UNCONFIRMED).
+    """
+    if (originator_id and originator_id != callback_id
+            and not database.get_pending_transaction(callback_id)
+            and database.get_pending_transaction(originator_id)):
+        return originator_id
+    return callback_id
+
+def apply_callback(kind, callback_id, result_code, originator_id=None):
+    """
+    Applies one callback in exactly one transaction: the wallet/subscription
+    change, the dedup record and removal of the pending row commit together.
+    Returns 'APPLIED', 'FAILED' (payment failed, pending released),
+    'DUPLICATE' or 'UNKNOWN' (no pending row).
+    """
+    pending_id = _pending_id(callback_id, originator_id)
+    # The pending row, its shop and the dedup record share one shard
+    db_name = database.locate_callback(pending_id)
+    with database.transaction(db_name):
+        if database.was_callback_processed(callback_id, db_name):
+            logger.info(f"Ignoring redelivered callback {callback_id}")
+            return 'DUPLICATE'
+        tx = database.get_pending_transaction(pending_id, db_name)
+        if not tx:
+            # Not recorded as processed: the pending row may still be on its way
+            logger.warning(f"⚠️ Transaction {callback_id} not found in pending list.")
+            return 'UNKNOWN'
+        database.mark_callback_processed(callback_id, kind, result_code, db_name)
+
+        tx_type = tx[2]
+        if result_code != 0:
+            status = 'FAILED'
+            # FAILURE: Just release lock
+            logger.info(f"❌ {tx_type} {callback_id} failed ({result_code}) for {tx[1]}")
+
+        elif tx_type == 'SUBSCRIPTION':
+            status = 'APPLIED'
+            database.renew_subscription(tx[1], amount=tx[4] or 0)
+            logger.info(f"✅ Renewed Subscription for {tx[1]}")
+
+        elif tx_type == 'PURCHASE':
+            status = 'APPLIED'
+            target_shop, amount = tx[3], tx[4]
+            database.credit_wallet(target_shop, amount, reference=callback_id)
+            logger.info(f"✅ Credited {amount} to Shop {target_shop}")
+
+        elif tx_type in database.WITHDRAWAL_TYPES:
+            status = 'APPLIED'
+            # SUCCESS: NOW we debit the wallet (by the amount actually paid out,
+            # so sales credited while the B2C was in flight stay in the wallet)
+            database.debit_wallet(tx[1], tx[4], reference=callback_id)
+            logger.info(f"✅ Withdrawal Confirmed for {tx[1]}")
+
+        else:
+            status = 'FAILED'
+            logger.warning(f"⚠️ Unknown transaction type {tx_type} for {callback_id}")
+
+        if tx_type in database.WITHDRAWAL_TYPES:
+            # Settles the payout item if the withdrawal came from a batched run
+            payouts.record_result(pending_id, status == 'APPLIED', db_name)
+        database.delete_pending_transaction(pending_id, db_name)
+        return status
+
+class GroupCommitter:
+    """Single writer thread that commits queued callbacks in batches."""
+
+    def __init__(self, batch_max=CALLBACK_BATCH_MAX, batch_wait_ms=CALLBACK_BATCH_WAIT_MS):
+        self.batch_max = batch_max
+        self.batch_wait = batch_wait_ms / 1000
+        self.stats = {'batches': 0, 'callbacks': 0}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, name="callback-commit", daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, kind, callback_id, result_code, originator_id=None):
+        """Queues a callback and waits until the batch holding it has committed."""
+        self._ensure_started()
+        item = {'event': (kind, callback_id, result_code, originator_id), 'done': threading.Event(),
+                'status': None, 'error': None}
+        self._queue.put(item)
+        if not item['done'].wait(CALLBACK_WAIT_TIMEOUT):
+            raise TimeoutError(f"Callback {callback_id} not committed in time")
+        if item['error']:
+            raise item['error']
+        return item['status']
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_max:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            # One commit per shard touched by the batch
+            by_shard = {}
+            for item in batch:
+                try:
+                    _, callback_id, _, originator_id = item['event']
+                    db_name = database.locate_callback(_pending_id(callback_id, originator_id))
+                except Exception as e:
+                    item['error'] = e
+                    continue
+                by_shard.setdefault(db_name, []).append(item)
+            for db_name, items in by_shard.items():
+                try:
+                    with database.transaction(db_name):
+                        for item in items:
+                            # A bad callback is rolled back alone, not with its batch
+                            try:
+                                with database.savepoint("callback", db_name):
+                                    item['status'] = apply_callback(*item['event'])
+                            except Exception as e:
+                                item['error'] = e
+                except Exception as e:
+                    for item in items:
+                        item['status'], item['error'] = None, e
+            with self._lock:
+                self.stats['batches'] += 1
+                self.stats['callbacks'] += len(batch)
+            for item in batch:
+                item['done'].set()
+
+group_committer = GroupCommitter()
+
+def process_callback(data):
+    """Entry point for /mpesa_callback. Returns the status of the event (None if ignored)."""
+    event = parse_callback(data)
+    if not event or not event[1]:
+        return None
+    if CALLBACK_GROUP_COMMIT:
+        status = group_committer.submit(*event)
+    else:
+        status = apply_callback(*event)
+    kind, _, result_code, _ = event
+    metrics.inc('mpesa_callbacks_total', {'kind': kind, 'result_code': result_code, 'status': status})
+    return status
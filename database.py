@@ -1,15 +1,217 @@
+import os
+import time
+import zlib
+import heapq
+import asyncio
 import sqlite3
+import functools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+import cache
+import metrics
 
 DB_NAME = "saas_bot.db"
 
-def init_db():
-    """Initializes the database with shops and transaction tables."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
+# Latency of each query function below, per function name
+_timed = metrics.timed('db_call_seconds')
+metrics.describe('db_call_seconds', 'histogram', 'Time spent in each database function.')
+
+# --- CONNECTION MANAGER ---
+# Each thread keeps one open connection instead of reconnecting on every call.
+# WAL lets /bot readers keep going while a callback is writing.
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "8192"))
+
+_local = threading.local()
+
+def _connect(db_name):
+    # isolation_level=None: reads autocommit, writes use transaction() below
+    conn = sqlite3.connect(db_name, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous=NORMAL") # Safe with WAL; fsync on checkpoint only
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    # INSERT OR REPLACE must fire delete triggers so the search index stays in sync
+    conn.execute("PRAGMA recursive_triggers=ON")
+    return conn
+
+def _thread_state():
+    # A forked worker must not reuse the parent's connections
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.conns = {}
+        _local.depth = {}
+        _local.after_transaction = {}
+    return _local
+
+def get_connection(db_name=None):
+    """Returns this thread's connection to the database, opening it on first use."""
+    state = _thread_state()
+    db_name = db_name or DB_NAME
+    conn = state.conns.get(db_name)
+    if conn is None:
+        conn = state.conns[db_name] = _connect(db_name)
+    return conn
+
+def close_connections():
+    """Closes this thread's connections (e.g. before a worker exits)."""
+    state = _thread_state()
+    for conn in state.conns.values():
+        conn.close()
+    state.conns.clear()
+    state.depth.clear()
+    state.after_transaction.clear()
+
+@contextmanager
+def transaction(db_name=None, immediate=True):
+    """
+    Runs a block of statements as one transaction and yields a cursor.
+    Nested calls join the outer transaction; only the outermost one commits.
+    immediate=True takes the write lock up front so read-then-write is safe.
+    """
+    state = _thread_state()
+    db_name = db_name or DB_NAME
+    conn = get_connection(db_name)
+    depth = state.depth.get(db_name, 0)
+    if depth == 0:
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    state.depth[db_name] = depth + 1
+    try:
+        yield conn.cursor()
+    except BaseException:
+        if depth == 0:
+            conn.rollback()
+        raise
+    else:
+        if depth == 0:
+            conn.commit()
+    finally:
+        state.depth[db_name] = depth
+        if depth == 0:
+            for fn in state.after_transaction.pop(db_name, []):
+                fn()
+
+def after_transaction(fn, db_name=None):
+    """
+    Runs fn once the current transaction has committed or rolled back
+    (right away if there is none). Used to invalidate caches.
+    """
+    state = _thread_state()
+    db_name = db_name or DB_NAME
+    if state.depth.get(db_name, 0):
+        state.after_transaction.setdefault(db_name, []).append(fn)
+    else:
+        fn()
+
+@contextmanager
+def savepoint(name="sp", db_name=None):
+    """
+    Inside a transaction(): if the block raises, undo only the block's
+    changes and re-raise, leaving the rest of the transaction intact.
+    """
+    conn = get_connection(db_name)
+    conn.execute(f"SAVEPOINT {name}")
+    try:
+        yield
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {name}")
+        conn.execute(f"RELEASE {name}")
+        raise
+    else:
+        conn.execute(f"RELEASE {name}")
+
+# --- ASYNC ACCESS ---
+# The asyncio service (async_app.py) must never block its event loop on
+# SQLite, so it runs database calls on this small pool instead. Each thread
+# keeps its own connections, and SQLite has one writer, so a few are enough.
+DB_EXECUTOR_THREADS = int(os.environ.get("DB_EXECUTOR_THREADS", "8"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+async def run_async(fn, *args, **kwargs):
+    """Awaits fn(*args, **kwargs) run on the database thread pool."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(DB_EXECUTOR_THREADS, thread_name_prefix="db")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+# --- SHARDING ---
+# DB_SHARDS=1 (default) keeps everything in DB_NAME. With N > 1, each shop's
+# row, ledger, pending transactions and callback records live in one of N files
+# (saas_bot_0.db ...) chosen by a hash of its phone number, so callbacks for
+# different shops commit in parallel. Name search and expiry scans fan out over
+# every shard and merge. Job watermarks stay in DB_NAME.
+# Use rebalance.py to split an existing database before raising DB_SHARDS.
+DB_SHARDS = int(os.environ.get("DB_SHARDS", "1"))
+
+_shard_names = {}
+
+def shard_names(count=None):
+    """The database files holding shop data (just DB_NAME when unsharded)."""
+    count = count or DB_SHARDS
+    key = (DB_NAME, count)
+    names = _shard_names.get(key)
+    if names is None:
+        if count <= 1:
+            names = [DB_NAME]
+        else:
+            root, ext = os.path.splitext(DB_NAME)
+            names = [f"{root}_{i}{ext}" for i in range(count)]
+        _shard_names[key] = names
+    return names
+
+def shard_for(phone_number, count=None):
+    """The database file a shop's rows live in."""
+    names = shard_names(count)
+    if len(names) == 1:
+        return names[0]
+    return names[zlib.crc32((phone_number or '').encode('utf-8')) % len(names)]
+
+def pending_owner(user_phone, target_shop):
+    """
+    The shop whose shard holds a pending row: the shop being paid for a
+    PURCHASE, the owner otherwise, so settling it is one transaction.
+    """
+    return target_shop or user_phone
+
+def locate_callback(callback_id):
+    """
+    The shard holding a callback's pending row or processed record.
+    Returns DB_NAME when unsharded, None if no shard knows the id.
+    """
+    names = shard_names()
+    if len(names) == 1:
+        return names[0]
+    for db_name in names:
+        c = get_connection(db_name).execute(
+            """SELECT 1 FROM pending_transactions WHERE checkout_request_id=?
+               UNION ALL SELECT 1 FROM processed_callbacks WHERE callback_id=? LIMIT 1""",
+            (callback_id, callback_id))
+        if c.fetchone():
+            return db_name
+    return None
+
+def database_files():
+    """Every database file in use: DB_NAME plus the shards."""
+    return list(dict.fromkeys([DB_NAME] + shard_names()))
+
+def create_schema(c):
+    """
+    The baseline (version 1) schema: shops and transaction tables.
+    Applied by migrations.py; later schema changes go there, not here.
+    """
     # 1. SHOPS TABLE (Updated with Wallet & Commission)
-    # wallet_balance: The money the shop owner has earned but not withdrawn
+    # wallet_cents: The money the shop owner has earned but not withdrawn,
+    #               kept in sync with the wallet_entries ledger
+    # wallet_balance: Legacy float balance, superseded by wallet_cents
     # commission_rate: Your cut (e.g., 0.05 for 5%)
     c.execute('''CREATE TABLE IF NOT EXISTS shops
                  (phone_number TEXT PRIMARY KEY,
@@ -20,7 +222,8 @@ def init_db():
                   operating_hours TEXT,
                   expiry_date TEXT,
                   wallet_balance REAL DEFAULT 0.0,
-                  commission_rate REAL DEFAULT 0.05)''')
+                  commission_rate REAL DEFAULT 0.05,
+                  wallet_cents INTEGER NOT NULL DEFAULT 0)''')
 
     # 2. PENDING TRANSACTIONS TABLE (State Management)
     # Links a CheckoutRequestID to a specific Shop Owner so we know who to credit
@@ -31,178 +234,600 @@ def init_db():
                   target_shop_phone TEXT,
                   amount REAL,
                   timestamp TEXT)''')
-                  
-    conn.commit()
-    conn.close()
 
+    # WITHDRAW checks user+type; the sweeper scans by age
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pending_user_type ON pending_transactions(user_phone, transaction_type)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pending_timestamp ON pending_transactions(timestamp)")
+
+    # 3. SHOP NAME SEARCH
+    # NOCASE index serves exact + prefix lookups; the FTS5 trigram index
+    # serves substring matches. Triggers keep it in sync with shops.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_shops_name ON shops(shop_name COLLATE NOCASE)")
+    c.execute("SELECT 1 FROM sqlite_master WHERE name='shops_fts'")
+    fts_exists = c.fetchone() is not None
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS shops_fts USING fts5
+                 (shop_name, content='shops', content_rowid='rowid', tokenize='trigram')''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS shops_fts_insert AFTER INSERT ON shops BEGIN
+                   INSERT INTO shops_fts(rowid, shop_name) VALUES (new.rowid, new.shop_name);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS shops_fts_delete AFTER DELETE ON shops BEGIN
+                   INSERT INTO shops_fts(shops_fts, rowid, shop_name) VALUES ('delete', old.rowid, old.shop_name);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS shops_fts_update AFTER UPDATE OF shop_name ON shops BEGIN
+                   INSERT INTO shops_fts(shops_fts, rowid, shop_name) VALUES ('delete', old.rowid, old.shop_name);
+                   INSERT INTO shops_fts(rowid, shop_name) VALUES (new.rowid, new.shop_name);
+                 END''')
+    if not fts_exists:
+        # Index shops registered before the search index existed
+        c.execute("INSERT INTO shops_fts(shops_fts) VALUES ('rebuild')")
+
+    # 4. EXPIRY SCANS
+    # (expiry_date, phone_number) is also the keyset used to page through them
+    c.execute("CREATE INDEX IF NOT EXISTS idx_shops_expiry ON shops(expiry_date, phone_number)")
+
+    # 5. JOB WATERMARKS: how far a batch job got, so it can resume
+    c.execute('''CREATE TABLE IF NOT EXISTS job_watermarks
+                 (job_name TEXT PRIMARY KEY,
+                  last_date TEXT,
+                  last_phone TEXT,
+                  updated_at TEXT)''')
+
+    # 6. WALLET LEDGER (append-only, integer cents)
+    # amount_cents is the signed change to the wallet; a SALE also records
+    # the customer's gross payment and our commission on it.
+    c.execute('''CREATE TABLE IF NOT EXISTS wallet_entries
+                 (entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  shop_phone TEXT NOT NULL,
+                  entry_type TEXT NOT NULL,
+                  gross_cents INTEGER NOT NULL DEFAULT 0,
+                  commission_cents INTEGER NOT NULL DEFAULT 0,
+                  amount_cents INTEGER NOT NULL,
+                  reference TEXT,
+                  created_at TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_wallet_entries_shop ON wallet_entries(shop_phone, entry_id)")
+    for action in ('UPDATE', 'DELETE'):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS wallet_entries_no_{action.lower()}
+                      BEFORE {action} ON wallet_entries BEGIN
+                        SELECT RAISE(ABORT, 'wallet_entries is append-only');
+                      END''')
+
+    # 7. PROCESSED CALLBACKS: Safaricom redelivers callbacks, so remember
+    # which CheckoutRequestID/ConversationID values were already applied
+    c.execute('''CREATE TABLE IF NOT EXISTS processed_callbacks
+                 (callback_id TEXT PRIMARY KEY,
+                  kind TEXT,
+                  result_code INTEGER,
+                  processed_at TEXT)''')
+
+    # Databases from before the ledger: move float balances to cents
+    c.execute("PRAGMA table_info(shops)")
+    if 'wallet_cents' not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE shops ADD COLUMN wallet_cents INTEGER NOT NULL DEFAULT 0")
+        c.execute("UPDATE shops SET wallet_cents = CAST(ROUND(wallet_balance * 100) AS INTEGER)")
+        c.execute('''INSERT INTO wallet_entries (shop_phone, entry_type, amount_cents, created_at)
+                     SELECT phone_number, 'OPENING', wallet_cents, ? FROM shops WHERE wallet_cents != 0''',
+                  (str(datetime.now()),))
+
+# --- TIMES ---
+# From schema v7 times are stored as epoch seconds (INTEGER). A subscription
+# expires at local midnight starting its expiry date; the date string is
+# only for display and for the date-based job APIs.
+def day_start(date_str):
+    """'YYYY-MM-DD' -> epoch seconds of that local midnight."""
+    return int(time.mktime(datetime.strptime(date_str, '%Y-%m-%d').timetuple()))
+
+def format_day(epoch_seconds):
+    """Epoch seconds -> 'YYYY-MM-DD' (local), or None."""
+    if epoch_seconds is None:
+        return None
+    return time.strftime('%Y-%m-%d', time.localtime(epoch_seconds))
+
+def _epoch(when):
+    """datetime (or epoch seconds) -> integer epoch seconds."""
+    return int(when.timestamp() if isinstance(when, datetime) else when)
+
+# --- SHOP CACHE ---
+# Owners tend to send several messages in a row, so recently used shop rows
+# (by phone) and name lookups (by normalized query) are kept in memory.
+# Writes invalidate them when their transaction ends; other workers see changes within
+# SHOP_CACHE_TTL seconds.
+SHOP_CACHE_SIZE = int(os.environ.get("SHOP_CACHE_SIZE", "2048"))
+SHOP_CACHE_TTL = float(os.environ.get("SHOP_CACHE_TTL", "30"))
+
+# Misses aren't cached: a shop registered in another worker must be found at once
+shop_cache = cache.TTLCache(SHOP_CACHE_SIZE, SHOP_CACHE_TTL, cache_none=False)    # phone -> shop row
+search_cache = cache.TTLCache(SHOP_CACHE_SIZE, SHOP_CACHE_TTL, cache_none=False)  # query -> phone
+
+def _invalidate_shop(phone_number, names_changed=False):
+    db_name = shard_for(phone_number)
+    after_transaction(lambda: shop_cache.invalidate(phone_number), db_name)
+    if names_changed:
+        after_transaction(search_cache.clear, db_name)
+
+def get_cache_stats():
+    """Hit-rate stats for the shop caches."""
+    return {'shops': shop_cache.get_stats(), 'search': search_cache.get_stats()}
+
+# Every shop row is returned in this column order (app.py indexes into it).
+# shop[6] is expires_at (epoch seconds; see format_day), and shop[7] the
+# wallet balance in KES, derived from the integer cents.
+SHOP_COLUMNS = ("phone_number, shop_name, catalog_link, location_map, payment_info, "
+                "operating_hours, expires_at, wallet_cents / 100.0, commission_rate")
+
+@_timed
 def add_shop(phone, name, catalog, location, payment, hours):
     """Registers a new shop with default wallet settings."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
     expiry = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
     
     try:
-        # Insert with default wallet=0.0 and commission=5%
-        c.execute("INSERT OR REPLACE INTO shops VALUES (?, ?, ?, ?, ?, ?, ?, 0.0, 0.05)",
-                  (phone, name, catalog, location, payment, hours, expiry))
-        conn.commit()
+        # New shops start with wallet=0 and commission=5%.
+        # Re-registering updates the details but keeps the wallet and its ledger.
+        with transaction(shard_for(phone)) as c:
+            c.execute("""INSERT INTO shops (phone_number, shop_name, catalog_link, location_map,
+                                            payment_info, operating_hours, expires_at)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)
+                         ON CONFLICT(phone_number) DO UPDATE SET
+                             shop_name = excluded.shop_name, catalog_link = excluded.catalog_link,
+                             location_map = excluded.location_map, payment_info = excluded.payment_info,
+                             operating_hours = excluded.operating_hours, expires_at = excluded.expires_at""",
+                      (phone, name, catalog, location, payment, hours, day_start(expiry)))
+            _invalidate_shop(phone, names_changed=True)
         return True, expiry
     except Exception as e:
         return False, str(e)
-    finally:
-        conn.close()
 
-def get_shop(phone_number):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT * FROM shops WHERE phone_number=?", (phone_number,))
-    shop = c.fetchone()
-    conn.close()
-    return shop
+@_timed
+def get_shop(phone_number, fresh=False):
+    """
+    Returns the shop row for a phone number (or None).
+    Served from the shop cache unless fresh=True; use fresh when acting on
+    the wallet balance (e.g. WITHDRAW).
+    """
+    # Inside a transaction we may see uncommitted rows: never cache those
+    if fresh or _thread_state().depth.get(shard_for(phone_number), 0):
+        return _load_shop(phone_number)
+    return shop_cache.get_or_load(phone_number, lambda: _load_shop(phone_number))
+
+def _load_shop(phone_number):
+    c = get_connection(shard_for(phone_number)).execute(
+        f"SELECT {SHOP_COLUMNS} FROM shops WHERE phone_number=?", (phone_number,))
+    return c.fetchone()
+
+# --- SHOP SEARCH ---
+SEARCH_LIMIT = 5
+SEARCH_CANDIDATES = 200 # Max substring hits considered for ranking
+_MIN_TRIGRAM_QUERY = 3 # The trigram tokenizer can't match shorter strings
+
+@_timed
+def search_shops(query_name, limit=SEARCH_LIMIT):
+    """
+    Finds shops by name, best match first:
+    exact name, then names starting with the query, then names containing it
+    (shortest, i.e. closest, first).
+    Every step is an index lookup, so cost doesn't grow with the directory,
+    except substrings under 3 characters, which need a (bounded) scan.
+    """
+    query = (query_name or '').strip()
+    if not query or limit <= 0:
+        return []
+    names = shard_names()
+    if len(names) == 1:
+        return [row for _, row in _search_shard(names[0], query, limit)]
+    # Each shard returns its own best `limit`; keep the best of those overall
+    ranked = [hit for db_name in names for hit in _search_shard(db_name, query, limit)]
+    return [row for _, row in heapq.nsmallest(limit, ranked, key=lambda hit: hit[0])]
+
+def _search_shard(db_name, query, limit):
+    """Runs the search on one database. Returns [(rank, row)], best first."""
+    conn = get_connection(db_name)
+    matches, seen = [], set()
+
+    def collect(rows, rank):
+        for row in rows:
+            if row[0] not in seen and len(matches) < limit:
+                seen.add(row[0])
+                matches.append((rank(row), row))
+
+    # 1. Exact (case-insensitive)
+    collect(conn.execute(f"SELECT {SHOP_COLUMNS} FROM shops WHERE shop_name = ? COLLATE NOCASE LIMIT ?",
+                         (query, limit)),
+            lambda row: (0, 0, row[1]))
+    # 2. Prefix: range scan on the NOCASE index
+    if len(matches) < limit:
+        collect(conn.execute(f"""SELECT {SHOP_COLUMNS} FROM shops
+                                WHERE shop_name >= ? COLLATE NOCASE AND shop_name < ? COLLATE NOCASE
+                                ORDER BY shop_name COLLATE NOCASE LIMIT ?""",
+                             (query, query + '\U0010ffff', limit + len(seen))),
+                lambda row: (1, 0, row[1].lower()))
+    # 3. Substring: trigram full-text index. Candidates are capped before
+    #    ranking so a very common fragment (e.g. "shop") stays cheap.
+    if len(matches) < limit and len(query) >= _MIN_TRIGRAM_QUERY:
+        phrase = '"' + query.replace('"', '""') + '"'
+        collect(conn.execute(f"""SELECT {SHOP_COLUMNS} FROM shops WHERE rowid IN
+                                    (SELECT rowid FROM shops_fts WHERE shops_fts MATCH ? LIMIT ?)
+                                ORDER BY length(shop_name), shop_name LIMIT ?""",
+                             (phrase, SEARCH_CANDIDATES, limit + len(seen))),
+                lambda row: (2, len(row[1]), row[1]))
+    # 3b. Substring of 1-2 characters (too short for trigrams): a full scan,
+    #     but it stops after SEARCH_CANDIDATES hits
+    elif len(matches) < limit:
+        pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        collect(conn.execute(f"""SELECT {SHOP_COLUMNS} FROM shops WHERE rowid IN
+                                    (SELECT rowid FROM shops WHERE shop_name LIKE ? ESCAPE '\\' LIMIT ?)
+                                ORDER BY length(shop_name), shop_name LIMIT ?""",
+                             (pattern, SEARCH_CANDIDATES, limit + len(seen))),
+                lambda row: (2, len(row[1]), row[1]))
+    return matches
 
+@_timed
 def search_shop_by_name(query_name):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT * FROM shops WHERE shop_name LIKE ?", (f'%{query_name}%',))
-    shop = c.fetchone()
-    conn.close()
-    return shop
+    """Returns the best matching shop for a name query, or None."""
+    # The search cache only maps a query to a phone number; the row itself
+    # comes from the shop cache, so wallet/expiry changes invalidate by phone
+    # Searched with the normalized query too, so every spelling sharing a key gets one answer
+    query = ' '.join((query_name or '').split())
+    key = query.lower()
+    def load():
+        matches = search_shops(query, limit=1)
+        return matches[0][0] if matches else None
+    phone = search_cache.get_or_load(key, load)
+    return get_shop(phone) if phone else None
 
+def rebuild_search_index():
+    """Re-indexes every shop name (run after a VACUUM, which may renumber rowids)."""
+    for db_name in shard_names():
+        with transaction(db_name) as c:
+            c.execute("INSERT INTO shops_fts(shops_fts) VALUES ('rebuild')")
+
+@_timed
 def update_shop_field(phone_number, field, new_value):
     column_map = {'NAME': 'shop_name', 'CATALOG': 'catalog_link', 
                   'LOCATION': 'location_map', 'PAY': 'payment_info', 'HOURS': 'operating_hours'}
     db_column = column_map.get(field.upper())
     if not db_column: return False, "Invalid field name."
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
     try:
-        query = f"UPDATE shops SET {db_column} = ? WHERE phone_number = ?"
-        c.execute(query, (new_value, phone_number))
-        conn.commit()
+        with transaction(shard_for(phone_number)) as c:
+            query = f"UPDATE shops SET {db_column} = ? WHERE phone_number = ?"
+            c.execute(query, (new_value, phone_number))
+            _invalidate_shop(phone_number, names_changed=(db_column == 'shop_name'))
         return True, f"Successfully updated {field}."
     except Exception as e:
         return False, str(e)
-    finally:
-        conn.close()
 
-def renew_subscription(phone_number, days=30):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+@_timed
+def renew_subscription(phone_number, days=30, amount=0):
+    """amount: what the owner paid for the renewal (counted in the daily rollups)."""
     new_expiry = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d')
-    c.execute("UPDATE shops SET expiry_date = ? WHERE phone_number = ?", (new_expiry, phone_number))
-    success = c.rowcount > 0
-    conn.commit()
-    conn.close()
+    with transaction(shard_for(phone_number)) as c:
+        c.execute("UPDATE shops SET expires_at = ? WHERE phone_number = ?", (day_start(new_expiry), phone_number))
+        success = c.rowcount > 0
+        if success:
+            _add_to_rollup(c, phone_number, renewals=1, renewal_cents=to_cents(amount))
+        _invalidate_shop(phone_number)
     return success, new_expiry
 
 # --- NEW: WALLET & TRANSACTION LOGIC ---
+# A withdrawal lock is a pending row of one of these types. WITHDRAWAL is a
+# B2C Daraja accepted (keyed by ConversationID); WITHDRAWAL_UNCONFIRMED one
+# we never heard back about (keyed by the OriginatorConversationID we sent).
+# The reconcile sweep never deletes the latter: it may have been paid.
+WITHDRAWAL_TYPES = ('WITHDRAWAL', 'WITHDRAWAL_UNCONFIRMED')
 
+@_timed
 def check_pending_withdrawal(shop_phone):
     """
     Checks if this shop already has a withdrawal in progress.
     Returns: Boolean (True if pending exists)
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT * FROM pending_transactions WHERE user_phone=? AND transaction_type='WITHDRAWAL'", (shop_phone,))
-    row = c.fetchone()
-    conn.close()
-    return row is not None
+    c = get_connection(shard_for(shop_phone)).execute(
+        "SELECT 1 FROM pending_transactions WHERE user_phone=? AND transaction_type IN (?, ?)",
+        (shop_phone, *WITHDRAWAL_TYPES))
+    return c.fetchone() is not None
 
+@_timed
 def clear_pending_withdrawal(shop_phone):
     """Removes the pending lock after success/failure."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM pending_transactions WHERE user_phone=? AND transaction_type='WITHDRAWAL'", (shop_phone,))
-    conn.commit()
-    conn.close()
+    with transaction(shard_for(shop_phone)) as c:
+        c.execute("DELETE FROM pending_transactions WHERE user_phone=? AND transaction_type='WITHDRAWAL'", (shop_phone,))
 
+@_timed
 def log_pending_transaction(checkout_id, user_phone, tx_type, target_shop=None, amount=0):
     """
     Saves a transaction as 'Pending' while we wait for M-Pesa PIN entry.
-    tx_type: 'SUBSCRIPTION' or 'PURCHASE' or 'WITHDRAWAL'
+    tx_type: 'SUBSCRIPTION' or 'PURCHASE' or 'WITHDRAWAL' (or 'WITHDRAWAL_UNCONFIRMED')
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
     try:
-        c.execute("INSERT INTO pending_transactions VALUES (?, ?, ?, ?, ?, ?)",
-                  (checkout_id, user_phone, tx_type, target_shop, amount, datetime.now()))
-        conn.commit()
+        with transaction(shard_for(pending_owner(user_phone, target_shop))) as c:
+            c.execute("INSERT INTO pending_transactions VALUES (?, ?, ?, ?, ?, ?)",
+                      (checkout_id, user_phone, tx_type, target_shop, amount, int(time.time())))
         return True
     except Exception as e:
         print(f"DB Error: {e}")
         return False
-    finally:
-        conn.close()
 
-def get_pending_transaction(checkout_id):
+# Lookups by callback id take db_name from locate_callback(); without it
+# they find the shard themselves.
+
+@_timed
+def get_pending_transaction(checkout_id, db_name=None):
     """Retrieves transaction details using the ID from the Callback."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT * FROM pending_transactions WHERE checkout_request_id=?", (checkout_id,))
-    tx = c.fetchone()
-    conn.close()
-    return tx
+    db_name = db_name or locate_callback(checkout_id)
+    if not db_name:
+        return None
+    c = get_connection(db_name).execute(
+        "SELECT * FROM pending_transactions WHERE checkout_request_id=?", (checkout_id,))
+    return c.fetchone()
+
+@_timed
+def delete_pending_transaction(checkout_id, db_name=None):
+    """Removes a pending transaction once its outcome is known."""
+    db_name = db_name or locate_callback(checkout_id)
+    if not db_name:
+        return False
+    with transaction(db_name) as c:
+        c.execute("DELETE FROM pending_transactions WHERE checkout_request_id=?", (checkout_id,))
+        return c.rowcount > 0
+
+@_timed
+def was_callback_processed(callback_id, db_name=None):
+    for name in [db_name] if db_name else shard_names():
+        c = get_connection(name).execute("SELECT 1 FROM processed_callbacks WHERE callback_id=?", (callback_id,))
+        if c.fetchone() is not None:
+            return True
+    return False
+
+@_timed
+def get_stale_pending(older_than, tx_types, limit=100):
+    """Oldest pending transactions of the given types logged before older_than."""
+    marks = ','.join('?' * len(tx_types))
+    per_shard = [get_connection(db_name).execute(
+                     f"""SELECT * FROM pending_transactions
+                         WHERE created_at < ? AND transaction_type IN ({marks})
+                         ORDER BY created_at LIMIT ?""", (_epoch(older_than), *tx_types, limit)).fetchall()
+                 for db_name in shard_names()]
+    if len(per_shard) == 1:
+        return per_shard[0]
+    return list(heapq.merge(*per_shard, key=lambda row: row[5]))[:limit]
+
+@_timed
+def sweep_expired_pending(older_than, tx_types, batch_size=500):
+    """
+    Deletes pending transactions of the given types logged before older_than,
+    batch_size rows per transaction so writers are never blocked for long.
+    Returns the number of rows deleted.
+    """
+    marks = ','.join('?' * len(tx_types))
+    deleted = 0
+    for db_name in shard_names():
+        while True:
+            with transaction(db_name) as c:
+                c.execute(f"""DELETE FROM pending_transactions WHERE rowid IN
+                                  (SELECT rowid FROM pending_transactions
+                                   WHERE created_at < ? AND transaction_type IN ({marks})
+                                   ORDER BY created_at LIMIT ?)""",
+                          (_epoch(older_than), *tx_types, batch_size))
+                count = c.rowcount
+            deleted += count
+            if count < batch_size:
+                break
+    return deleted
+
+@_timed
+def count_pending_by_type():
+    """Number of pending transactions per transaction_type."""
+    counts = {}
+    for db_name in shard_names():
+        c = get_connection(db_name).execute(
+            "SELECT transaction_type, COUNT(*) FROM pending_transactions GROUP BY transaction_type")
+        for tx_type, count in c.fetchall():
+            counts[tx_type] = counts.get(tx_type, 0) + count
+    return counts
+
+@_timed
+def mark_callback_processed(callback_id, kind, result_code, db_name=None):
+    """
+    Records that a callback was applied.
+    Returns False if it was already recorded (i.e. this is a redelivery).
+    """
+    with transaction(db_name or locate_callback(callback_id)) as c:
+        c.execute("INSERT OR IGNORE INTO processed_callbacks VALUES (?, ?, ?, ?)",
+                  (callback_id, kind, result_code, int(time.time())))
+        return c.rowcount > 0
+
+# --- WALLET LEDGER ---
+# Balances only move through single `wallet_cents = wallet_cents + ?` updates,
+# each paired with a wallet_entries row in the same transaction.
+
+def to_cents(amount):
+    """Converts a KES amount (int, float or str) to integer cents."""
+    return int(Decimal(str(amount)).scaleb(2).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def _commission_cents(gross_cents, rate):
+    return int((Decimal(gross_cents) * Decimal(str(rate))).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def _append_entry(c, shop_phone, entry_type, amount_cents, gross_cents=0, commission_cents=0, reference=None):
+    c.execute("""INSERT INTO wallet_entries (shop_phone, entry_type, gross_cents, commission_cents,
+                                             amount_cents, reference, created_at)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)""",
+              (shop_phone, entry_type, gross_cents, commission_cents, amount_cents, reference,
+               int(time.time())))
+    c.execute("UPDATE shops SET wallet_cents = wallet_cents + ? WHERE phone_number = ?",
+              (amount_cents, shop_phone))
+    if entry_type == 'SALE':
+        _add_to_rollup(c, shop_phone, sales=1, gross_cents=gross_cents, commission_cents=commission_cents)
+    elif entry_type == 'WITHDRAWAL':
+        _add_to_rollup(c, shop_phone, withdrawals=1, withdrawal_cents=-amount_cents)
+    _invalidate_shop(shop_phone)
 
-def credit_wallet(shop_phone, amount):
+@_timed
+def credit_wallet(shop_phone, amount, reference=None):
     """
     Calculates commission and credits the Shop Owner's wallet.
     Logic: Net = Amount - (Amount * CommissionRate)
+    reference: the CheckoutRequestID the money came from (for the audit trail)
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Get current balance & rate
-    c.execute("SELECT wallet_balance, commission_rate FROM shops WHERE phone_number=?", (shop_phone,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return False
-    
-    current_balance, rate = row
-    
-    # Calculate Commission
-    commission = amount * rate
-    net_amount = amount - commission
-    new_balance = current_balance + net_amount
-    
-    c.execute("UPDATE shops SET wallet_balance = ? WHERE phone_number = ?", (new_balance, shop_phone))
-    conn.commit()
-    conn.close()
+    gross = to_cents(amount)
+    with transaction(shard_for(shop_phone)) as c:
+        c.execute("SELECT commission_rate FROM shops WHERE phone_number=?", (shop_phone,))
+        row = c.fetchone()
+        if not row:
+            return False
+        
+        # Calculate Commission
+        commission = _commission_cents(gross, row[0])
+        _append_entry(c, shop_phone, 'SALE', gross - commission, gross, commission, reference)
     return True
 
-def debit_wallet_all(shop_phone):
+@_timed
+def debit_wallet(shop_phone, amount=None, reference=None):
+    """
+    Debits a confirmed withdrawal (never below zero). amount=None empties the wallet.
+    Returns the amount debited in KES.
+    """
+    with transaction(shard_for(shop_phone)) as c:
+        c.execute("SELECT wallet_cents FROM shops WHERE phone_number=?", (shop_phone,))
+        row = c.fetchone()
+        if not row or row[0] <= 0:
+            return 0
+        
+        cents = row[0] if amount is None else min(row[0], to_cents(amount))
+        if cents <= 0:
+            return 0
+        _append_entry(c, shop_phone, 'WITHDRAWAL', -cents, reference=reference)
+    return cents / 100
+
+@_timed
+def debit_wallet_all(shop_phone, reference=None):
     """
     Empties the shop's wallet for withdrawal.
     NOW: Only called AFTER success callback.
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    c.execute("SELECT wallet_balance FROM shops WHERE phone_number=?", (shop_phone,))
-    row = c.fetchone()
-    if not row: return 0
-    
-    balance = row[0]
-    if balance <= 0: return 0
-    
-    # Reset balance to 0 (Optimistic Locking strategy for MVP)
-    c.execute("UPDATE shops SET wallet_balance = 0 WHERE phone_number = ?", (shop_phone,))
-    conn.commit()
-    conn.close()
-    
-    return balance
+    return debit_wallet(shop_phone, None, reference)
+
+@_timed
+def get_wallet_entries(shop_phone, limit=20):
+    """Latest ledger entries for a shop, newest first."""
+    c = get_connection(shard_for(shop_phone)).execute(
+        """SELECT entry_id, entry_type, gross_cents, commission_cents, amount_cents, reference, created_at
+           FROM wallet_entries WHERE shop_phone=? ORDER BY entry_id DESC LIMIT ?""", (shop_phone, limit))
+    return c.fetchall()
+
+def rebuild_wallet_balances():
+    """Recomputes every wallet_cents from the ledger. Returns how many shops changed."""
+    ledger_total = """COALESCE((SELECT SUM(amount_cents) FROM wallet_entries
+                                WHERE shop_phone = shops.phone_number), 0)"""
+    changed = 0
+    for db_name in shard_names():
+        with transaction(db_name) as c:
+            c.execute(f"UPDATE shops SET wallet_cents = {ledger_total} WHERE wallet_cents != {ledger_total}")
+            after_transaction(shop_cache.clear, db_name)
+            changed += c.rowcount
+    return changed
+
+# --- DAILY ROLLUPS ---
+# Per-day totals for each shop, plus a platform row (shop_phone = ''), kept in
+# the shop's shard and bumped in the same transaction as the ledger entry or
+# renewal they count. Reports read one row per day instead of the ledger.
+PLATFORM = ''
+ROLLUP_COLUMNS = ('sales', 'gross_cents', 'commission_cents',
+                  'withdrawals', 'withdrawal_cents', 'renewals', 'renewal_cents')
+
+def _add_to_rollup(c, shop_phone, **amounts):
+    """Adds amounts (ROLLUP_COLUMNS) to today's row for the shop and for the platform."""
+    names = ', '.join(amounts)
+    updates = ', '.join(f"{name} = {name} + excluded.{name}" for name in amounts)
+    day = datetime.now().strftime('%Y-%m-%d')
+    for phone in (shop_phone, PLATFORM):
+        c.execute(f"""INSERT INTO daily_rollups (shop_phone, day, {names})
+                      VALUES (?, ?, {', '.join('?' * len(amounts))})
+                      ON CONFLICT(shop_phone, day) DO UPDATE SET {updates}""",
+                  (phone, day, *amounts.values()))
+
+@_timed
+def get_daily_rollups(start_day, end_day, shop_phone=None):
+    """
+    [(day, {column: total})] for days in [start_day, end_day] that had any
+    activity, oldest first. shop_phone=None: the whole platform.
+    """
+    phone = shop_phone or PLATFORM
+    names = [shard_for(phone)] if shop_phone else shard_names()
+    days = {}
+    for db_name in names:
+        c = get_connection(db_name).execute(
+            f"""SELECT day, {', '.join(ROLLUP_COLUMNS)} FROM daily_rollups
+                WHERE shop_phone = ? AND day BETWEEN ? AND ? ORDER BY day""",
+            (phone, start_day, end_day))
+        for day, *values in c.fetchall():
+            totals = days.setdefault(day, dict.fromkeys(ROLLUP_COLUMNS, 0))
+            for name, value in zip(ROLLUP_COLUMNS, values):
+                totals[name] += value
+    return sorted(days.items())
 
 # --- NEW: EXPIRY CHECK LOGIC ---
+@_timed
 def get_shops_expiring_on(date_str):
     """
     Finds all shops expiring on a specific date (YYYY-MM-DD).
     Returns a list of tuples: [(phone, name), (phone, name)...]
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT phone_number, shop_name FROM shops WHERE expiry_date = ?", (date_str,))
-    results = c.fetchall()
-    conn.close()
-    return results
\ No newline at end of file
+    start, end = _day_bounds(date_str, date_str)
+    rows = []
+    for db_name in shard_names():
+        c = get_connection(db_name).execute(
+            "SELECT phone_number, shop_name FROM shops WHERE expires_at >= ? AND expires_at < ?", (start, end))
+        rows.extend(c.fetchall())
+    return rows
+
+def _day_bounds(start_date, end_date):
+    """[start of start_date, start of the day after end_date) in epoch seconds."""
+    day_after = (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    return day_start(start_date), day_start(day_after)
+
+EXPIRY_PAGE_SIZE = 500
+
+def iter_shops_expiring_between(start_date, end_date, after=None, page_size=EXPIRY_PAGE_SIZE):
+    """
+    Yields (phone, name, expiry_date) for shops expiring in [start_date, end_date]
+    (all 'YYYY-MM-DD'), ordered by (expiry, phone). Reads one page at a time using keyset
+    pagination, so memory stays flat however many shops share a date.
+    after: (expiry_date, phone) to resume strictly after.
+    Shards are scanned side by side and merged into one ordered stream.
+    """
+    names = shard_names()
+    scans = [_iter_expiring(db_name, start_date, end_date, after, page_size) for db_name in names]
+    if len(scans) == 1:
+        return scans[0]
+    return heapq.merge(*scans, key=lambda row: (row[2], row[0]))
+
+def _iter_expiring(db_name, start_date, end_date, after, page_size):
+    start, end = _day_bounds(start_date, end_date)
+    last_expiry, last_phone = start, ''
+    if after and day_start(after[0]) >= start:
+        last_expiry, last_phone = day_start(after[0]), after[1]
+    while True:
+        c = get_connection(db_name).execute(
+            """SELECT phone_number, shop_name, expires_at FROM shops
+               WHERE expires_at < ? AND (expires_at, phone_number) > (?, ?)
+                 AND expires_at >= ?
+               ORDER BY expires_at, phone_number LIMIT ?""",
+            (end, last_expiry, last_phone, start, page_size))
+        page = c.fetchall()
+        for phone, name, expires_at in page:
+            yield phone, name, format_day(expires_at)
+        if len(page) < page_size:
+            return
+        last_phone, _, last_expiry = page[-1]
+
+@_timed
+def get_watermark(job_name):
+    """Returns (last_date, last_phone) recorded for a job, or None."""
+    c = get_connection().execute("SELECT last_date, last_phone FROM job_watermarks WHERE job_name=?", (job_name,))
+    return c.fetchone()
+
+@_timed
+def set_watermark(job_name, last_date, last_phone):
+    """Records the last (date, phone) a job finished processing."""
+    with transaction() as c:
+        c.execute("INSERT OR REPLACE INTO job_watermarks VALUES (?, ?, ?, ?)",
+                  (job_name, last_date, last_phone, str(datetime.now())))
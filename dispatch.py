@@ -0,0 +1,66 @@
+import os
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class WorkerPool:
+    """
+    A bounded background job queue served by a fixed number of threads.
+    submit() never blocks: when the queue is full it returns False so the
+    caller can shed load instead of piling up requests.
+    """
+
+    def __init__(self, name, workers=4, max_queue=100):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.stats = {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0}
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, so start them in the process that uses them
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+            self._pid = os.getpid()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs). Returns False if the queue is saturated."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((fn, args, kwargs))
+        except queue.Full:
+            self._count('rejected')
+            return False
+        self._count('submitted')
+        return True
+
+    def depth(self):
+        """Number of jobs waiting for a worker."""
+        return self._queue.qsize()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _run(self):
+        while True:
+            fn, args, kwargs = self._queue.get()
+            try:
+                fn(*args, **kwargs)
+                self._count('completed')
+            except Exception as e:
+                self._count('failed')
+                logger.error(f"{self.name} job failed: {e}")
+            finally:
+                self._queue.task_done()
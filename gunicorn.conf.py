@@ -0,0 +1,18 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app`.
+
+def on_starting(server):
+    """Runs once in the master before any worker boots: apply schema migrations."""
+    import database
+    import metrics
+    import migrations
+    applied = migrations.migrate()
+    # Workers are forked from here: they must not inherit open SQLite handles
+    database.close_connections()
+    # Counters restart with each deploy; drop the last one's worker snapshots
+    metrics.reset()
+    server.log.info(f"Schema v{migrations.SCHEMA_VERSION}, applied: {applied}")
+
+def child_exit(server, worker):
+    """Keeps an exited worker's metrics in the archive (its pid may be reused)."""
+    import metrics
+    metrics.retire(worker.pid)
@@ -0,0 +1,169 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- WEBHOOK IDEMPOTENCY ---
+# Twilio retries /bot when we answer slowly, with the same MessageSid. The
+# first delivery claims the sid in webhook_replies (shared by all workers)
+# and stores its TwiML reply; a retry gets that reply back without running
+# the command again, so a slow BUY can't send a second PIN prompt.
+# If the first attempt is still running, the retry waits for its reply.
+WEBHOOK_DEDUP_TTL = int(os.environ.get("WEBHOOK_DEDUP_TTL", "3600"))        # Seconds a reply is kept
+WEBHOOK_DEDUP_MAX_ROWS = int(os.environ.get("WEBHOOK_DEDUP_MAX_ROWS", "50000"))
+WEBHOOK_DEDUP_WAIT = float(os.environ.get("WEBHOOK_DEDUP_WAIT", "10"))      # Retry waits this long for the first attempt
+WEBHOOK_CLAIM_TIMEOUT = int(os.environ.get("WEBHOOK_CLAIM_TIMEOUT", "60"))  # Then a dead worker's claim is taken over
+PRUNE_EVERY = 200 # Claims per process between clean-ups
+POLL_INTERVAL = 0.05
+
+# Sent when the first attempt is still running after WEBHOOK_DEDUP_WAIT:
+# an empty reply, so the customer gets no message rather than a double charge
+EMPTY_REPLY = b'<?xml version="1.0" encoding="UTF-8"?><Response />'
+
+metrics.describe('webhook_dedup_total', 'counter', 'Inbound /bot deliveries by deduplication outcome.')
+
+_claims = [0]
+_claims_lock = threading.Lock()
+
+def _claim(message_sid, now):
+    """Returns None if we now own message_sid, else its row (reply, claimed_at)."""
+    with database.transaction() as c:
+        c.execute("INSERT OR IGNORE INTO webhook_replies (message_sid, claimed_at) VALUES (?, ?)",
+                  (message_sid, now))
+        if c.rowcount:
+            return None
+        c.execute("SELECT reply, claimed_at FROM webhook_replies WHERE message_sid=?", (message_sid,))
+        row = c.fetchone()
+        if row[0] is None and row[1] < now - WEBHOOK_CLAIM_TIMEOUT:
+            # The worker that claimed it never answered (crashed or killed)
+            c.execute("UPDATE webhook_replies SET claimed_at=? WHERE message_sid=?", (now, message_sid))
+            return None
+        return row
+
+def _store(message_sid, reply):
+    with database.transaction() as c:
+        c.execute("UPDATE webhook_replies SET reply=? WHERE message_sid=?", (reply, message_sid))
+
+def _release(message_sid):
+    with database.transaction() as c:
+        c.execute("DELETE FROM webhook_replies WHERE message_sid=? AND reply IS NULL", (message_sid,))
+
+def _lookup(message_sid):
+    c = database.get_connection().execute(
+        "SELECT reply FROM webhook_replies WHERE message_sid=?", (message_sid,))
+    return c.fetchone()
+
+def _wait_for_reply(message_sid):
+    deadline = time.monotonic() + WEBHOOK_DEDUP_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        row = _lookup(message_sid)
+        if row is None:
+            return None # First attempt failed and released it
+        if row[0] is not None:
+            return row[0]
+    return EMPTY_REPLY
+
+async def _wait_for_reply_async(message_sid):
+    deadline = time.monotonic() + WEBHOOK_DEDUP_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+        row = await database.run_async(_lookup, message_sid)
+        if row is None:
+            return None
+        if row[0] is not None:
+            return row[0]
+    return EMPTY_REPLY
+
+def prune(now=None):
+    """Drops expired replies, then the oldest beyond WEBHOOK_DEDUP_MAX_ROWS. Returns rows deleted."""
+    now = now or time.time()
+    with database.transaction() as c:
+        c.execute("DELETE FROM webhook_replies WHERE claimed_at < ?", (now - WEBHOOK_DEDUP_TTL,))
+        deleted = c.rowcount
+        c.execute("""DELETE FROM webhook_replies WHERE claimed_at <
+                         (SELECT claimed_at FROM webhook_replies ORDER BY claimed_at DESC LIMIT 1 OFFSET ?)""",
+                  (WEBHOOK_DEDUP_MAX_ROWS - 1,))
+        return deleted + c.rowcount
+
+def _maybe_prune():
+    with _claims_lock:
+        _claims[0] += 1
+        due = _claims[0] % PRUNE_EVERY == 0
+    if due:
+        try:
+            prune()
+        except Exception as e:
+            logger.warning(f"Webhook dedup prune failed: {e}")
+
+def _duplicate(message_sid, reply, result):
+    metrics.inc('webhook_dedup_total', {'result': result})
+    logger.info(f"Duplicate delivery of {message_sid} ({result})")
+    return reply
+
+def _new_delivery():
+    metrics.inc('webhook_dedup_total', {'result': 'new'})
+    _maybe_prune()
+
+def _encoded(reply):
+    return reply if isinstance(reply, bytes) else reply.encode('utf-8')
+
+def run_once(message_sid, handler):
+    """
+    Returns handler()'s reply for the first delivery of message_sid and the
+    same reply for any redelivery. Without a sid, just calls handler().
+    """
+    if not message_sid:
+        return handler()
+
+    while True:
+        row = _claim(message_sid, time.time())
+        if row is None:
+            break
+        if row[0] is not None:
+            return _duplicate(message_sid, row[0], 'replayed')
+        reply = _wait_for_reply(message_sid)
+        if reply is None:
+            continue # The first attempt failed and gave up its claim
+        return _duplicate(message_sid, reply, 'timed_out' if reply is EMPTY_REPLY else 'waited')
+
+    _new_delivery()
+    try:
+        reply = handler()
+    except BaseException:
+        # Nothing was answered, so let Twilio's retry run the command again
+        _release(message_sid)
+        raise
+    _store(message_sid, _encoded(reply))
+    return reply
+
+async def run_once_async(message_sid, handler):
+    """run_once() for the asyncio service: handler is a coroutine function."""
+    if not message_sid:
+        return await handler()
+
+    while True:
+        row = await database.run_async(_claim, message_sid, time.time())
+        if row is None:
+            break
+        if row[0] is not None:
+            return _duplicate(message_sid, row[0], 'replayed')
+        reply = await _wait_for_reply_async(message_sid)
+        if reply is None:
+            continue
+        return _duplicate(message_sid, reply, 'timed_out' if reply is EMPTY_REPLY else 'waited')
+
+    await database.run_async(_new_delivery)
+    try:
+        reply = await handler()
+    except BaseException:
+        await asyncio.shield(database.run_async(_release, message_sid))
+        raise
+    await database.run_async(_store, message_sid, _encoded(reply))
+    return reply
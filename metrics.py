@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import atexit
+import tempfile
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# --- METRICS ---
+# Counters and latency histograms in the Prometheus text format.
+# Each gunicorn worker keeps its own numbers; with METRICS_DIR set, workers
+# write snapshots there and /metrics adds them all up, so a scrape sees the
+# whole deployment no matter which worker answers it.
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "5"))
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+_help = {}        # name -> (type, help text)
+_gauges = []      # functions returning [(name, labels dict, value)], run at scrape
+_last_flush = [0.0]
+
+def describe(name, metric_type, help_text):
+    """Registers the # HELP / # TYPE lines for a metric."""
+    _help[name] = (metric_type, help_text)
+
+def _key(name, labels):
+    return (name, tuple(sorted((labels or {}).items())))
+
+def inc(name, labels=None, value=1):
+    """Adds value to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _maybe_flush()
+
+def observe(name, seconds, labels=None):
+    """Records one duration in a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+                break
+        else:
+            hist[len(BUCKETS)] += 1
+        hist[-1] += seconds
+    _maybe_flush()
+
+@contextmanager
+def timer(name, **labels):
+    """Times a block into a histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, labels)
+
+def timed(name, label='function'):
+    """Decorator timing each call into a histogram labelled with the function name."""
+    def decorator(fn):
+        labels = {label: fn.__name__}
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started, labels)
+        return wrapper
+    return decorator
+
+def register_gauge(fn):
+    """fn() -> [(name, labels, value)] is evaluated once per scrape (not summed across workers)."""
+    _gauges.append(fn)
+    return fn
+
+# --- MULTI-PROCESS AGGREGATION ---
+def _snapshot():
+    with _lock:
+        return {'counters': [[k[0], list(k[1]), v] for k, v in _counters.items()],
+                'histograms': [[k[0], list(k[1]), list(v)] for k, v in _histograms.items()]}
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f"metrics_{pid}.json")
+
+# Totals of workers that have exited (see retire), summed like a live snapshot
+ARCHIVE_FILE = "metrics_archive.json"
+
+def _write_json(path, data):
+    """Atomically replaces path (write temp file + rename)."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, prefix=".metrics")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def flush():
+    """Writes this process's metrics for other workers to read."""
+    if not METRICS_DIR:
+        return
+    _last_flush[0] = time.monotonic()
+    try:
+        _write_json(_snapshot_path(os.getpid()), _snapshot())
+    except OSError as e:
+        print(f"Metrics Flush Error: {e}")
+
+def _maybe_flush():
+    if METRICS_DIR and time.monotonic() - _last_flush[0] > METRICS_FLUSH_SECONDS:
+        flush()
+
+atexit.register(flush)
+
+def _merge(snapshots):
+    """Sums snapshots. Returns (counters, histograms) keyed like the live dicts."""
+    counters, histograms = {}, {}
+    for snap in snapshots:
+        for name, labels, value in snap['counters']:
+            key = (name, tuple(tuple(l) for l in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snap['histograms']:
+            key = (name, tuple(tuple(l) for l in labels))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, v in enumerate(values):
+                total[i] += v
+    return counters, histograms
+
+def _collect():
+    """Sums the snapshots of every worker (ours taken live) and the archive."""
+    snapshots = [_snapshot()]
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        own = os.path.basename(_snapshot_path(os.getpid()))
+        for filename in os.listdir(METRICS_DIR):
+            if filename.startswith("metrics_") and filename != own:
+                snap = _read_json(os.path.join(METRICS_DIR, filename))
+                if snap:
+                    snapshots.append(snap)
+    return _merge(snapshots)
+
+# --- WORKER LIFECYCLE ---
+# Called from the gunicorn master (gunicorn.conf.py), so a recycled worker's
+# totals aren't lost, and a new worker reusing its pid can't overwrite them.
+def retire(pid):
+    """Folds an exited worker's snapshot into the archive and deletes it."""
+    if not METRICS_DIR:
+        return
+    path = _snapshot_path(pid)
+    snap = _read_json(path)
+    try:
+        if snap:
+            archive_path = os.path.join(METRICS_DIR, ARCHIVE_FILE)
+            archive = _read_json(archive_path) or {'counters': [], 'histograms': []}
+            counters, histograms = _merge([archive, snap])
+            _write_json(archive_path, {'counters': [[k[0], list(k[1]), v] for k, v in counters.items()],
+                                       'histograms': [[k[0], list(k[1]), v] for k, v in histograms.items()]})
+        os.remove(path)
+    except OSError as e:
+        print(f"Metrics Retire Error: {e}")
+
+def reset():
+    """Deletes every snapshot and the archive (at deploy, before workers start)."""
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    for filename in os.listdir(METRICS_DIR):
+        if filename.startswith(("metrics_", ".metrics")):
+            try:
+                os.remove(os.path.join(METRICS_DIR, filename))
+            except OSError:
+                continue
+
+# --- EXPOSITION ---
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(pairs, extra=()):
+    pairs = list(pairs) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _header(lines, seen, name, default_type):
+    if name in seen:
+        return
+    seen.add(name)
+    metric_type, help_text = _help.get(name, (default_type, name))
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    counters, histograms = _collect()
+    lines, seen = [], set()
+    for (name, labels), value in sorted(counters.items()):
+        _header(lines, seen, name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), values in sorted(histograms.items()):
+        _header(lines, seen, name, "histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS, values):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+        cumulative += values[len(BUCKETS)]
+        lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {values[-1]}")
+        lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    for gauge in _gauges:
+        try:
+            samples = gauge()
+        except Exception as e:
+            print(f"Metrics Gauge Error: {e}")
+            continue
+        for name, labels, value in samples:
+            _header(lines, seen, name, "gauge")
+            lines.append(f"{name}{_labels(sorted(labels.items()))} {value}")
+    return "\n".join(lines) + "\n"
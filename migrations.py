@@ -0,0 +1,180 @@
+import os
+import logging
+
+import database
+import online_migration
+
+logger = logging.getLogger(__name__)
+
+# --- SCHEMA MIGRATIONS ---
+# Each database file records its schema version in PRAGMA user_version.
+# Migrations run once per deploy: from gunicorn's master process (see
+# gunicorn.conf.py) or by hand with `python migrations.py`. Workers only
+# read the version when they start.
+# To change the schema, append (version, function) below; never edit one
+# that has shipped. Each function gets a cursor inside the migration's transaction.
+def _webhook_replies(c):
+    """v2: replies per Twilio MessageSid, so webhook retries are answered once (see idempotency.py)."""
+    # Only used in DB_NAME; harmless (and empty) in the shard files
+    c.execute('''CREATE TABLE IF NOT EXISTS webhook_replies
+                 (message_sid TEXT PRIMARY KEY,
+                  reply BLOB,
+                  claimed_at REAL NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_webhook_replies_claimed ON webhook_replies(claimed_at)")
+
+def _rate_buckets(c):
+    """v3: token buckets shared by all workers (see ratelimit.py)."""
+    # full_at: when the bucket will have refilled, after which the row can go
+    c.execute('''CREATE TABLE IF NOT EXISTS rate_buckets
+                 (bucket_key TEXT PRIMARY KEY,
+                  tokens REAL NOT NULL,
+                  updated_at REAL NOT NULL,
+                  full_at REAL NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rate_buckets_full ON rate_buckets(full_at)")
+
+def _daily_rollups(c):
+    """v4: per-day revenue totals per shop and for the platform (see database.get_daily_rollups)."""
+    counters = ', '.join(f"{name} INTEGER NOT NULL DEFAULT 0" for name in database.ROLLUP_COLUMNS)
+    c.execute(f'''CREATE TABLE IF NOT EXISTS daily_rollups
+                  (shop_phone TEXT NOT NULL,
+                   day TEXT NOT NULL,
+                   {counters},
+                   PRIMARY KEY (shop_phone, day)) WITHOUT ROWID''')
+    # Backfill sales and withdrawals from the ledger. Renewals before this
+    # point were never recorded anywhere, so they start at zero.
+    ledger = """SELECT {phone}, substr(created_at, 1, 10),
+                       SUM(entry_type = 'SALE'),
+                       SUM(CASE WHEN entry_type = 'SALE' THEN gross_cents ELSE 0 END),
+                       SUM(CASE WHEN entry_type = 'SALE' THEN commission_cents ELSE 0 END),
+                       SUM(entry_type = 'WITHDRAWAL'),
+                       SUM(CASE WHEN entry_type = 'WITHDRAWAL' THEN -amount_cents ELSE 0 END)
+                FROM wallet_entries
+                WHERE entry_type IN ('SALE', 'WITHDRAWAL') AND created_at IS NOT NULL
+                GROUP BY 1, 2"""
+    for phone in ('shop_phone', '?'):
+        c.execute(f"""INSERT INTO daily_rollups (shop_phone, day, sales, gross_cents, commission_cents,
+                                                 withdrawals, withdrawal_cents)
+                      {ledger.format(phone=phone)}""",
+                  () if phone == 'shop_phone' else (database.PLATFORM,))
+
+def _payouts(c):
+    """v5: batched payout runs and their items (see payouts.py)."""
+    c.execute("PRAGMA table_info(shops)")
+    if 'payout_requested_at' not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE shops ADD COLUMN payout_requested_at REAL")
+    # The run picks flagged shops by balance; unflagged shops stay out of the index
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_shops_payout ON shops(wallet_cents)
+                 WHERE payout_requested_at IS NOT NULL""")
+    # Runs are kept in DB_NAME, items in the shop's shard (next to its withdrawal lock)
+    c.execute('''CREATE TABLE IF NOT EXISTS payout_runs
+                 (run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  status TEXT NOT NULL,
+                  started_at REAL NOT NULL,
+                  finished_at REAL,
+                  items INTEGER NOT NULL DEFAULT 0,
+                  amount_cents INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS payout_items
+                 (run_id INTEGER NOT NULL,
+                  shop_phone TEXT NOT NULL,
+                  amount_cents INTEGER NOT NULL,
+                  state TEXT NOT NULL,
+                  conversation_id TEXT,
+                  error TEXT,
+                  updated_at REAL NOT NULL,
+                  PRIMARY KEY (run_id, shop_phone))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payout_items_state ON payout_items(run_id, state)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payout_items_conversation ON payout_items(conversation_id)")
+
+def _outbox(c):
+    """v6: outbound WhatsApp messages waiting for (or done with) delivery (see outbox.py)."""
+    # Only used in DB_NAME; harmless (and empty) in the shard files
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox
+                 (message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  to_phone TEXT NOT NULL,
+                  body TEXT NOT NULL,
+                  dedup_key TEXT UNIQUE,
+                  status TEXT NOT NULL,
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at REAL NOT NULL,
+                  created_at REAL NOT NULL,
+                  updated_at REAL NOT NULL,
+                  sid TEXT,
+                  error TEXT)''')
+    # Workers only look at rows still to be delivered
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(next_attempt_at)
+                 WHERE status IN ('queued', 'sending')""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_updated ON outbox(updated_at)")
+
+def _typed_tables(c):
+    """v7: STRICT core tables with epoch-second times (see online_migration.py)."""
+    online_migration.swap_all(c)
+
+def _payout_originators(c):
+    """v8: the opaque OriginatorConversationID each payout item is sent under."""
+    c.execute("PRAGMA table_info(payout_items)")
+    if 'originator_id' not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE payout_items ADD COLUMN originator_id TEXT")
+    # Items sent before v8 used PAYOUT_<run>_<phone>, which their locks may still carry
+    c.execute("""UPDATE payout_items SET originator_id = 'PAYOUT_' || run_id || '_' || shop_phone
+                 WHERE originator_id IS NULL AND state != 'queued'""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payout_items_originator ON payout_items(originator_id)")
+
+MIGRATIONS = [
+    (1, database.create_schema),
+    (2, _webhook_replies),
+    (3, _rate_buckets),
+    (4, _daily_rollups),
+    (5, _payouts),
+    (6, _outbox),
+    (7, _typed_tables),
+    (8, _payout_originators),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# If a worker finds an old schema (no deploy hook ran, e.g. `python app.py`),
+# migrate it there and then. The first worker does the work; the others wait
+# on the write lock and then find nothing to do. Set to 0 to refuse to start instead.
+MIGRATE_ON_START = os.environ.get("MIGRATE_ON_START", "1") == "1"
+
+def get_version(db_name):
+    return database.get_connection(db_name).execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_file(db_name):
+    """Brings one database file up to SCHEMA_VERSION. Returns the versions applied."""
+    applied = []
+    with database.transaction(db_name) as c:
+        # Read under the write lock, so concurrent callers apply each step once
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for target, migration in MIGRATIONS:
+            if target > version:
+                migration(c)
+                applied.append(target)
+        if applied:
+            c.execute(f"PRAGMA user_version = {applied[-1]}")
+    for target in applied:
+        logger.info(f"Migrated {db_name} to schema v{target}")
+    return applied
+
+def migrate():
+    """Migrates every database file. Returns {file: [versions applied]}."""
+    return {db_name: migrate_file(db_name) for db_name in database.database_files()}
+
+def outdated():
+    """{file: version} for every database file behind SCHEMA_VERSION."""
+    versions = {db_name: get_version(db_name) for db_name in database.database_files()}
+    return {db_name: v for db_name, v in versions.items() if v < SCHEMA_VERSION}
+
+def ensure_current():
+    """Startup check: a couple of PRAGMA reads when the deploy step already ran."""
+    behind = outdated()
+    if not behind:
+        return
+    if not MIGRATE_ON_START:
+        raise RuntimeError(f"Database schema is behind v{SCHEMA_VERSION}: {behind}. "
+                           f"Run `python migrations.py` first.")
+    migrate()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    result = migrate()
+    print(f"✅ Schema v{SCHEMA_VERSION}. Applied: {result}")
@@ -1,13 +1,30 @@
 import requests
 import json
+import random
+import logging
+import asyncio
 import base64
 import os
+import tempfile
+import threading
+import time
+import uuid
 from datetime import datetime
+from collections import deque
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
-# --- NEW: SECURITY IMPORTS ---
-# You must install pycryptodome: pip install pycryptodome
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_v1_5
+import metrics
+import database
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl  # POSIX only; used to share one token refresh across workers
+except ImportError:
+    fcntl = None
 
 # --- CONFIGURATION ---
 # Using keys from your uploaded file
@@ -22,30 +39,419 @@ B2C_SHORTCODE = "600996" # Sandbox B2C Shortcode
 INITIATOR_NAME = "testapi"
 INITIATOR_PASSWORD = "YOUR_INITIATOR_PASSWORD" # Plain text password from portal
 
-def get_access_token():
-    """Authenticates with Safaricom."""
-    api_url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-    r = requests.get(api_url, auth=(CONSUMER_KEY, CONSUMER_SECRET))
-    return r.json().get('access_token')
+# --- HTTP CLIENT ---
+# One pooled keep-alive session for every Daraja call, so we pay the TCP+TLS
+# handshake once per connection instead of once per payment.
+MPESA_BASE_URL = os.environ.get("MPESA_BASE_URL", "https://sandbox.safaricom.co.ke")
+HTTP_POOL_SIZE = int(os.environ.get("MPESA_POOL_SIZE", "10"))            # Connections kept per host
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("MPESA_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.environ.get("MPESA_READ_TIMEOUT", "15"))
+HTTP_RETRIES = int(os.environ.get("MPESA_RETRIES", "2"))
+RETRY_BACKOFF = 0.3 # Seconds; doubles per retry after the first, plus up to RETRY_JITTER
+RETRY_JITTER = 0.3
+# Longest a GET can spend sleeping between its retries
+RETRY_SLEEP_BUDGET = (sum(RETRY_BACKOFF * 2 ** (n - 1) for n in range(2, HTTP_RETRIES + 1))
+                      + RETRY_JITTER * HTTP_RETRIES)
+
+# Each call has a total deadline covering the token fetch, the request
+# and any retry, so a hung Safaricom endpoint can't hold a worker for long
+STK_DEADLINE = float(os.environ.get("MPESA_STK_DEADLINE", "8"))
+B2C_DEADLINE = float(os.environ.get("MPESA_B2C_DEADLINE", "10"))
+QUERY_DEADLINE = float(os.environ.get("MPESA_QUERY_DEADLINE", "5"))
+
+metrics.describe('daraja_request_seconds', 'histogram', 'Latency of outbound Daraja requests per endpoint.')
+metrics.describe('daraja_requests_total', 'counter', 'Outbound Daraja requests by endpoint and HTTP status.')
+metrics.describe('daraja_token_cache_total', 'counter', 'Access token lookups by result.')
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def _build_retry():
+    """
+    Retries with jittered backoff. Read/status retries only apply to GET
+    (idempotent); a POST is only retried if the connection never opened.
+    """
+    options = dict(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=HTTP_RETRIES,
+                   status=HTTP_RETRIES, status_forcelist=(429, 500, 502, 503, 504),
+                   allowed_methods=frozenset(['GET']), backoff_factor=RETRY_BACKOFF,
+                   raise_on_status=False)
+    try:
+        return Retry(backoff_jitter=RETRY_JITTER, **options)
+    except TypeError:
+        # urllib3 < 2 has no backoff_jitter
+        return Retry(**options)
+
+def get_session():
+    """Returns the shared requests.Session (rebuilt after a fork)."""
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE,
+                                  max_retries=_build_retry())
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session, _session_pid = session, os.getpid()
+    return _session
+
+# --- ERRORS ---
+class MpesaError(Exception):
+    """A Daraja call failed or returned something we can't use."""
+
+class MpesaUnavailable(MpesaError):
+    """
+    Daraja is unreachable or too slow, or the circuit breaker is open.
+    sent: the request may have reached Daraja (e.g. it timed out waiting
+    for the answer), so the payment may still go through.
+    """
+    def __init__(self, message, sent=False):
+        super().__init__(message)
+        self.sent = sent
+
+class MpesaBusy(MpesaUnavailable):
+    """No slot in the MPESA_CALLS_PER_SECOND budget came up in time; nothing was sent."""
+
+def _maybe_sent(error):
+    """False only when no connection was ever made, so Daraja can't have seen the request."""
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return not isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+# --- CIRCUIT BREAKER ---
+# When most recent Daraja calls fail, stop calling for a while: payment
+# commands then fail in microseconds instead of each waiting out a timeout,
+# so workers stay free for everything else.
+# closed: calls go through; the last CIRCUIT_WINDOW seconds are tracked and
+#   the circuit opens once CIRCUIT_MIN_CALLS calls there fail at CIRCUIT_FAILURE_RATE or more.
+# open: calls are refused for CIRCUIT_OPEN_SECONDS.
+# half_open: up to CIRCUIT_HALF_OPEN_CALLS trial calls; success closes, failure re-opens.
+# Each worker process has its own breaker.
+CIRCUIT_WINDOW = float(os.environ.get("MPESA_CIRCUIT_WINDOW", "30"))
+CIRCUIT_MIN_CALLS = int(os.environ.get("MPESA_CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_FAILURE_RATE = float(os.environ.get("MPESA_CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("MPESA_CIRCUIT_OPEN_SECONDS", "30"))
+CIRCUIT_HALF_OPEN_CALLS = int(os.environ.get("MPESA_CIRCUIT_HALF_OPEN_CALLS", "1"))
+
+metrics.describe('daraja_circuit_transitions_total', 'counter', 'Daraja circuit breaker state changes.')
+metrics.describe('daraja_circuit_rejected_total', 'counter', 'Daraja calls refused while the circuit was open.')
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, window=CIRCUIT_WINDOW, min_calls=CIRCUIT_MIN_CALLS,
+                 failure_rate=CIRCUIT_FAILURE_RATE, open_seconds=CIRCUIT_OPEN_SECONDS,
+                 half_open_calls=CIRCUIT_HALF_OPEN_CALLS):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = self.CLOSED
+        self._results = deque() # (time, ok) of calls in the window
+        self._opened_at = 0.0
+        self._trials = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning(f"Daraja circuit {self.state} -> {state}")
+            metrics.inc('daraja_circuit_transitions_total', {'state': state})
+        self.state = state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        elif state == self.HALF_OPEN:
+            self._trials = 0 # Each half-open window starts with its full trial budget
+        elif state == self.CLOSED:
+            self._results.clear()
+
+    def _refresh(self):
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._set_state(self.HALF_OPEN)
+
+    def is_open(self):
+        """True while calls are being refused (a half-open circuit lets trials through)."""
+        with self._lock:
+            self._refresh()
+            return self.state == self.OPEN
+
+    def before_call(self):
+        """Raises MpesaUnavailable if the call may not proceed. Returns True for a half-open trial."""
+        with self._lock:
+            self._refresh()
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                return True
+        metrics.inc('daraja_circuit_rejected_total')
+        raise MpesaUnavailable("Daraja circuit is open")
+
+    def after_call(self, ok, trial):
+        with self._lock:
+            now = time.monotonic()
+            if trial:
+                self._trials = max(self._trials - 1, 0)
+                if self.state == self.HALF_OPEN:
+                    self._set_state(self.CLOSED if ok else self.OPEN)
+                return
+            if self.state != self.CLOSED:
+                return # Started before the circuit opened
+            self._results.append((now, ok))
+            while self._results and self._results[0][0] < now - self.window:
+                self._results.popleft()
+            failures = sum(1 for _, result in self._results if not result)
+            if len(self._results) >= self.min_calls and failures / len(self._results) >= self.failure_rate:
+                self._set_state(self.OPEN)
+
+breaker = CircuitBreaker()
+
+# --- CALL RATE ---
+# Every outbound request (from /bot, reconcile, payout runs, any worker)
+# takes a token from the shared 'mpesa' bucket (see ratelimit.py), waiting up
+# to MPESA_SLOT_WAIT seconds for one, so together they stay under Daraja's quota.
+MPESA_SLOT_WAIT = float(os.environ.get("MPESA_SLOT_WAIT", "2"))
+
+def _slot_wait_until(deadline):
+    wait_until = time.monotonic() + MPESA_SLOT_WAIT
+    return wait_until if deadline is None else min(wait_until, deadline)
+
+def _wait_for_call_slot(deadline=None):
+    """Blocks until the global bucket has a token. Raises MpesaBusy if none comes in time."""
+    if not ratelimit.RATE_LIMIT_ENABLED:
+        return
+    capacity, rate = ratelimit.LIMITS['mpesa']
+    wait_until = _slot_wait_until(deadline)
+    while not ratelimit.take('mpesa:', capacity, rate):
+        pause = random.uniform(0.5, 1.5) / rate
+        if time.monotonic() + pause > wait_until:
+            metrics.inc('rate_limit_decisions_total', {'limit': 'mpesa', 'result': 'shed'})
+            raise MpesaBusy("Daraja call rate limit reached")
+        time.sleep(pause)
+    metrics.inc('rate_limit_decisions_total', {'limit': 'mpesa', 'result': 'allowed'})
+
+async def _wait_for_call_slot_async(deadline=None):
+    """_wait_for_call_slot() for the event loop."""
+    if not ratelimit.RATE_LIMIT_ENABLED:
+        return
+    capacity, rate = ratelimit.LIMITS['mpesa']
+    wait_until = _slot_wait_until(deadline)
+    while not await database.run_async(ratelimit.take, 'mpesa:', capacity, rate):
+        pause = random.uniform(0.5, 1.5) / rate
+        if time.monotonic() + pause > wait_until:
+            metrics.inc('rate_limit_decisions_total', {'limit': 'mpesa', 'result': 'shed'})
+            raise MpesaBusy("Daraja call rate limit reached")
+        await asyncio.sleep(pause)
+    metrics.inc('rate_limit_decisions_total', {'limit': 'mpesa', 'result': 'allowed'})
+
+def is_available():
+    """False while the circuit is open; payment commands should fail fast."""
+    return not breaker.is_open()
+
+def _timeouts(method, deadline):
+    """(connect, read) timeouts for each attempt of a call that must end by deadline."""
+    connect_timeout, read_timeout = HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise MpesaUnavailable("Daraja call ran out of time")
+        # Only GETs are retried after a read timeout (see _build_retry)
+        per_attempt = max(remaining - RETRY_SLEEP_BUDGET, 0.1) / (HTTP_RETRIES + 1)
+        connect_timeout = min(connect_timeout, per_attempt)
+        read_timeout = min(read_timeout, per_attempt if method == 'GET' else remaining - connect_timeout)
+    return connect_timeout, read_timeout
+
+def http_request(method, path, deadline=None, **kwargs):
+    """
+    Sends a request to Daraja through the pooled session and the circuit breaker.
+    deadline: time.monotonic() by which the call must be over. The time
+    left is split across the attempts the session's Retry may make.
+    Raises MpesaUnavailable instead of requests' network errors, and
+    MpesaBusy if the shared call rate leaves no slot in time.
+    """
+    _wait_for_call_slot(deadline)
+    kwargs.setdefault('timeout', _timeouts(method, deadline))
+    trial = breaker.before_call()
+
+    endpoint = path.split('?', 1)[0]
+    status, ok = 'error', False
+    started = time.perf_counter()
+    try:
+        response = get_session().request(method, MPESA_BASE_URL + path, **kwargs)
+        status = str(response.status_code)
+        ok = response.status_code < 500 and response.status_code != 429
+        return response
+    except requests.RequestException as e:
+        raise MpesaUnavailable(f"Daraja request failed: {e}", sent=_maybe_sent(e)) from e
+    finally:
+        breaker.after_call(ok, trial)
+        metrics.observe('daraja_request_seconds', time.perf_counter() - started, {'endpoint': endpoint})
+        metrics.inc('daraja_requests_total', {'endpoint': endpoint, 'status': status})
+
+def _json(response):
+    try:
+        return response.json()
+    except ValueError:
+        raise MpesaError(f"Daraja answered {response.status_code} without a JSON body")
+
+def _authorized_post(path, payload, deadline=None):
+    """POSTs with the cached token, retrying once with a fresh token on 401."""
+    for attempt in range(2):
+        try:
+            token = get_access_token(deadline)
+        except MpesaUnavailable as e:
+            # No token means the payment request itself was never sent
+            raise MpesaUnavailable(str(e), sent=False) from e
+        headers = { "Authorization": f"Bearer {token}" }
+        response = http_request("POST", path, deadline=deadline, json=payload, headers=headers)
+        if response.status_code != 401 or attempt:
+            return response
+        # The request was rejected before processing, so it is safe to resend
+        reset_access_token()
+
+# --- TOKEN CACHE ---
+# Daraja tokens are valid for `expires_in` seconds (~1 hour), so we keep the
+# current one in memory and only go back to the OAuth endpoint shortly before
+# it lapses. Set MPESA_TOKEN_CACHE_FILE to also share it between gunicorn workers.
+TOKEN_REFRESH_MARGIN = 60 # Seconds before expiry at which we refresh
+TOKEN_CACHE_FILE = os.environ.get("MPESA_TOKEN_CACHE_FILE")
+
+_token_lock = threading.Lock()
+_token = {'value': None, 'expires_at': 0.0}
+_stats_lock = threading.Lock()
+TOKEN_STATS = {'hits': 0, 'shared_hits': 0, 'misses': 0}
+
+def _count(key):
+    with _stats_lock:
+        TOKEN_STATS[key] += 1
+    metrics.inc('daraja_token_cache_total', {'result': key})
+
+def get_token_stats():
+    """
+    Returns the token cache counters.
+    hits/shared_hits were served without a network call, misses hit OAuth.
+    """
+    with _stats_lock:
+        stats = dict(TOKEN_STATS)
+    total = stats['hits'] + stats['shared_hits'] + stats['misses']
+    stats['hit_rate'] = (total - stats['misses']) / total if total else 0.0
+    return stats
+
+def _token_is_fresh(value, expires_at):
+    return bool(value) and time.time() < expires_at
+
+def _read_shared_token():
+    """Reads the token another worker stored. Returns (token, expires_at) or (None, 0)."""
+    if not TOKEN_CACHE_FILE:
+        return None, 0.0
+    try:
+        with open(TOKEN_CACHE_FILE, "r") as f:
+            data = json.load(f)
+        return data.get('access_token'), float(data.get('expires_at', 0))
+    except (OSError, ValueError):
+        return None, 0.0
+
+def _write_shared_token(value, expires_at):
+    """Atomically replaces the shared token file (write temp file + rename)."""
+    if not TOKEN_CACHE_FILE:
+        return
+    folder = os.path.dirname(os.path.abspath(TOKEN_CACHE_FILE))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".mpesa_token")
+        with os.fdopen(fd, "w") as f:
+            json.dump({'access_token': value, 'expires_at': expires_at}, f)
+        os.replace(tmp_path, TOKEN_CACHE_FILE)
+    except OSError as e:
+        print(f"Token Cache Error: {e}")
+
+class _SharedRefreshLock:
+    """File lock so only one worker process refreshes the token at a time."""
+
+    def __enter__(self):
+        self.handle = None
+        if TOKEN_CACHE_FILE and fcntl:
+            try:
+                self.handle = open(TOKEN_CACHE_FILE + ".lock", "a")
+                fcntl.flock(self.handle, fcntl.LOCK_EX)
+            except OSError:
+                self.handle = None
+        return self
+
+    def __exit__(self, *exc):
+        if self.handle:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+            self.handle.close()
+
+def _fetch_access_token(deadline=None):
+    """Authenticates with Safaricom. Returns (token, expires_in seconds)."""
+    r = http_request("GET", "/oauth/v1/generate?grant_type=client_credentials", deadline=deadline,
+                     auth=(CONSUMER_KEY, CONSUMER_SECRET))
+    data = _json(r)
+    return data.get('access_token'), float(data.get('expires_in', 3599))
+
+def get_access_token(deadline=None):
+    """Returns a valid Safaricom token, refreshing it just before it expires."""
+    if _token_is_fresh(_token['value'], _token['expires_at']):
+        _count('hits')
+        return _token['value']
+
+    # Only one thread refreshes; the rest wait here and reuse its result
+    with _token_lock:
+        if _token_is_fresh(_token['value'], _token['expires_at']):
+            _count('hits')
+            return _token['value']
+
+        with _SharedRefreshLock():
+            value, expires_at = _read_shared_token()
+            if _token_is_fresh(value, expires_at):
+                _count('shared_hits')
+            else:
+                _count('misses')
+                value, expires_in = _fetch_access_token(deadline)
+                if not value:
+                    return None
+                expires_at = time.time() + expires_in - TOKEN_REFRESH_MARGIN
+                _write_shared_token(value, expires_at)
+
+        _token['value'], _token['expires_at'] = value, expires_at
+        return value
+
+def reset_access_token():
+    """Drops the cached token (e.g. after Safaricom rejects it)."""
+    with _token_lock:
+        stale = _token['value']
+        _token['value'], _token['expires_at'] = None, 0.0
+        if stale and _read_shared_token()[0] == stale:
+            _write_shared_token(None, 0.0)
 
 # --- NEW: DYNAMIC SECURITY CREDENTIAL ---
+# ⚠️ IMPORTANT: You must download the M-Pesa Certificate (cert.cer) 
+# from the Developer Portal and upload it to your Render root folder.
+CERT_FILE = "cert.cer"
+
 def generate_security_credential(initiator_password):
     """
     Encrypts the Initiator Password using Safaricom's Public Certificate.
     """
     try:
-        # ⚠️ IMPORTANT: You must download the M-Pesa Certificate (cert.cer) 
-        # from the Developer Portal and upload it to your Render root folder.
-        cert_file_path = "cert.cer" 
+        cert_file_path = CERT_FILE
         
         if not os.path.exists(cert_file_path):
             # Fallback for local testing without cert
-            print("❌ Certificate file 'cert.cer' not found!")
+            print(f"❌ Certificate file '{cert_file_path}' not found!")
             return None
 
         with open(cert_file_path, "r") as cert_file:
             cert_data = cert_file.read()
-            
+
+        # You must install pycryptodome: pip install pycryptodome
+        # Imported here, not at module load: only withdrawals need it
+        from Crypto.PublicKey import RSA
+        from Crypto.Cipher import PKCS1_v1_5
+
         pubkey = RSA.importKey(cert_data)
         cipher = PKCS1_v1_5.new(pubkey)
         encrypted_password = cipher.encrypt(initiator_password.encode())
@@ -55,20 +461,56 @@ def generate_security_credential(initiator_password):
         print(f"Encryption Error: {e}")
         return None
 
-def trigger_stk_push(phone_number, amount=1):
+# --- CREDENTIAL CACHE ---
+# The encrypted credential stays valid until the cert or the password changes,
+# so we compute it once and reuse it for every withdrawal.
+_credential_lock = threading.Lock()
+_credential = (None, None) # (key, encrypted value), swapped as one object
+
+def _credential_key(initiator_password):
+    """Identifies the inputs of the cached credential: cert mtime + password."""
+    try:
+        mtime = os.stat(CERT_FILE).st_mtime_ns
+    except OSError:
+        mtime = None
+    return (CERT_FILE, mtime, initiator_password)
+
+def get_security_credential(initiator_password=None):
+    """Returns the cached SecurityCredential, re-encrypting only when its inputs change."""
+    if initiator_password is None:
+        initiator_password = INITIATOR_PASSWORD
+    global _credential
+    key = _credential_key(initiator_password)
+    cached_key, value = _credential
+    if cached_key == key:
+        return value
+
+    with _credential_lock:
+        cached_key, value = _credential
+        if cached_key != key:
+            value = generate_security_credential(initiator_password)
+            _credential = (key, value)
+        return value
+
+def warm_up(fetch_token=False):
     """
-    Initiates the payment prompt (Customer -> Business).
+    Pre-computes expensive state so the first payment after a deploy is fast.
+    Call once per worker at startup; fetch_token also primes the OAuth cache.
     """
-    access_token = get_access_token()
-    api_url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
-    
-    headers = { "Authorization": f"Bearer {access_token}" }
-    
+    get_security_credential()
+    if fetch_token:
+        try:
+            get_access_token()
+        except MpesaError as e:
+            print(f"Token Warm-up Error: {e}")
+
+def stk_push_payload(phone_number, amount=1):
+    """Request body of an STK push."""
     timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
     password_str = BUSINESS_SHORTCODE + PASSKEY + timestamp
     password = base64.b64encode(password_str.encode()).decode()
     
-    payload = {
+    return {
         "BusinessShortCode": BUSINESS_SHORTCODE,
         "Password": password,
         "Timestamp": timestamp,
@@ -81,21 +523,35 @@ def trigger_stk_push(phone_number, amount=1):
         "AccountReference": "SaaSBot",
         "TransactionDesc": "Payment"
     }
+
+def stk_query_payload(checkout_request_id):
+    """Request body of an STK Push Query."""
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    password_str = BUSINESS_SHORTCODE + PASSKEY + timestamp
+    password = base64.b64encode(password_str.encode()).decode()
     
-    response = requests.post(api_url, json=payload, headers=headers)
-    return response.json()
+    return {
+        "BusinessShortCode": BUSINESS_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id
+    }
+
+# v3 takes our own OriginatorConversationID (v1 generates one we only learn from the answer)
+B2C_PATH = "/mpesa/b2c/v3/paymentrequest"
 
-def pay_shop_owner(phone_number, amount):
+def new_originator_id():
+    """A fresh OriginatorConversationID for a B2C request."""
+    return f"W_{uuid.uuid4().hex}"
+
+def b2c_payload(phone_number, amount, originator_id=None):
     """
-    Sends money from Business -> Shop Owner (Withdrawal).
-    NOW USES DYNAMIC SECURITY CREDENTIAL.
+    Request body of a B2C payment, with the cached security credential.
+    originator_id: our OriginatorConversationID. Daraja echoes it in the
+    result, so the result can be matched even if this request's answer is lost.
     """
-    access_token = get_access_token()
-    api_url = "https://sandbox.safaricom.co.ke/mpesa/b2c/v1/paymentrequest"
-    headers = { "Authorization": f"Bearer {access_token}" }
-
-    # Generate the encrypted credential on the fly
-    encrypted_cred = generate_security_credential(INITIATOR_PASSWORD)
+    # Encrypted once, then reused until cert.cer or the password changes
+    encrypted_cred = get_security_credential(INITIATOR_PASSWORD)
     
     # Fallback for Sandbox testing if cert is missing (Remove in Production)
     if not encrypted_cred:
@@ -114,6 +570,181 @@ def pay_shop_owner(phone_number, amount):
         "ResultURL": CALLBACK_URL,
         "Occasion": ""
     }
-    
-    response = requests.post(api_url, json=payload, headers=headers)
-    return response.json()
\ No newline at end of file
+    if originator_id:
+        payload["OriginatorConversationID"] = originator_id
+    return payload
+
+def trigger_stk_push(phone_number, amount=1):
+    """
+    Initiates the payment prompt (Customer -> Business).
+    """
+    response = _authorized_post("/mpesa/stkpush/v1/processrequest", stk_push_payload(phone_number, amount),
+                                time.monotonic() + STK_DEADLINE)
+    return _json(response)
+
+def query_stk_status(checkout_request_id):
+    """
+    Asks Daraja for the outcome of an STK push (STK Push Query API).
+    The response carries ResultCode once the customer has acted on the prompt.
+    """
+    response = _authorized_post("/mpesa/stkpushquery/v1/query", stk_query_payload(checkout_request_id),
+                                time.monotonic() + QUERY_DEADLINE)
+    return _json(response)
+
+def pay_shop_owner(phone_number, amount, originator_id=None):
+    """
+    Sends money from Business -> Shop Owner (Withdrawal).
+    NOW USES DYNAMIC SECURITY CREDENTIAL.
+    """
+    response = _authorized_post(B2C_PATH, b2c_payload(phone_number, amount, originator_id),
+                                time.monotonic() + B2C_DEADLINE)
+    return _json(response)
+
+# --- ASYNC CLIENT ---
+# Async versions of the calls above for the asyncio service (async_app.py):
+# a pending call holds a coroutine and a pooled aiohttp connection instead of
+# a thread, so one process can wait on thousands of them. They share the
+# circuit breaker, deadlines, retry rules, token cache and metrics with the
+# sync client. aiohttp is imported on first use; the Flask app never needs it.
+ASYNC_POOL_SIZE = int(os.environ.get("MPESA_ASYNC_POOL_SIZE", "1000")) # Open connections; more calls wait for one
+RETRY_STATUSES = (429, 500, 502, 503, 504) # Same as _build_retry; GET only
+
+_async_session = None
+_async_token_lock = None
+
+def get_async_session():
+    """Returns the shared aiohttp session (call from the event loop)."""
+    global _async_session
+    if _async_session is None or _async_session.closed:
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE, limit_per_host=0)
+        _async_session = aiohttp.ClientSession(connector=connector)
+    return _async_session
+
+async def close_async_session():
+    global _async_session
+    if _async_session is not None:
+        await _async_session.close()
+        _async_session = None
+
+def _retry_delay(retry):
+    """urllib3's backoff for the n-th retry: none for the first, then doubling, plus jitter."""
+    delay = RETRY_BACKOFF * 2 ** (retry - 1) if retry > 1 else 0.0
+    return delay + random.uniform(0, RETRY_JITTER)
+
+async def http_request_async(method, path, deadline=None, **kwargs):
+    """
+    http_request() on the aiohttp session. Returns (status code, body bytes).
+    Like the sync client, a POST is only retried if the connection never opened.
+    """
+    import aiohttp
+    await _wait_for_call_slot_async(deadline)
+    connect_timeout, read_timeout = _timeouts(method, deadline)
+    trial = breaker.before_call()
+
+    endpoint = path.split('?', 1)[0]
+    status, ok = 'error', False
+    started = time.perf_counter()
+    error = None # The last attempt's failure, raised once retries run out
+    try:
+        for retry in range(HTTP_RETRIES + 1):
+            if retry:
+                await asyncio.sleep(_retry_delay(retry))
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise MpesaUnavailable("Daraja call ran out of time", sent=error.sent)
+            timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout,
+                                            total=deadline - time.monotonic() if deadline else None)
+            try:
+                async with get_async_session().request(method, MPESA_BASE_URL + path, timeout=timeout,
+                                                       **kwargs) as response:
+                    body = await response.read()
+            except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+                error = MpesaUnavailable(f"Daraja request failed: {e}", sent=False)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = MpesaUnavailable(f"Daraja request failed: {e!r}", sent=True)
+                if method != 'GET':
+                    raise error from e
+            else:
+                status = str(response.status)
+                if method == 'GET' and response.status in RETRY_STATUSES and retry < HTTP_RETRIES:
+                    error = MpesaUnavailable(f"Daraja answered {status}", sent=True)
+                    continue
+                ok = response.status < 500 and response.status != 429
+                return response.status, body
+        raise error
+    finally:
+        breaker.after_call(ok, trial)
+        metrics.observe('daraja_request_seconds', time.perf_counter() - started, {'endpoint': endpoint})
+        metrics.inc('daraja_requests_total', {'endpoint': endpoint, 'status': status})
+
+def _json_body(status, body):
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise MpesaError(f"Daraja answered {status} without a JSON body")
+
+async def _fetch_access_token_async(deadline=None):
+    import aiohttp
+    status, body = await http_request_async("GET", "/oauth/v1/generate?grant_type=client_credentials",
+                                            deadline=deadline,
+                                            auth=aiohttp.BasicAuth(CONSUMER_KEY, CONSUMER_SECRET))
+    data = _json_body(status, body)
+    return data.get('access_token'), float(data.get('expires_in', 3599))
+
+async def get_access_token_async(deadline=None):
+    """get_access_token() for the event loop: one coroutine refreshes, the rest wait for it."""
+    global _async_token_lock
+    if _token_is_fresh(_token['value'], _token['expires_at']):
+        _count('hits')
+        return _token['value']
+
+    if _async_token_lock is None:
+        _async_token_lock = asyncio.Lock()
+    async with _async_token_lock:
+        if _token_is_fresh(_token['value'], _token['expires_at']):
+            _count('hits')
+            return _token['value']
+
+        # No _SharedRefreshLock: waiting on the file lock would stall the loop.
+        # At worst two processes fetch a token at the same moment.
+        value, expires_at = _read_shared_token()
+        if _token_is_fresh(value, expires_at):
+            _count('shared_hits')
+        else:
+            _count('misses')
+            value, expires_in = await _fetch_access_token_async(deadline)
+            if not value:
+                return None
+            expires_at = time.time() + expires_in - TOKEN_REFRESH_MARGIN
+            _write_shared_token(value, expires_at)
+
+        _token['value'], _token['expires_at'] = value, expires_at
+        return value
+
+async def _authorized_post_async(path, payload, deadline=None):
+    """_authorized_post() on the event loop. Returns the parsed JSON body."""
+    for attempt in range(2):
+        try:
+            token = await get_access_token_async(deadline)
+        except MpesaUnavailable as e:
+            raise MpesaUnavailable(str(e), sent=False) from e
+        headers = { "Authorization": f"Bearer {token}" }
+        status, body = await http_request_async("POST", path, deadline=deadline, json=payload, headers=headers)
+        if status != 401 or attempt:
+            return _json_body(status, body)
+        reset_access_token()
+
+async def trigger_stk_push_async(phone_number, amount=1):
+    """Async trigger_stk_push()."""
+    return await _authorized_post_async("/mpesa/stkpush/v1/processrequest", stk_push_payload(phone_number, amount),
+                                        time.monotonic() + STK_DEADLINE)
+
+async def query_stk_status_async(checkout_request_id):
+    """Async query_stk_status()."""
+    return await _authorized_post_async("/mpesa/stkpushquery/v1/query", stk_query_payload(checkout_request_id),
+                                        time.monotonic() + QUERY_DEADLINE)
+
+async def pay_shop_owner_async(phone_number, amount, originator_id=None):
+    """Async pay_shop_owner()."""
+    return await _authorized_post_async(B2C_PATH, b2c_payload(phone_number, amount, originator_id),
+                                        time.monotonic() + B2C_DEADLINE)
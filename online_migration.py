@@ -0,0 +1,240 @@
+import sys
+import time
+import logging
+import argparse
+
+import database
+import migrations
+
+logger = logging.getLogger(__name__)
+
+# --- ONLINE TABLE REBUILDS ---
+# Schema v7 rebuilds the core tables as STRICT tables with epoch-second times
+# (shops.expires_at instead of the 'YYYY-MM-DD' expiry_date, and INTEGER
+# created_at/processed_at instead of str(datetime.now())). SQLite can't change
+# a column's type in place, so each table is copied into <table>_v7:
+#   1. prepare:  create <table>_v7 and triggers that mirror every write to the old table
+#   2. backfill: copy old rows in chunks, each its own short transaction
+#   3. swap:     drop the old table and rename <table>_v7 (migration v7)
+# Steps 1-2 run while the current version keeps serving:
+#   python online_migration.py [--chunk 2000] [--pause 0.05]
+# then deploying this version applies migration v7, which only copies what
+# is left and swaps, so the write lock is held for milliseconds. Without the
+# tool, migration v7 does all three steps in one transaction.
+# Rows keep their rowids, so the shop name search index stays valid.
+BACKFILL_CHUNK = 2000
+BACKFILL_PAUSE = 0.05 # Seconds between chunks, for the bot's writes to get in
+
+def _epoch(column):
+    # Old values are local times; 'utc' converts them like time.mktime() does
+    return f"CAST(strftime('%s', {column}, 'utc') AS INTEGER)"
+
+# name -> (v7 columns, {v7 column: expression over the old row {r}}, DDL run after the swap)
+TABLES = {
+    'shops': (
+        '''phone_number TEXT PRIMARY KEY,
+           shop_name TEXT,
+           catalog_link TEXT,
+           location_map TEXT,
+           payment_info TEXT,
+           operating_hours TEXT,
+           expires_at INTEGER,
+           commission_rate REAL NOT NULL DEFAULT 0.05,
+           wallet_cents INTEGER NOT NULL DEFAULT 0,
+           payout_requested_at REAL''',
+        {'phone_number': '{r}.phone_number', 'shop_name': '{r}.shop_name', 'catalog_link': '{r}.catalog_link',
+         'location_map': '{r}.location_map', 'payment_info': '{r}.payment_info',
+         'operating_hours': '{r}.operating_hours', 'expires_at': _epoch('{r}.expiry_date'),
+         'commission_rate': 'COALESCE({r}.commission_rate, 0.05)', 'wallet_cents': '{r}.wallet_cents',
+         'payout_requested_at': '{r}.payout_requested_at'},
+        [
+            "CREATE INDEX IF NOT EXISTS idx_shops_name ON shops(shop_name COLLATE NOCASE)",
+            # Expiry scans page through (expires_at, phone_number)
+            "CREATE INDEX IF NOT EXISTS idx_shops_expiry ON shops(expires_at, phone_number)",
+            """CREATE INDEX IF NOT EXISTS idx_shops_payout ON shops(wallet_cents)
+               WHERE payout_requested_at IS NOT NULL""",
+            '''CREATE TRIGGER IF NOT EXISTS shops_fts_insert AFTER INSERT ON shops BEGIN
+                 INSERT INTO shops_fts(rowid, shop_name) VALUES (new.rowid, new.shop_name);
+               END''',
+            '''CREATE TRIGGER IF NOT EXISTS shops_fts_delete AFTER DELETE ON shops BEGIN
+                 INSERT INTO shops_fts(shops_fts, rowid, shop_name) VALUES ('delete', old.rowid, old.shop_name);
+               END''',
+            '''CREATE TRIGGER IF NOT EXISTS shops_fts_update AFTER UPDATE OF shop_name ON shops BEGIN
+                 INSERT INTO shops_fts(shops_fts, rowid, shop_name) VALUES ('delete', old.rowid, old.shop_name);
+                 INSERT INTO shops_fts(rowid, shop_name) VALUES (new.rowid, new.shop_name);
+               END''',
+        ]),
+    'pending_transactions': (
+        '''checkout_request_id TEXT PRIMARY KEY,
+           user_phone TEXT,
+           transaction_type TEXT,
+           target_shop_phone TEXT,
+           amount REAL,
+           created_at INTEGER NOT NULL''',
+        {'checkout_request_id': '{r}.checkout_request_id', 'user_phone': '{r}.user_phone',
+         'transaction_type': '{r}.transaction_type', 'target_shop_phone': '{r}.target_shop_phone',
+         'amount': '{r}.amount',
+         'created_at': f"COALESCE({_epoch('{r}.timestamp')}, CAST(strftime('%s', 'now') AS INTEGER))"},
+        [
+            "CREATE INDEX IF NOT EXISTS idx_pending_user_type ON pending_transactions(user_phone, transaction_type)",
+            "CREATE INDEX IF NOT EXISTS idx_pending_created ON pending_transactions(created_at)",
+        ]),
+    'wallet_entries': (
+        '''entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+           shop_phone TEXT NOT NULL,
+           entry_type TEXT NOT NULL,
+           gross_cents INTEGER NOT NULL DEFAULT 0,
+           commission_cents INTEGER NOT NULL DEFAULT 0,
+           amount_cents INTEGER NOT NULL,
+           reference TEXT,
+           created_at INTEGER''',
+        {'entry_id': '{r}.entry_id', 'shop_phone': '{r}.shop_phone', 'entry_type': '{r}.entry_type',
+         'gross_cents': '{r}.gross_cents', 'commission_cents': '{r}.commission_cents',
+         'amount_cents': '{r}.amount_cents', 'reference': '{r}.reference',
+         'created_at': _epoch('{r}.created_at')},
+        [
+            "CREATE INDEX IF NOT EXISTS idx_wallet_entries_shop ON wallet_entries(shop_phone, entry_id)",
+        ] + [f'''CREATE TRIGGER IF NOT EXISTS wallet_entries_no_{action.lower()}
+                 BEFORE {action} ON wallet_entries BEGIN
+                   SELECT RAISE(ABORT, 'wallet_entries is append-only');
+                 END''' for action in ('UPDATE', 'DELETE')]),
+    'processed_callbacks': (
+        '''callback_id TEXT PRIMARY KEY,
+           kind TEXT,
+           result_code INTEGER,
+           processed_at INTEGER''',
+        {'callback_id': '{r}.callback_id', 'kind': '{r}.kind', 'result_code': '{r}.result_code',
+         'processed_at': _epoch('{r}.processed_at')},
+        []),
+}
+
+def _new(table):
+    return f"{table}_v7"
+
+def _exists(c, name):
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+    return c.fetchone() is not None
+
+def _is_converted(c, table):
+    # v7 tables are STRICT; the old ones aren't
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    row = c.fetchone()
+    return row is not None and row[0].rstrip().upper().endswith('STRICT')
+
+def _copy_sql(table, mode, where):
+    columns, conversions, _ = TABLES[table]
+    names = ', '.join(conversions)
+    values = ', '.join(expr.format(r='r') for expr in conversions.values())
+    return (f"INSERT OR {mode} INTO {_new(table)} (rowid, {names}) "
+            f"SELECT r.rowid, {values} FROM {table} AS r {where}")
+
+def _prepare(c, table):
+    """Creates <table>_v7 and the triggers that keep it in step with the old table."""
+    columns, conversions, _ = TABLES[table]
+    new = _new(table)
+    c.execute(f"CREATE TABLE IF NOT EXISTS {new} ({columns}) STRICT")
+    c.execute('''CREATE TABLE IF NOT EXISTS online_migration_progress
+                 (table_name TEXT PRIMARY KEY, last_rowid INTEGER NOT NULL)''')
+    names = ', '.join(conversions)
+    values = ', '.join(expr.format(r='new') for expr in conversions.values())
+    for event in ('INSERT', 'UPDATE'):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {new}_sync_{event.lower()} AFTER {event} ON {table} BEGIN
+                        INSERT OR REPLACE INTO {new} (rowid, {names}) VALUES (new.rowid, {values});
+                      END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS {new}_sync_delete AFTER DELETE ON {table} BEGIN
+                    DELETE FROM {new} WHERE rowid = old.rowid;
+                  END''')
+
+def _progress(c, table):
+    c.execute("SELECT last_rowid FROM online_migration_progress WHERE table_name = ?", (table,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def prepare(db_name):
+    """Step 1 for every table still in the old layout. Returns the tables prepared."""
+    prepared = []
+    with database.transaction(db_name) as c:
+        for table in TABLES:
+            if _exists(c, table) and not _is_converted(c, table):
+                _prepare(c, table)
+                prepared.append(table)
+    return prepared
+
+def backfill(db_name, table, chunk=BACKFILL_CHUNK, pause=BACKFILL_PAUSE):
+    """Step 2: copies rows the triggers haven't, chunk rows per transaction. Returns rows copied."""
+    copied = 0
+    while True:
+        with database.transaction(db_name) as c:
+            last = _progress(c, table)
+            c.execute(f"SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                      (last, chunk))
+            upto = c.fetchone()[0]
+            if upto is None:
+                return copied
+            # Rows the triggers already copied hold newer data: keep them
+            c.execute(_copy_sql(table, 'IGNORE', "WHERE r.rowid > ? AND r.rowid <= ?"), (last, upto))
+            copied += c.rowcount
+            c.execute("INSERT OR REPLACE INTO online_migration_progress VALUES (?, ?)", (table, upto))
+        time.sleep(pause)
+
+def swap(c, table):
+    """Step 3, inside the migration's transaction: finishes the copy and renames."""
+    if not _exists(c, table) or _is_converted(c, table):
+        return
+    new = _new(table)
+    if not _exists(c, new):
+        _prepare(c, table)
+    c.execute(_copy_sql(table, 'IGNORE', "WHERE r.rowid > ?"), (_progress(c, table),))
+    for event in ('insert', 'update', 'delete'):
+        c.execute(f"DROP TRIGGER IF EXISTS {new}_sync_{event}")
+    # Dropping the old table also drops its indexes and triggers
+    c.execute(f"DROP TABLE {table}")
+    c.execute(f"ALTER TABLE {new} RENAME TO {table}")
+    for ddl in TABLES[table][2]:
+        c.execute(ddl)
+    c.execute("DELETE FROM online_migration_progress WHERE table_name = ?", (table,))
+
+def swap_all(c):
+    """Migration v7: swaps in every table."""
+    for table in TABLES:
+        swap(c, table)
+    c.execute("DROP TABLE IF EXISTS online_migration_progress")
+
+def run(chunk=BACKFILL_CHUNK, pause=BACKFILL_PAUSE):
+    """Steps 1-2 for every database file. Returns {file: {table: rows copied}}."""
+    report = {}
+    for db_name in database.database_files():
+        version = migrations.get_version(db_name)
+        if version >= 7:
+            continue
+        if version < 6:
+            raise ValueError(f"{db_name} is at schema v{version}; run `python migrations.py` "
+                             f"with the previous release first")
+        report[db_name] = {}
+        for table in prepare(db_name):
+            started = time.perf_counter()
+            copied = backfill(db_name, table, chunk, pause)
+            report[db_name][table] = copied
+            logger.info(f"{db_name}: copied {copied} {table} rows in {time.perf_counter() - started:.1f}s")
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copy the tables into the v7 layout while the bot runs.")
+    parser.add_argument("--chunk", type=int, default=BACKFILL_CHUNK, help="rows per transaction")
+    parser.add_argument("--pause", type=float, default=BACKFILL_PAUSE, help="seconds between chunks")
+    parser.add_argument("--db", default=database.DB_NAME, help="base database file name")
+    args = parser.parse_args(argv)
+
+    database.DB_NAME = args.db
+    try:
+        report = run(args.chunk, args.pause)
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    print(f"✅ Backfill Complete. {report}")
+    print("Now deploy: migration v7 swaps the new tables in.")
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,301 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+
+import database
+import metrics
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# --- WHATSAPP OUTBOX ---
+# Messages we start (reminders, async STK results) are written to the outbox
+# table in DB_NAME and delivered by a pool of background threads, so the code
+# that sends them returns at once and a Twilio failure is retried, not lost.
+#   queued -> sending -> sent | failed (after OUTBOX_MAX_ATTEMPTS)
+# A worker leases a row for OUTBOX_LEASE_SECONDS; if it dies, the row is
+# taken again once the lease runs out. A send must end well within the lease
+# (the Twilio clients time out after TWILIO_TIMEOUT), and a worker only
+# records its outcome while it still holds the lease. Each claim counts as an
+# attempt, so a message whose sends keep outliving the lease also ends up
+# failed after OUTBOX_MAX_ATTEMPTS. Every app process runs OUTBOX_WORKERS
+# threads (0 to deliver only from `python outbox.py`), and all of them share
+# the TWILIO_MESSAGES_PER_SECOND token bucket (see ratelimit.py).
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "4"))
+# The asyncio service (async_app.py) delivers with this many tasks instead
+OUTBOX_ASYNC_TASKS = int(os.environ.get("OUTBOX_ASYNC_TASKS", "32"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_SECONDS = float(os.environ.get("OUTBOX_BACKOFF_SECONDS", "5"))  # Doubles per attempt
+OUTBOX_BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", "600"))
+OUTBOX_LEASE_SECONDS = 120
+OUTBOX_POLL_SECONDS = 1.0 # Idle workers look for due rows this often
+OUTBOX_RETENTION_DAYS = int(os.environ.get("OUTBOX_RETENTION_DAYS", "7"))
+PRUNE_EVERY = 1000 # Deliveries per process between clean-ups
+
+metrics.describe('outbox_deliveries_total', 'counter', 'Outbox delivery attempts by result.')
+metrics.describe('outbox_messages', 'gauge', 'Outbox rows per status.')
+
+@metrics.register_gauge
+def _status_gauge():
+    return [('outbox_messages', {'status': status}, count) for status, count in count_by_status().items()]
+
+def enqueue(to, body, dedup_key=None):
+    """
+    Queues one message. dedup_key (e.g. 'reminder:<phone>:<date>') makes
+    enqueueing idempotent. Returns False if that key was already queued.
+    """
+    return enqueue_many([(to, body, dedup_key)]) > 0
+
+def enqueue_many(messages):
+    """Queues [(to, body, dedup_key)] in one transaction. Returns how many were new."""
+    now = time.time()
+    with database.transaction() as c:
+        before = c.connection.total_changes
+        c.executemany("""INSERT OR IGNORE INTO outbox
+                             (to_phone, body, dedup_key, status, attempts, next_attempt_at, created_at, updated_at)
+                         VALUES (?, ?, ?, 'queued', 0, ?, ?, ?)""",
+                      [(to, body, key, now, now, now) for to, body, key in messages])
+        added = c.connection.total_changes - before
+        if added:
+            database.after_transaction(_wake_workers)
+    return added
+
+def count_by_status():
+    c = database.get_connection().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+    return dict(c.fetchall())
+
+_DUE = """SELECT message_id, to_phone, body, attempts FROM outbox
+          WHERE status IN ('queued', 'sending') AND next_attempt_at <= ?
+          ORDER BY next_attempt_at LIMIT 1""" # Served by idx_outbox_due
+
+def _claim(now):
+    """
+    Leases the next due row, counting the attempt. Returns
+    (message_id, to, body, attempts, lease_until) or None.
+    """
+    # Idle workers only read, so polling never takes the write lock
+    if database.get_connection().execute(_DUE, (now,)).fetchone() is None:
+        return None
+    with database.transaction() as c:
+        # Expired leases that used up every attempt aren't tried again
+        c.execute("""UPDATE outbox SET status = 'failed', updated_at = ?,
+                                       error = COALESCE(error, 'Lease expired on every attempt')
+                     WHERE status = 'sending' AND next_attempt_at <= ? AND attempts >= ?""",
+                  (now, now, OUTBOX_MAX_ATTEMPTS))
+        if c.rowcount:
+            metrics.inc('outbox_deliveries_total', {'result': 'failed'}, c.rowcount)
+            logger.error(f"Outbox: {c.rowcount} message(s) failed after {OUTBOX_MAX_ATTEMPTS} expired attempts")
+        c.execute(_DUE, (now,))
+        row = c.fetchone()
+        if not row:
+            return None
+        lease_until = now + OUTBOX_LEASE_SECONDS
+        c.execute("""UPDATE outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ?,
+                                       updated_at = ? WHERE message_id = ?""",
+                  (lease_until, now, row[0]))
+        message_id, to, body, attempts = row
+        return (message_id, to, body, attempts + 1, lease_until)
+
+def _record(message_id, lease_until, status, attempts, sid=None, error=None, next_attempt_at=None):
+    """Stores a send's outcome if the lease taken at lease_until is still ours. Returns False if not."""
+    now = time.time()
+    with database.transaction() as c:
+        c.execute("""UPDATE outbox SET status = ?, attempts = ?, sid = ?, error = ?,
+                                       next_attempt_at = ?, updated_at = ?
+                     WHERE message_id = ? AND status = 'sending' AND next_attempt_at = ?""",
+                  (status, attempts, sid, error, next_attempt_at or now, now, message_id, lease_until))
+        recorded = c.rowcount > 0
+    if not recorded:
+        logger.warning(f"Outbox message {message_id}: lease expired before its {status} result was recorded")
+    return recorded
+
+def _backoff(attempts):
+    delay = min(OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+def _is_permanent(error):
+    """Twilio 4xx errors (bad number, outside the session window...) won't succeed on retry; 429 will."""
+    status = getattr(error, 'status', None)
+    return isinstance(status, int) and 400 <= status < 500 and status != 429
+
+def _wait_for_send_slot():
+    if not ratelimit.RATE_LIMIT_ENABLED:
+        return
+    capacity, rate = ratelimit.LIMITS['twilio']
+    while not ratelimit.take('twilio:', capacity, rate):
+        time.sleep(random.uniform(0.5, 1.5) / rate)
+
+async def _wait_for_send_slot_async():
+    if not ratelimit.RATE_LIMIT_ENABLED:
+        return
+    capacity, rate = ratelimit.LIMITS['twilio']
+    while not await database.run_async(ratelimit.take, 'twilio:', capacity, rate):
+        await asyncio.sleep(random.uniform(0.5, 1.5) / rate)
+
+def _settle(message_id, to, attempts, lease_until, sid=None, error=None):
+    """Records the outcome of a send. Returns 'sent', 'retry' or 'failed'."""
+    if error is None:
+        result = 'sent'
+        _record(message_id, lease_until, 'sent', attempts, sid=sid)
+    elif attempts >= OUTBOX_MAX_ATTEMPTS or _is_permanent(error):
+        result = 'failed'
+        _record(message_id, lease_until, 'failed', attempts, error=str(error))
+        logger.error(f"Outbox message {message_id} to {to} failed after {attempts} attempt(s): {error}")
+    else:
+        result = 'retry'
+        _record(message_id, lease_until, 'queued', attempts, error=str(error),
+                next_attempt_at=time.time() + _backoff(attempts))
+    metrics.inc('outbox_deliveries_total', {'result': result})
+    return result
+
+def deliver(send, row):
+    """Sends one leased row with send(to, body) -> sid and records the outcome. Returns the result."""
+    message_id, to, body, attempts, lease_until = row
+    _wait_for_send_slot()
+    try:
+        sid = send(to, body)
+    except Exception as e:
+        return _settle(message_id, to, attempts, lease_until, error=e)
+    return _settle(message_id, to, attempts, lease_until, sid=sid)
+
+async def deliver_async(send, row):
+    """deliver() with a coroutine send; the database work runs on database.run_async's pool."""
+    message_id, to, body, attempts, lease_until = row
+    await _wait_for_send_slot_async()
+    try:
+        sid = await send(to, body)
+    except Exception as e:
+        return await database.run_async(_settle, message_id, to, attempts, lease_until, error=e)
+    return await database.run_async(_settle, message_id, to, attempts, lease_until, sid=sid)
+
+def prune(now=None):
+    """Deletes sent and failed rows older than OUTBOX_RETENTION_DAYS. Returns rows deleted."""
+    cutoff = (now or time.time()) - OUTBOX_RETENTION_DAYS * 86400
+    with database.transaction() as c:
+        c.execute("DELETE FROM outbox WHERE status IN ('sent', 'failed') AND updated_at < ?", (cutoff,))
+        return c.rowcount
+
+class DeliveryWorkers:
+    """Threads that drain the outbox. Started per process, like dispatch.WorkerPool."""
+
+    def __init__(self, workers=OUTBOX_WORKERS):
+        self.workers = workers
+        self.stats = {'sent': 0, 'retry': 0, 'failed': 0}
+        self._send = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self, send):
+        """Starts the threads in this process (once); send(to, body) returns the message SID."""
+        self._send = send
+        if self._pid == os.getpid() or not self.workers:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def wake(self):
+        """Cuts idle workers' sleep short when a message is queued in this process."""
+        self._wake.set()
+
+    def _count(self, result):
+        with self._lock:
+            self.stats[result] += 1
+            due = sum(self.stats.values()) % PRUNE_EVERY == 0
+        if due:
+            prune()
+
+    def _run(self):
+        while True:
+            try:
+                row = _claim(time.time())
+                if row is None:
+                    self._wake.wait(OUTBOX_POLL_SECONDS * random.uniform(0.5, 1.5))
+                    self._wake.clear()
+                    continue
+                self._count(deliver(self._send, row))
+            except Exception as e:
+                logger.error(f"Outbox worker error: {e}")
+                time.sleep(OUTBOX_POLL_SECONDS)
+
+class AsyncDeliveryWorkers:
+    """
+    DeliveryWorkers for the asyncio service: OUTBOX_ASYNC_TASKS tasks on its
+    event loop, so a message waiting on Twilio holds no thread.
+    """
+
+    def __init__(self, tasks=OUTBOX_ASYNC_TASKS):
+        self.tasks = tasks
+        self.stats = {'sent': 0, 'retry': 0, 'failed': 0}
+        self._send = None
+        self._loop = None
+        self._wake = None
+        self._running = []
+
+    def start(self, send):
+        """Starts the tasks on the running loop; send(to, body) is a coroutine function returning the SID."""
+        self._send = send
+        if self._running or not self.tasks:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._running = [asyncio.create_task(self._run(), name=f"outbox-{i}") for i in range(self.tasks)]
+
+    async def stop(self):
+        self._loop = None
+        for task in self._running:
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+        self._running = []
+
+    def wake(self):
+        """Like DeliveryWorkers.wake(); callable from any thread (enqueue runs on the database pool)."""
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wake.set)
+
+    async def _count(self, result):
+        self.stats[result] += 1
+        if sum(self.stats.values()) % PRUNE_EVERY == 0:
+            await database.run_async(prune)
+
+    async def _run(self):
+        while True:
+            try:
+                row = await database.run_async(_claim, time.time())
+                if row is None:
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_SECONDS * random.uniform(0.5, 1.5))
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wake.clear()
+                    continue
+                await self._count(await deliver_async(self._send, row))
+            except Exception as e:
+                logger.error(f"Outbox task error: {e}")
+                await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+def _wake_workers():
+    workers.wake()
+    async_workers.wake()
+
+workers = DeliveryWorkers()
+async_workers = AsyncDeliveryWorkers()
+
+if __name__ == '__main__':
+    # A delivery-only process: `OUTBOX_WORKERS=16 python outbox.py`.
+    # Importing app starts the workers of the imported outbox module (this
+    # script is a separate copy), so only start them here if it didn't.
+    import app
+    import outbox
+    if not outbox.workers.workers:
+        outbox.workers.workers = 1
+        outbox.workers.start(app.send_whatsapp)
+    threading.Event().wait()
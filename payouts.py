@@ -0,0 +1,249 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import metrics
+import mpesa
+
+logger = logging.getLogger(__name__)
+
+# --- BATCHED PAYOUTS ---
+# WITHDRAW_MODE=batched: WITHDRAW only flags the shop (shops.payout_requested_at).
+# A scheduled run (/cron/run_payouts or `python payouts.py`) then pays every
+# flagged wallet holding at least MIN_WITHDRAWAL, PAYOUT_CONCURRENCY B2C
+# requests at a time, reusing one access token and security credential.
+#
+# Each shop in a run is a payout_items row (in the shop's shard):
+#   queued -> sending -> sent -> confirmed | failed
+# 'sending' holds a withdrawal lock under a fresh opaque id (payout_items.originator_id,
+# also sent as the OriginatorConversationID) while Daraja is called; once
+# accepted the lock is re-keyed to the ConversationID, so the B2C result goes
+# through the normal callback path (which debits the wallet and settles the item).
+# If Daraja's answer is lost the lock becomes WITHDRAWAL_UNCONFIRMED under the
+# originator id, and the B2C result (or an admin) settles it, even after the
+# item was marked failed.
+# A run left unfinished (crash, Daraja down) is resumed by the next call.
+WITHDRAW_MODE = os.environ.get("WITHDRAW_MODE", "instant")
+MIN_WITHDRAWAL = int(os.environ.get("MIN_WITHDRAWAL", "50"))
+PAYOUT_CONCURRENCY = int(os.environ.get("PAYOUT_CONCURRENCY", "4"))
+PAYOUT_RUN_LIMIT = int(os.environ.get("PAYOUT_RUN_LIMIT", "5000")) # Shops per run
+# A 'sending' item older than this belonged to a runner that died mid-call
+PAYOUT_SENDING_TIMEOUT = 6 * mpesa.B2C_DEADLINE
+
+metrics.describe('payout_items_total', 'counter', 'Payout items by the state a run left them in.')
+metrics.describe('payout_run_seconds', 'histogram', 'Duration of each payout run invocation.')
+
+# --- REQUESTS ---
+def request_payout(shop_phone):
+    """Flags a shop for the next run. Returns False if it was already flagged."""
+    with database.transaction(database.shard_for(shop_phone)) as c:
+        c.execute("UPDATE shops SET payout_requested_at = ? WHERE phone_number = ? AND payout_requested_at IS NULL",
+                  (time.time(), shop_phone))
+        return c.rowcount > 0
+
+def is_requested(shop_phone):
+    c = database.get_connection(database.shard_for(shop_phone)).execute(
+        "SELECT payout_requested_at IS NOT NULL FROM shops WHERE phone_number = ?", (shop_phone,))
+    row = c.fetchone()
+    return bool(row and row[0])
+
+# --- RUNS ---
+def _open_run(now):
+    """Returns (run_id, resumed): the unfinished run if there is one, else a new one."""
+    with database.transaction() as c:
+        c.execute("SELECT run_id FROM payout_runs WHERE status = 'running' ORDER BY run_id LIMIT 1")
+        row = c.fetchone()
+        if row:
+            return row[0], True
+        c.execute("INSERT INTO payout_runs (status, started_at) VALUES ('running', ?)", (now,))
+        return c.lastrowid, False
+
+def _plan(run_id, now):
+    """Queues an item for every eligible shop and clears their requests. Returns items queued."""
+    queued = 0
+    for db_name in database.shard_names():
+        with database.transaction(db_name) as c:
+            # Served by idx_shops_payout (partial index on wallet_cents)
+            c.execute("""SELECT phone_number, wallet_cents FROM shops
+                         WHERE payout_requested_at IS NOT NULL AND wallet_cents >= ?
+                           AND NOT EXISTS (SELECT 1 FROM pending_transactions
+                                           WHERE user_phone = phone_number AND transaction_type IN (?, ?))
+                         ORDER BY wallet_cents DESC LIMIT ?""",
+                      (MIN_WITHDRAWAL * 100, *database.WITHDRAWAL_TYPES, PAYOUT_RUN_LIMIT - queued))
+            # B2C pays whole shillings; the cents stay in the wallet
+            items = [(run_id, phone, cents // 100 * 100, now) for phone, cents in c.fetchall()]
+            c.executemany("""INSERT INTO payout_items (run_id, shop_phone, amount_cents, state, updated_at)
+                             VALUES (?, ?, ?, 'queued', ?)""", items)
+            c.executemany("UPDATE shops SET payout_requested_at = NULL WHERE phone_number = ?",
+                          [(item[1],) for item in items])
+        queued += len(items)
+    return queued
+
+def _expire_interrupted(run_id, now):
+    """Fails items a dead runner left 'sending'. Their lock stays, as unconfirmed."""
+    expired = 0
+    for db_name in database.shard_names():
+        with database.transaction(db_name) as c:
+            c.execute("""SELECT shop_phone, originator_id FROM payout_items
+                         WHERE run_id = ? AND state = 'sending' AND updated_at < ?""",
+                      (run_id, now - PAYOUT_SENDING_TIMEOUT))
+            items = c.fetchall()
+            c.executemany("""UPDATE payout_items SET state = 'failed', updated_at = ?,
+                                    error = 'Interrupted while calling Daraja; check the B2C statement'
+                             WHERE run_id = ? AND shop_phone = ?""",
+                          [(now, run_id, phone) for phone, _ in items])
+            # The B2C may have gone out: keep the lock out of the pending sweep
+            c.executemany("""UPDATE pending_transactions SET transaction_type = 'WITHDRAWAL_UNCONFIRMED'
+                             WHERE checkout_request_id = ?""",
+                          [(originator_id,) for _, originator_id in items])
+            expired += len(items)
+    return expired
+
+def _queued_items(run_id):
+    items = []
+    for db_name in database.shard_names():
+        c = database.get_connection(db_name).execute(
+            "SELECT shop_phone, amount_cents FROM payout_items WHERE run_id = ? AND state = 'queued'", (run_id,))
+        items.extend(c.fetchall())
+    return items
+
+def _claim(run_id, shop_phone, amount_cents):
+    """
+    queued -> sending, taking the shop's withdrawal lock under a new originator id.
+    Returns that id, or None if another runner has the item.
+    """
+    lock_id = mpesa.new_originator_id()
+    with database.transaction(database.shard_for(shop_phone)) as c:
+        c.execute("""UPDATE payout_items SET state = 'sending', originator_id = ?, updated_at = ?
+                     WHERE run_id = ? AND shop_phone = ? AND state = 'queued'""",
+                  (lock_id, time.time(), run_id, shop_phone))
+        if not c.rowcount:
+            return None
+        # Same row log_pending_transaction() writes, in this transaction
+        c.execute("INSERT INTO pending_transactions VALUES (?, ?, 'WITHDRAWAL', NULL, ?, ?)",
+                  (lock_id, shop_phone, amount_cents / 100, int(time.time())))
+    return lock_id
+
+def _finish_item(run_id, shop_phone, lock_id, state, conversation_id=None, error=None, release_lock=False,
+                 unconfirmed=False):
+    with database.transaction(database.shard_for(shop_phone)) as c:
+        # The B2C result may have settled the item (and its lock) already
+        c.execute("""UPDATE payout_items SET state = ?, conversation_id = ?, error = ?, updated_at = ?
+                     WHERE run_id = ? AND shop_phone = ? AND state = 'sending'""",
+                  (state, conversation_id, error, time.time(), run_id, shop_phone))
+        if not c.rowcount:
+            return
+        if release_lock:
+            # Nothing was paid: unlock the wallet and flag it for the next run
+            c.execute("DELETE FROM pending_transactions WHERE checkout_request_id = ?", (lock_id,))
+            c.execute("UPDATE shops SET payout_requested_at = ? WHERE phone_number = ?", (time.time(), shop_phone))
+        elif unconfirmed:
+            # May have been paid: only its B2C result or an admin releases the lock
+            c.execute("""UPDATE pending_transactions SET transaction_type = 'WITHDRAWAL_UNCONFIRMED'
+                         WHERE checkout_request_id = ?""", (lock_id,))
+        elif conversation_id:
+            # Re-key the lock so the B2C result finds it
+            c.execute("UPDATE pending_transactions SET checkout_request_id = ? WHERE checkout_request_id = ?",
+                      (conversation_id, lock_id))
+
+def _send(run_id, shop_phone, amount_cents):
+    """Pays one item. Returns its new state (None if it was left queued)."""
+    if not mpesa.is_available():
+        return None # Daraja is failing: leave it for the resumed run
+    lock_id = _claim(run_id, shop_phone, amount_cents)
+    if not lock_id:
+        return None
+    clean_phone = shop_phone.replace('whatsapp:', '').replace('+', '')
+    try:
+        res = mpesa.pay_shop_owner(clean_phone, amount_cents // 100, lock_id)
+    except mpesa.MpesaError as e:
+        if getattr(e, 'sent', False):
+            # May still be paid: keep the lock, as an unconfirmed WITHDRAW does
+            logger.error(f"Payout: unconfirmed B2C for {shop_phone}: {e}")
+            _finish_item(run_id, shop_phone, lock_id, 'failed', error=f"Unconfirmed: {e}", unconfirmed=True)
+        else:
+            _finish_item(run_id, shop_phone, lock_id, 'failed', error=str(e), release_lock=True)
+        return 'failed'
+
+    if res.get('ResponseCode') != '0' or not res.get('ConversationID'):
+        error = res.get('ResponseDescription') or res.get('errorMessage') or 'Rejected by Daraja'
+        _finish_item(run_id, shop_phone, lock_id, 'failed', error=error, release_lock=True)
+        return 'failed'
+    _finish_item(run_id, shop_phone, lock_id, 'sent', conversation_id=res['ConversationID'])
+    return 'sent'
+
+def _send_one(item):
+    run_id, shop_phone, amount_cents = item
+    try:
+        return _send(run_id, shop_phone, amount_cents)
+    except Exception as e:
+        logger.error(f"Payout to {shop_phone} failed: {e}")
+        return 'failed'
+
+def _count_states(run_id):
+    counts, amount = {}, 0
+    for db_name in database.shard_names():
+        c = database.get_connection(db_name).execute(
+            """SELECT state, COUNT(*), SUM(amount_cents) FROM payout_items
+               WHERE run_id = ? GROUP BY state""", (run_id,))
+        for state, count, cents in c.fetchall():
+            counts[state] = counts.get(state, 0) + count
+            amount += cents
+    return counts, amount
+
+def run():
+    """
+    Plans a new run (or resumes an unfinished one) and sends its queued items.
+    Returns a report with the run's item states, duration and throughput.
+    """
+    started = time.time()
+    run_id, resumed = _open_run(started)
+    expired = _expire_interrupted(run_id, started) if resumed else 0
+    planned = 0 if resumed else _plan(run_id, started)
+
+    items = [(run_id, phone, cents) for phone, cents in _queued_items(run_id)]
+    with ThreadPoolExecutor(max_workers=PAYOUT_CONCURRENCY) as pool:
+        results = list(pool.map(_send_one, items))
+
+    counts, amount_cents = _count_states(run_id)
+    finished = not counts.get('queued') and not counts.get('sending')
+    elapsed = time.time() - started
+    with database.transaction() as c:
+        c.execute("""UPDATE payout_runs SET status = ?, finished_at = ?, items = ?, amount_cents = ?
+                     WHERE run_id = ?""",
+                  ('finished' if finished else 'running', time.time() if finished else None,
+                   sum(counts.values()), amount_cents, run_id))
+
+    attempted = [state for state in results if state]
+    for state in attempted:
+        metrics.inc('payout_items_total', {'state': state})
+    metrics.observe('payout_run_seconds', elapsed)
+    report = {'run_id': run_id, 'resumed': resumed, 'planned': planned, 'interrupted': expired,
+              'attempted': len(attempted), 'sent': attempted.count('sent'),
+              'failed': attempted.count('failed'), 'states': counts,
+              'amount_kes': amount_cents / 100, 'finished': finished,
+              'seconds': round(elapsed, 3),
+              'per_second': round(len(attempted) / elapsed, 2) if elapsed else 0.0}
+    logger.info(f"Payout run {run_id}: {report}")
+    return report
+
+# --- B2C RESULTS ---
+def record_result(pending_id, success, db_name):
+    """
+    Settles an item from the withdrawal lock its B2C result (or an admin)
+    released, inside the callback's transaction. pending_id is the lock's id:
+    the ConversationID once re-keyed, else the item's originator id. Items
+    still 'sending' (result before the answer) or marked failed (unconfirmed,
+    interrupted) are settled too.
+    """
+    with database.transaction(db_name) as c:
+        c.execute("""UPDATE payout_items SET state = ?, updated_at = ?
+                     WHERE (originator_id = ? OR conversation_id = ?)
+                       AND state IN ('sending', 'sent', 'failed')""",
+                  ('confirmed' if success else 'failed', time.time(), pending_id, pending_id))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(run())
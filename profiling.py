@@ -0,0 +1,189 @@
+import os
+import re
+import io
+import json
+import time
+import random
+import pstats
+import logging
+import cProfile
+import tempfile
+import threading
+from functools import wraps
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- REQUEST PROFILING ---
+# Off by default. When on, 1 in PROFILE_EVERY calls of a profiled view
+# (/bot, /mpesa_callback) runs under cProfile, and the profile is kept if the
+# request took at least PROFILE_SLOW_MS. Profiles are pstats files in
+# PROFILE_DIR, <epoch ms>_<command>_<ms>ms_<pid>.prof; the oldest are deleted
+# past PROFILE_MAX_FILES or PROFILE_MAX_MB. Read one with `python -m pstats`.
+# An admin can change the settings without a redeploy (POST /admin/profiling):
+# they go to PROFILE_DIR/settings.json, which every worker on the host reads,
+# and lapse after the given minutes, when the env settings apply again.
+PROFILE_EVERY = int(os.environ.get("PROFILE_EVERY", "0"))        # 0: off, 1: every request
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "200"))
+PROFILE_MAX_MB = float(os.environ.get("PROFILE_MAX_MB", "100"))
+SETTINGS_CHECK_SECONDS = 1.0 # How often a worker looks for new settings
+
+PROFILE_NAME = re.compile(r'^(\d+)_([A-Za-z0-9-]+)_(\d+)ms_(\d+)\.prof$')
+
+metrics.describe('profiles_saved_total', 'counter', 'Request profiles written to PROFILE_DIR per command.')
+
+# --- SETTINGS ---
+_override = {'checked_at': 0.0, 'mtime': None, 'settings': None}
+_override_lock = threading.Lock()
+
+def _settings_path():
+    return os.path.join(PROFILE_DIR, "settings.json")
+
+def _reload_override(now):
+    with _override_lock:
+        _override['checked_at'] = now
+        try:
+            mtime = os.stat(_settings_path()).st_mtime_ns
+        except OSError:
+            _override['mtime'], _override['settings'] = None, None
+            return
+        if mtime == _override['mtime']:
+            return
+        try:
+            with open(_settings_path(), "r") as f:
+                data = json.load(f)
+            _override['settings'] = {'every': int(data['every']), 'slow_ms': float(data['slow_ms']),
+                                     'until': float(data['until'])}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring profiling settings file: {e}")
+            _override['settings'] = None
+        _override['mtime'] = mtime
+
+def get_settings():
+    """The settings in effect: {'every', 'slow_ms', 'until', 'source'}."""
+    now = time.time()
+    if now - _override['checked_at'] >= SETTINGS_CHECK_SECONDS:
+        _reload_override(now)
+    settings = _override['settings']
+    if settings and settings['until'] > now:
+        return dict(settings, source='admin')
+    return {'every': PROFILE_EVERY, 'slow_ms': PROFILE_SLOW_MS, 'until': None, 'source': 'env'}
+
+def set_settings(every, slow_ms=0.0, minutes=60):
+    """Sets every worker on this host to profile 1 in `every` requests (0: none) for `minutes`."""
+    settings = {'every': int(every), 'slow_ms': float(slow_ms), 'until': time.time() + minutes * 60}
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PROFILE_DIR, prefix=".settings")
+    with os.fdopen(fd, "w") as f:
+        json.dump(settings, f)
+    os.replace(tmp_path, _settings_path())
+    _override['checked_at'] = 0.0 # This worker applies it at once
+    return get_settings()
+
+# --- SAMPLING ---
+# One profiled request at a time per process: cProfile can't run two
+# profilers at once, and it bounds the overhead
+_profiling = threading.Lock()
+
+def profiled(label):
+    """
+    Decorator profiling sampled calls of a view. label() names the command;
+    it is called in the request, after the view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            settings = get_settings()
+            every = settings['every']
+            if every <= 0 or random.random() * every >= 1 or not _profiling.acquire(blocking=False):
+                return view(*args, **kwargs)
+            try:
+                profiler = cProfile.Profile()
+                started = time.perf_counter()
+                profiler.enable()
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    profiler.disable()
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    if elapsed_ms >= settings['slow_ms']:
+                        _save(profiler, label, elapsed_ms)
+            finally:
+                _profiling.release()
+        return wrapper
+    return decorator
+
+def _slug(command):
+    # File names use '_' between fields, so 'CALLBACK_STK' is saved as 'CALLBACK-STK'
+    return re.sub(r'[^A-Za-z0-9]+', '-', command).strip('-').upper() or 'UNKNOWN'
+
+def _save(profiler, label, elapsed_ms):
+    # Never fails the request it profiled
+    try:
+        command = _slug(label())
+        name = f"{int(time.time() * 1000)}_{command}_{int(elapsed_ms)}ms_{os.getpid()}.prof"
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        tmp_path = os.path.join(PROFILE_DIR, f".{name}")
+        profiler.dump_stats(tmp_path)
+        os.replace(tmp_path, os.path.join(PROFILE_DIR, name))
+        metrics.inc('profiles_saved_total', {'command': command})
+        prune()
+    except Exception as e:
+        logger.warning(f"Could not save profile: {e}")
+
+# --- SAVED PROFILES ---
+def _saved():
+    """[(name, command, elapsed_ms, created_at, bytes)], newest first."""
+    profiles = []
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except OSError:
+        return profiles
+    for name in names:
+        match = PROFILE_NAME.match(name)
+        if not match:
+            continue
+        try:
+            size = os.path.getsize(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            continue # Pruned by another worker
+        profiles.append((name, match.group(2), int(match.group(3)), int(match.group(1)) / 1000, size))
+    profiles.sort(key=lambda p: p[3], reverse=True)
+    return profiles
+
+def prune():
+    """Deletes the oldest profiles past PROFILE_MAX_FILES or PROFILE_MAX_MB. Returns files deleted."""
+    deleted, kept, total = 0, 0, 0
+    for name, _, _, _, size in _saved():
+        if kept < PROFILE_MAX_FILES and total + size <= PROFILE_MAX_MB * 1024 * 1024:
+            kept += 1
+            total += size
+            continue
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+            deleted += 1
+        except OSError:
+            pass
+    return deleted
+
+def list_profiles(command=None, limit=50):
+    """Recent profiles, newest first, optionally for one command (e.g. 'BUY')."""
+    return [{'name': name, 'command': cmd, 'elapsed_ms': elapsed_ms, 'created_at': created_at, 'bytes': size}
+            for name, cmd, elapsed_ms, created_at, size in _saved()
+            if command is None or cmd == _slug(command)][:limit]
+
+def profile_path(name):
+    """Path of a saved profile, or None if there is no such profile."""
+    if not PROFILE_NAME.match(name):
+        return None # Also keeps requests inside PROFILE_DIR
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
+
+def summary(path, sort='cumulative', limit=40):
+    """The pstats report of a profile: the top `limit` functions by `sort`."""
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
@@ -0,0 +1,83 @@
+import os
+import time
+import logging
+import threading
+
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- RATE LIMITING ---
+# Token buckets kept in SQLite (rate_buckets in DB_NAME), so every gunicorn
+# worker draws from the same buckets without an external service.
+# Limits are written "N/S": bursts of up to N, refilled at N per S seconds.
+#   RATE_LIMIT_PAYMENT  BUY, PAY, WITHDRAW per sender (each one hits Daraja)
+#   RATE_LIMIT_WRITE    REGISTER, UPDATE per sender
+#   RATE_LIMIT_READ     everything else per sender
+#   MPESA_CALLS_PER_SECOND  every outbound Daraja request, all workers (see mpesa.py)
+#   TWILIO_MESSAGES_PER_SECOND  outbox deliveries, all workers (see outbox.py)
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+MPESA_CALLS_PER_SECOND = float(os.environ.get("MPESA_CALLS_PER_SECOND", "20"))
+TWILIO_MESSAGES_PER_SECOND = float(os.environ.get("TWILIO_MESSAGES_PER_SECOND", "10"))
+PRUNE_EVERY = 500 # Takes per process between clean-ups of refilled buckets
+
+def parse_limit(spec):
+    """'5/60' -> (capacity 5, refill rate 5/60 tokens per second)."""
+    count, seconds = spec.split('/')
+    return float(count), float(count) / float(seconds)
+
+LIMITS = {
+    'payment': parse_limit(os.environ.get("RATE_LIMIT_PAYMENT", "3/60")),
+    'write': parse_limit(os.environ.get("RATE_LIMIT_WRITE", "10/60")),
+    'read': parse_limit(os.environ.get("RATE_LIMIT_READ", "30/60")),
+    'mpesa': (MPESA_CALLS_PER_SECOND, MPESA_CALLS_PER_SECOND),
+    'twilio': (TWILIO_MESSAGES_PER_SECOND, TWILIO_MESSAGES_PER_SECOND),
+}
+
+metrics.describe('rate_limit_decisions_total', 'counter', 'Rate limiter decisions by limit and result.')
+
+_takes = [0]
+_takes_lock = threading.Lock()
+
+def take(bucket_key, capacity, rate, cost=1.0, now=None):
+    """Takes cost tokens from a bucket if it has them. Returns True if allowed."""
+    now = now or time.time()
+    with database.transaction() as c:
+        c.execute("SELECT tokens, updated_at FROM rate_buckets WHERE bucket_key=?", (bucket_key,))
+        row = c.fetchone()
+        tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        c.execute("INSERT OR REPLACE INTO rate_buckets VALUES (?, ?, ?, ?)",
+                  (bucket_key, tokens, now, now + (capacity - tokens) / rate))
+    _maybe_prune()
+    return allowed
+
+def allow(limit, key=''):
+    """Checks the named limit ('payment', 'write', 'read', 'mpesa', 'twilio') for key."""
+    if not RATE_LIMIT_ENABLED:
+        return True
+    capacity, rate = LIMITS[limit]
+    allowed = take(f"{limit}:{key}", capacity, rate)
+    metrics.inc('rate_limit_decisions_total', {'limit': limit, 'result': 'allowed' if allowed else 'shed'})
+    if not allowed:
+        logger.info(f"Rate limited {limit} {key}")
+    return allowed
+
+def prune(now=None):
+    """Deletes buckets that have refilled (a missing bucket counts as full). Returns rows deleted."""
+    with database.transaction() as c:
+        c.execute("DELETE FROM rate_buckets WHERE full_at < ?", (now or time.time(),))
+        return c.rowcount
+
+def _maybe_prune():
+    with _takes_lock:
+        _takes[0] += 1
+        due = _takes[0] % PRUNE_EVERY == 0
+    if due:
+        try:
+            prune()
+        except Exception as e:
+            logger.warning(f"Rate bucket prune failed: {e}")
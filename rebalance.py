@@ -0,0 +1,240 @@
+import os
+import sys
+import heapq
+import logging
+import sqlite3
+import argparse
+import tempfile
+
+import database
+import migrations
+
+logger = logging.getLogger(__name__)
+
+# --- SHARD REBALANCING ---
+# Copies shop data from one layout (e.g. the single saas_bot.db) into another
+# (e.g. DB_SHARDS=4 -> saas_bot_0.db ... saas_bot_3.db), routing every row with
+# the same hash the app uses. Once the totals match, the moved tables are
+# emptied in the source files, so any layout can be split or merged again
+# later (copy the files first if you want a backup). Set DB_SHARDS to the new
+# count afterwards. Stop the app (or at least the callback endpoint) while this runs.
+# `python rebalance.py --round-trip 4,1,2` rehearses a chain of layouts on a
+# temporary copy and checks that nothing is lost on the way.
+COPY_BATCH_SIZE = 1000
+# Emptied in the sources after a copy (payout_runs, outbox etc. stay in DB_NAME)
+MOVED_TABLES = ('shops', 'wallet_entries', 'pending_transactions', 'processed_callbacks',
+                'daily_rollups', 'payout_items')
+
+def _columns(db_name, table):
+    c = database.get_connection(db_name).execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in c.fetchall()]
+
+def _scan(db_name, table, columns, order_by):
+    """Yields a table's rows in order, COPY_BATCH_SIZE at a time."""
+    conn = database.get_connection(db_name)
+    cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {order_by}")
+    while True:
+        rows = cursor.fetchmany(COPY_BATCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+def _copy(rows, table, columns, route, skip_existing=False):
+    """
+    Inserts rows into the shards chosen by route(row). Returns rows copied.
+    skip_existing: ignore rows whose key is already there (copies of one row).
+    """
+    insert = f"INSERT {'OR IGNORE ' if skip_existing else ''}INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    batches, copied = {}, 0
+
+    def flush(db_name):
+        with database.transaction(db_name) as c:
+            c.executemany(insert, batches.pop(db_name))
+
+    for row in rows:
+        for db_name in route(row):
+            batch = batches.setdefault(db_name, [])
+            batch.append(row)
+            if len(batch) >= COPY_BATCH_SIZE:
+                flush(db_name)
+        copied += 1
+    for db_name in list(batches):
+        flush(db_name)
+    return copied
+
+def _totals(db_names):
+    """(shops, wallet cents, ledger entries, pending rows, payout items) across db_names."""
+    totals = [0] * 5
+    for db_name in db_names:
+        c = database.get_connection(db_name).execute(
+            """SELECT (SELECT COUNT(*) FROM shops), (SELECT COALESCE(SUM(wallet_cents), 0) FROM shops),
+                      (SELECT COUNT(*) FROM wallet_entries), (SELECT COUNT(*) FROM pending_transactions),
+                      (SELECT COUNT(*) FROM payout_items)""")
+        totals = [total + value for total, value in zip(totals, c.fetchone())]
+    return tuple(totals)
+
+def _clear(db_names):
+    """Empties the moved tables, one transaction per file."""
+    for db_name in db_names:
+        with database.transaction(db_name) as c:
+            # The ledger refuses deletes; lift that only for this move (same transaction)
+            c.execute("DROP TRIGGER IF EXISTS wallet_entries_no_delete")
+            for table in MOVED_TABLES:
+                c.execute(f"DELETE FROM {table}")
+            c.execute('''CREATE TRIGGER wallet_entries_no_delete
+                         BEFORE DELETE ON wallet_entries BEGIN
+                           SELECT RAISE(ABORT, 'wallet_entries is append-only');
+                         END''')
+
+def rebalance(source_shards, target_shards):
+    """
+    Moves every shop, ledger entry, pending row, callback record, rollup and
+    payout item: copies them, checks the totals, then empties the sources.
+    Returns a report dict.
+    """
+    sources = database.shard_names(source_shards)
+    targets = database.shard_names(target_shards)
+    if set(sources) & set(targets):
+        raise ValueError("Source and target files overlap; go through a single file first "
+                         "(e.g. 2 -> 1 -> 4 shards: run with --shards 1, then --from-shards 1 --shards 4)")
+    for db_name in sources:
+        if migrations.get_version(db_name) != migrations.SCHEMA_VERSION:
+            raise ValueError(f"{db_name} is not at schema v{migrations.SCHEMA_VERSION}; "
+                             f"run `python migrations.py` first")
+
+    for db_name in targets:
+        migrations.migrate_file(db_name)
+        c = database.get_connection(db_name).execute(
+            """SELECT (SELECT COUNT(*) FROM shops) + (SELECT COUNT(*) FROM wallet_entries)
+                    + (SELECT COUNT(*) FROM pending_transactions)
+                    + (SELECT COUNT(*) FROM daily_rollups)""")
+        if c.fetchone()[0]:
+            raise ValueError(f"{db_name} already holds shop data; refusing to copy over it")
+
+    def to_shard(phone):
+        return [database.shard_for(phone, target_shards)]
+
+    report = {'sources': sources, 'targets': targets}
+
+    # 1. Shops (the search index is filled by its triggers)
+    columns = _columns(sources[0], 'shops')
+    report['shops'] = _copy((row for db_name in sources
+                             for row in _scan(db_name, 'shops', columns, 'rowid')),
+                            'shops', columns, lambda row: to_shard(row[0]))
+
+    # 2. Ledger: entry_id is renumbered per shard, keeping each shop's order
+    columns = [col for col in _columns(sources[0], 'wallet_entries') if col != 'entry_id']
+    created = columns.index('created_at')
+    scans = [_scan(db_name, 'wallet_entries', columns, 'entry_id') for db_name in sources]
+    entries = scans[0] if len(scans) == 1 else heapq.merge(*scans, key=lambda row: row[created] or 0)
+    report['wallet_entries'] = _copy(entries, 'wallet_entries', columns,
+                                     lambda row: to_shard(row[columns.index('shop_phone')]))
+
+    # 3. Pending transactions go with the shop they settle to
+    columns = _columns(sources[0], 'pending_transactions')
+    report['pending_transactions'] = _copy(
+        (row for db_name in sources for row in _scan(db_name, 'pending_transactions', columns, 'rowid')),
+        'pending_transactions', columns, lambda row: to_shard(database.pending_owner(row[1], row[3])))
+
+    # 4. Processed callbacks carry no phone number, so every shard gets a copy
+    #    (and merging shards meets each one several times)
+    columns = _columns(sources[0], 'processed_callbacks')
+    report['processed_callbacks'] = _copy(
+        (row for db_name in sources for row in _scan(db_name, 'processed_callbacks', columns, 'rowid')),
+        'processed_callbacks', columns, lambda row: targets, skip_existing=True)
+
+    # 5. Daily rollups: shop rows go with their shop. Platform rows are summed
+    #    per day and kept in the first target (reports add them up across shards).
+    columns = _columns(sources[0], 'daily_rollups')
+    platform = {}
+    def route_rollup(row):
+        if row[0] != database.PLATFORM:
+            return to_shard(row[0])
+        totals = platform.setdefault(row[1], [0] * (len(columns) - 2))
+        for i, value in enumerate(row[2:]):
+            totals[i] += value
+        return []
+    report['daily_rollups'] = _copy(
+        (row for db_name in sources for row in _scan(db_name, 'daily_rollups', columns, 'shop_phone, day')),
+        'daily_rollups', columns, route_rollup)
+    _copy(((database.PLATFORM, day, *totals) for day, totals in sorted(platform.items())),
+          'daily_rollups', columns, lambda row: targets[:1])
+
+    # 6. Payout items go with their shop (payout_runs stay in DB_NAME)
+    columns = _columns(sources[0], 'payout_items')
+    report['payout_items'] = _copy(
+        (row for db_name in sources for row in _scan(db_name, 'payout_items', columns, 'run_id, shop_phone')),
+        'payout_items', columns, lambda row: to_shard(row[1]))
+
+    # Nothing may be lost or double counted on the way
+    before, after = _totals(sources), _totals(targets)
+    if before != after:
+        raise RuntimeError(f"Totals differ after copy: {before} before, {after} after "
+                           f"(shops, cents, ledger entries, pending, payout items); sources left as they were")
+    report['wallet_cents'] = after[1]
+    _clear(sources)
+    return report
+
+def round_trip(start_shards, chain):
+    """
+    Runs start_shards -> chain[0] -> chain[1] ... on a temporary copy of the
+    current files and checks the totals after every step. Returns the totals.
+    """
+    base = database.DB_NAME
+    with tempfile.TemporaryDirectory() as folder:
+        # The backup API also copies what is still in the WAL
+        for db_name in dict.fromkeys(database.database_files() + database.shard_names(start_shards)):
+            if os.path.exists(db_name):
+                copy = sqlite3.connect(os.path.join(folder, os.path.basename(db_name)))
+                database.get_connection(db_name).backup(copy)
+                copy.close()
+        database.DB_NAME = os.path.join(folder, os.path.basename(base))
+        try:
+            current = start_shards
+            expected = _totals(database.shard_names(current))
+            for shards in chain:
+                rebalance(current, shards)
+                totals = _totals(database.shard_names(shards))
+                if totals != expected:
+                    raise RuntimeError(f"{current} -> {shards} shards changed the totals: "
+                                       f"{expected} before, {totals} after")
+                logger.info(f"{current} -> {shards} shards: totals {totals} kept")
+                current = shards
+            database.close_connections()
+            return expected
+        finally:
+            database.DB_NAME = base
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split (or merge) the shop databases into N shards.")
+    parser.add_argument("--shards", type=int, help="target number of shards")
+    parser.add_argument("--from-shards", type=int, default=1, help="current DB_SHARDS (default: 1)")
+    parser.add_argument("--db", default=database.DB_NAME, help="base database file name")
+    parser.add_argument("--round-trip", help="rehearse a chain of shard counts (e.g. 4,1,2) on a "
+                                             "temporary copy and check the totals; changes nothing")
+    args = parser.parse_args(argv)
+    if not args.shards and not args.round_trip:
+        parser.error("--shards or --round-trip is required")
+
+    database.DB_NAME = args.db
+    if args.round_trip:
+        try:
+            totals = round_trip(args.from_shards, [int(n) for n in args.round_trip.split(',')])
+        except (ValueError, RuntimeError) as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 1
+        print(f"✅ Round trip {args.from_shards} -> {args.round_trip} kept every total: {totals} "
+              f"(shops, cents, ledger entries, pending, payout items)")
+        return 0
+    try:
+        report = rebalance(args.from_shards, args.shards)
+    except (ValueError, RuntimeError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    print(f"✅ Rebalance Complete. {report}")
+    print(f"Now restart the app with DB_SHARDS={args.shards}")
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
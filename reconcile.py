@@ -0,0 +1,85 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import callbacks
+import database
+import mpesa
+
+logger = logging.getLogger(__name__)
+
+# --- RECONCILIATION SETTINGS ---
+# STK pushes with no callback after RECONCILE_AFTER_MINUTES are looked up with
+# the STK Push Query API; anything still unsettled after its TTL is deleted.
+RECONCILE_AFTER_MINUTES = int(os.environ.get("RECONCILE_AFTER_MINUTES", "5"))
+RECONCILE_BATCH_SIZE = int(os.environ.get("RECONCILE_BATCH_SIZE", "100"))
+RECONCILE_CONCURRENCY = int(os.environ.get("RECONCILE_CONCURRENCY", "4"))
+STK_PENDING_TTL_MINUTES = int(os.environ.get("STK_PENDING_TTL_MINUTES", "60"))
+# B2C has no synchronous query, so a withdrawal lock is only released after
+# a much longer wait (its callback may be delayed, not lost). Unconfirmed
+# sends (WITHDRAWAL_UNCONFIRMED) are never released here: the money may have
+# gone out, so they wait for their B2C result or an admin (/admin/withdrawals).
+WITHDRAWAL_PENDING_TTL_MINUTES = int(os.environ.get("WITHDRAWAL_PENDING_TTL_MINUTES", "1440"))
+SWEEP_BATCH_SIZE = 500
+
+STK_TYPES = ('PURCHASE', 'SUBSCRIPTION')
+
+def _query(checkout_id):
+    """Returns the settled ResultCode for an STK push, or None if not known yet."""
+    try:
+        res = mpesa.query_stk_status(checkout_id)
+    except Exception as e:
+        logger.error(f"STK Query Error for {checkout_id}: {e}")
+        return None
+    if res.get('ResponseCode') == '0' and 'ResultCode' in res:
+        return int(res['ResultCode'])
+    # e.g. errorCode 500.001.1001: "The transaction is being processed"
+    return None
+
+def reconcile_stk(now=None):
+    """
+    Queries Daraja for STK pushes whose callback never arrived and settles
+    them through the normal callback path (so it stays idempotent).
+    Returns (queried, settled).
+    """
+    now = now or datetime.now()
+    cutoff = now - timedelta(minutes=RECONCILE_AFTER_MINUTES)
+    rows = database.get_stale_pending(cutoff, STK_TYPES, RECONCILE_BATCH_SIZE)
+    if not rows:
+        return 0, 0
+
+    ids = [row[0] for row in rows]
+    with ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY) as pool:
+        result_codes = list(pool.map(_query, ids))
+
+    settled = 0
+    for checkout_id, result_code in zip(ids, result_codes):
+        if result_code is None:
+            continue
+        status = callbacks.apply_callback('STK', checkout_id, result_code)
+        logger.info(f"Reconciled {checkout_id}: {status}")
+        settled += 1
+    return len(ids), settled
+
+def sweep(now=None):
+    """Deletes pending rows past their TTL. Returns (stk_deleted, withdrawals_released)."""
+    now = now or datetime.now()
+    stk = database.sweep_expired_pending(now - timedelta(minutes=STK_PENDING_TTL_MINUTES),
+                                         STK_TYPES, SWEEP_BATCH_SIZE)
+    withdrawals = database.sweep_expired_pending(now - timedelta(minutes=WITHDRAWAL_PENDING_TTL_MINUTES),
+                                                 ('WITHDRAWAL',), SWEEP_BATCH_SIZE)
+    if withdrawals:
+        logger.warning(f"⚠️ Released {withdrawals} withdrawal lock(s) with no B2C result")
+    return stk, withdrawals
+
+def run():
+    """One reconciliation pass: settle what Daraja knows, then sweep the rest."""
+    queried, settled = reconcile_stk()
+    stk_deleted, withdrawals_released = sweep()
+    return {'queried': queried, 'settled': settled,
+            'stk_expired': stk_deleted, 'withdrawals_released': withdrawals_released}
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(run())
@@ -0,0 +1,155 @@
+import time
+import logging
+import importlib
+import threading
+from collections import namedtuple
+
+from twilio.twiml.messaging_response import MessagingResponse
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('bot_command_seconds', 'histogram', 'Time spent in each /bot command handler.')
+
+# What a command handler receives:
+# raw: message as typed, command: upper-cased, sender: 'whatsapp:+254...',
+# args: the '|' separated parts (stripped), including the command word itself
+BotRequest = namedtuple('BotRequest', 'raw command sender args')
+
+Command = namedtuple('Command', 'name handler prefix args usage')
+
+def render(body):
+    """Builds the TwiML reply for a single message body."""
+    resp = MessagingResponse()
+    msg = resp.message()
+    msg.body(body)
+    return str(resp)
+
+def prerender(body):
+    """Encodes a fixed reply once, so serving it costs no XML work per request."""
+    return render(body).encode('utf-8')
+
+class CommandRouter:
+    """
+    Maps WhatsApp commands to handlers.
+    Exact commands (e.g. STATUS) are a dict lookup; prefix commands
+    (e.g. 'BUY | ...') are tried longest name first. Handlers return a
+    message body (rendered here) or pre-rendered bytes (served as is).
+    """
+
+    def __init__(self, fallback):
+        self.fallback = prerender(fallback)
+        self._exact = {}
+        self._prefix = []
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def command(self, name, prefix=False, args=None, usage=None):
+        """
+        Decorator registering a handler.
+        args: number of '|' parts required (the last one keeps any extra '|');
+        if fewer are sent, usage is replied instead of calling the handler.
+        """
+        def decorator(handler):
+            self.add(Command(name.upper(), handler, prefix, args,
+                             prerender(usage) if usage else None))
+            return handler
+        return decorator
+
+    def static(self, names, body):
+        """Registers commands that always get the same reply."""
+        reply = prerender(body)
+        for name in names:
+            self.add(Command(name.upper(), lambda req: reply, False, None, None))
+
+    def add(self, command):
+        if command.prefix:
+            self._prefix = [c for c in self._prefix if c.name != command.name] + [command]
+            self._prefix.sort(key=lambda c: len(c.name), reverse=True)
+        else:
+            self._exact[command.name] = command
+
+    def resolve(self, command_msg):
+        """Returns the Command for a message, or None."""
+        command = self._exact.get(command_msg)
+        if command:
+            return command
+        for command in self._prefix:
+            if command_msg.startswith(command.name):
+                return command
+        return None
+
+    def _request(self, command, raw_msg, command_msg, sender):
+        """The handler's BotRequest, or None if fewer '|' parts than command.args were sent."""
+        if command.args:
+            parts = [p.strip() for p in raw_msg.split('|', command.args - 1)]
+            if len(parts) < command.args:
+                return None
+        else:
+            parts = [raw_msg]
+        return BotRequest(raw_msg, command_msg, sender, parts)
+
+    def dispatch(self, raw_msg, sender):
+        """Runs the matching handler and returns the TwiML reply."""
+        command_msg = raw_msg.upper()
+        command = self.resolve(command_msg)
+        if not command:
+            self._record('FALLBACK', 0.0)
+            return self.fallback
+
+        started = time.perf_counter()
+        try:
+            req = self._request(command, raw_msg, command_msg, sender)
+            if req is None:
+                return command.usage
+            reply = command.handler(req)
+            return reply if isinstance(reply, bytes) else render(reply)
+        finally:
+            self._record(command.name, time.perf_counter() - started)
+
+    async def dispatch_async(self, raw_msg, sender, async_handlers, run):
+        """
+        dispatch() for the asyncio service. Commands in async_handlers
+        (name -> coroutine function) are awaited; any other handler is
+        awaited through run(handler, req), e.g. on a thread pool.
+        """
+        command_msg = raw_msg.upper()
+        command = self.resolve(command_msg)
+        if not command:
+            self._record('FALLBACK', 0.0)
+            return self.fallback
+
+        started = time.perf_counter()
+        try:
+            req = self._request(command, raw_msg, command_msg, sender)
+            if req is None:
+                return command.usage
+            handler = async_handlers.get(command.name)
+            reply = await (handler(req) if handler else run(command.handler, req))
+            return reply if isinstance(reply, bytes) else render(reply)
+        finally:
+            self._record(command.name, time.perf_counter() - started)
+
+    def _record(self, name, elapsed):
+        metrics.observe('bot_command_seconds', elapsed, {'command': name})
+        with self._stats_lock:
+            stats = self._stats.setdefault(name, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+    def stats(self):
+        """Per-command call counts and handler time."""
+        with self._stats_lock:
+            return {name: dict(s) for name, s in self._stats.items()}
+
+    def load_plugins(self, module_names):
+        """Imports each plugin module and calls its register(router)."""
+        for module_name in module_names:
+            module_name = module_name.strip()
+            if not module_name:
+                continue
+            module = importlib.import_module(module_name)
+            module.register(self)
+            logger.info(f"Loaded command plugin {module_name}")
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# --- COLD START REPORT ---
+# Imports the app in a fresh interpreter (as a new worker would) and shows
+# where the time goes: each module app.py imports, the startup steps app.py
+# records, and what the modules it defers cost when first used.
+#   python startup_report.py [--runs 5] [--json]
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFERRED = ('twilio.rest', 'Crypto.PublicKey.RSA', 'Crypto.Cipher.PKCS1_v1_5')
+
+_PROBE = """
+import json, sys, time, importlib
+started = time.perf_counter()
+import app
+total = time.perf_counter() - started
+deferred = {}
+for name in %r:
+    t = time.perf_counter()
+    importlib.import_module(name)
+    deferred[name] = round((time.perf_counter() - t) * 1000, 2)
+print(json.dumps({'total_ms': round(total * 1000, 2), 'steps_ms': app.STARTUP_TIMINGS,
+                  'deferred_ms': deferred}))
+""" % (DEFERRED,)
+
+def _parse_importtime(stderr, module='app'):
+    """
+    Returns {direct import of module: cumulative ms} from -X importtime output.
+    Nested imports are printed before their parent, one indent level deeper.
+    """
+    children, result = {}, {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|', 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 1:
+            children[name] = int(cumulative) / 1000
+        elif depth == 0:
+            if name == module:
+                result = dict(children)
+            children = {}
+    return result
+
+def measure():
+    """One cold import of the app. Returns the probe's timings plus the import breakdown."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', _PROBE],
+                          cwd=os.getcwd(), capture_output=True, text=True,
+                          env=dict(os.environ, PYTHONPATH=HERE + os.pathsep + os.environ.get('PYTHONPATH', '')))
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "probe failed")
+    report = json.loads(proc.stdout.strip().splitlines()[-1])
+    report['imports_ms'] = _parse_importtime(proc.stderr)
+    return report
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0.0
+
+def summarize(reports):
+    """Median of each timing over several runs."""
+    def merged(key):
+        names = {name for r in reports for name in r[key]}
+        return {name: round(_median([r[key].get(name, 0.0) for r in reports]), 2) for name in names}
+    return {'runs': len(reports),
+            'total_ms': round(_median([r['total_ms'] for r in reports]), 2),
+            'imports_ms': merged('imports_ms'),
+            'steps_ms': merged('steps_ms'),
+            'deferred_ms': merged('deferred_ms')}
+
+def print_report(summary):
+    print(f"Cold import of app.py: {summary['total_ms']:.1f} ms (median of {summary['runs']} runs)\n")
+    print("Imports made by app.py (cumulative):")
+    for name, ms in sorted(summary['imports_ms'].items(), key=lambda item: -item[1]):
+        print(f"  {name:<24} {ms:8.1f} ms")
+    print("\nStartup steps:")
+    for name, ms in summary['steps_ms'].items():
+        print(f"  {name:<24} {ms:8.1f} ms")
+    print("\nDeferred to first use (not paid at startup):")
+    for name, ms in summary['deferred_ms'].items():
+        print(f"  {name:<24} {ms:8.1f} ms")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Break down the app's cold start time.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    summary = summarize([measure() for _ in range(args.runs)])
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+
+if __name__ == '__main__':
+    main()